@@ -0,0 +1,252 @@
+#!/bin/usr/python3
+'''
+    Benchmarks of the training and decoding stages on synthetic corpora
+'''
+import argparse, random, tempfile, tracemalloc, subprocess
+from utils import *
+from models import *
+from decoders import *
+
+STAGES = ['model1', 'model2', 'model3', 'lm', 'decode_model3_lm', 'decode_beam']
+
+#
+# functions
+#
+
+def generate_corpora(prefix, sentences, vocab_size=1000, mean_length=10, length_spread=3, max_length=40, seed=0) :
+    '''
+        writes a synthetic parallel corpus (prefix.de-en), a monolingual corpus of its english side (prefix.en)
+        and a foreign input file (prefix.de)
+
+        Foreign tokens are drawn from a Zipf distribution over vocab_size tokens and translated by a fixed
+        random lexicon with some noise, local reordering, dropped and inserted tokens, so that the models
+        have structure to learn.
+
+        arguments
+            prefix : output path prefix
+            sentences : number of sentence pairs
+            vocab_size=1000 : size of both vocabularies
+            mean_length=10, length_spread=3 : mean and standard deviation of the foreign sentence lengths
+            max_length=40 : maximum sentence length
+            seed=0 : random seed
+        returns number of foreign tokens
+    '''
+    rand = random.Random(seed)
+    tokens_f = [ 'f%d' % index for index in range(vocab_size) ]
+    weights = [ 1./(index+1) for index in range(vocab_size) ]
+    lexicon = list(range(vocab_size))
+    rand.shuffle(lexicon)
+    res = 0
+    with open(prefix+'.de-en', 'w', encoding='utf8') as fop_ef, open(prefix+'.en', 'w', encoding='utf8') as fop_e, open(prefix+'.de', 'w', encoding='utf8') as fop_f :
+        for index_sen in range(sentences) :
+            length = min(max(int(round(rand.gauss(mean_length, length_spread))), 1), max_length)
+            sentence_f = rand.choices(range(vocab_size), weights, k=length)
+            sentence_e = []
+            for index_f in sentence_f :
+                noise = rand.random()
+                if noise < 0.05 :
+                    continue # dropped token
+                sentence_e.append('e%d' % (lexicon[index_f] if noise < 0.9 else rand.randrange(vocab_size)))
+                if noise > 0.97 :
+                    sentence_e.append('e%d' % rand.randrange(vocab_size)) # inserted token
+            for index_e in range(len(sentence_e)-1) :
+                if rand.random() < 0.1 :
+                    sentence_e[index_e], sentence_e[index_e+1] = sentence_e[index_e+1], sentence_e[index_e]
+            if len(sentence_e) < 1 :
+                sentence_e = ['e%d' % lexicon[sentence_f[0]]]
+            sentence_f = [ tokens_f[index_f] for index_f in sentence_f ]
+            fop_ef.write(' '.join(sentence_f) + ' ||| ' + ' '.join(sentence_e) + '\n')
+            fop_e.write(' '.join(sentence_e) + '\n')
+            fop_f.write(' '.join(sentence_f) + '\n')
+            res += len(sentence_f)
+    return res
+
+def measure(function, *args, memory=True, **kwargs) :
+    '''
+        calls function(*args, **kwargs)
+
+        returns (result, {'seconds', 'peak_mb'}) where peak_mb is the peak of the memory allocated
+        during the call as traced by tracemalloc (None if memory=False, tracing slows the call down)
+    '''
+    if memory :
+        tracemalloc.start()
+    start = perf_counter()
+    res = function(*args, **kwargs)
+    stats = {'seconds':perf_counter() - start, 'peak_mb':None}
+    if memory :
+        stats['peak_mb'] = tracemalloc.get_traced_memory()[1] / (1<<20)
+        tracemalloc.stop()
+    return res, stats
+
+def get_commit() :
+    try :
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError :
+        return None
+
+def run_benchmark(sentences=2000, vocab_size=1000, mean_length=10, length_spread=3, iterations=2, order=3, decode_sentences=200, stages=None, memory=True, seed=0, verbose=False) :
+    '''
+        times the training and decoding stages on a synthetic corpus
+
+        Model 2 and 3 are resumed from the checkpoints of the previous stage, so every stage only
+        measures its own iterations (Model 1 and 2 use iterations*2 iterations as in train_model3).
+
+        arguments
+            sentences, vocab_size, mean_length, length_spread, seed : synthetic corpus (see generate_corpora)
+            iterations=2 : number of Model 3 iterations
+            order=3 : language model order
+            decode_sentences=200 : number of decoded foreign sentences
+            stages=None : subset of STAGES (default all)
+            memory=True : record the peak memory of every stage
+        returns {'config', 'commit', 'tokens', 'stages' : {stage : {'seconds', 'peak_mb', 'items', 'tokens', 'items_per_second'}}}
+            where items are the processed sentence (pairs) and tokens the processed foreign tokens
+    '''
+    stages = stages if stages else STAGES
+    config = {'sentences':sentences, 'vocab_size':vocab_size, 'mean_length':mean_length, 'length_spread':length_spread, 'iterations':iterations, 'order':order, 'decode_sentences':decode_sentences, 'memory':memory, 'seed':seed}
+    res = {'config':config, 'commit':get_commit(), 'stages':{}}
+    with tempfile.TemporaryDirectory() as work_dir :
+        prefix = os.path.join(work_dir, 'synthetic')
+        res['tokens'] = generate_corpora(prefix, sentences, vocab_size, mean_length, length_spread, seed=seed)
+        checkpoint = os.path.join(work_dir, 'checkpoint')
+        corpus_ef = corpus_parallel(prefix+'.de-en')
+        corpus_f = list(islice(corpus(prefix+'.de'), decode_sentences))
+        tokens_f = sum(len(sentence_f) for sentence_f in corpus_f)
+        def record(stage, items, tokens, function, *args, **kwargs) :
+            value, stats = measure(function, *args, memory=memory, **kwargs)
+            stats['items'] = items
+            stats['tokens'] = tokens
+            stats['items_per_second'] = items / stats['seconds'] if stats['seconds'] > 0 else None
+            res['stages'][stage] = stats
+            if verbose : print("%-18s %10.3f s %12.1f items/s %s" % (stage, stats['seconds'], stats['items_per_second'] or 0, ('%8.1f MB' % stats['peak_mb']) if memory else ''))
+            return value
+        model3 = None
+        if 'model1' in stages :
+            record('model1', sentences*iterations*2, res['tokens']*iterations*2, train_model1, corpus_ef, iterations*2, checkpoint=checkpoint)
+        if 'model2' in stages :
+            record('model2', sentences*iterations*2, res['tokens']*iterations*2, train_model2, corpus_ef, iterations*2, checkpoint=checkpoint)
+        if set(stages) & set(['model3', 'decode_model3_lm', 'decode_beam']) :
+            if 'model3' in stages :
+                model3 = record('model3', sentences*iterations, res['tokens']*iterations, train_model3, corpus_ef, iterations, checkpoint=checkpoint)
+            else :
+                model3 = train_model3(corpus_ef, iterations, checkpoint=checkpoint)
+        prob_lm = None
+        if set(stages) & set(['lm', 'decode_model3_lm', 'decode_beam']) :
+            if 'lm' in stages :
+                prob_lm = record('lm', sentences, res['tokens'], train_lm, corpus(prefix+'.en'), order)
+            else :
+                prob_lm = train_lm(corpus(prefix+'.en'), order)
+        if model3 is not None :
+            dist_t, dist_d, dist_f, prob_p0 = distribution(model3[0]), distribution(model3[1]), distribution(model3[2]), model3[3]
+            lm_weights = { n : 1./order for n in range(1, order+1) }
+            for stage, decoder in [('decode_model3_lm', decode_model3_lm), ('decode_beam', decode_beam)] :
+                if stage in stages :
+                    record(stage, len(corpus_f), tokens_f, decoder, corpus_f, dist_t, dist_d, dist_f, prob_p0, prob_lm, lm_weights)
+    return res
+
+def compare_results(baseline, current, tolerance=0.2) :
+    '''
+        compares two results of run_benchmark stage by stage
+
+        arguments
+            baseline, current : results (as loaded from the JSON files)
+            tolerance=0.2 : relative increase of time or peak memory which is flagged as a regression
+        returns [(stage, metric, baseline value, current value, ratio, regression)]
+            times are only compared if both results were traced the same way (memory option)
+    '''
+    res = []
+    metrics = ['peak_mb']
+    if baseline['config'].get('memory') == current['config'].get('memory') :
+        metrics.insert(0, 'seconds')
+    for stage in baseline['stages'] :
+        if stage not in current['stages'] :
+            continue
+        for metric in metrics :
+            value_baseline = baseline['stages'][stage].get(metric)
+            value_current = current['stages'][stage].get(metric)
+            if (not value_baseline) or (value_current is None) :
+                continue
+            ratio = value_current / value_baseline
+            res.append((stage, metric, value_baseline, value_current, ratio, ratio > 1 + tolerance))
+    return res
+
+def run_scaling(sizes, lengths, verbose=False, **kwargs) :
+    '''
+        runs run_benchmark for every corpus size (at the default length) and every mean sentence length
+        (at the smallest size)
+
+        returns {'sizes' : [result], 'lengths' : [result]}
+    '''
+    res = {'sizes':[], 'lengths':[]}
+    for sentences in sizes :
+        if verbose : print("sentences : %d" % sentences)
+        res['sizes'].append(run_benchmark(sentences=sentences, verbose=verbose, **kwargs))
+    for mean_length in lengths :
+        if verbose : print("mean length : %d" % mean_length)
+        res['lengths'].append(run_benchmark(sentences=min(sizes), mean_length=mean_length, length_spread=max(mean_length//4, 1), verbose=verbose, **kwargs))
+    return res
+
+def print_scaling(curves) :
+    '''
+        prints the microseconds per token of every stage along both curves, constant values indicate linear scaling
+    '''
+    for curve, key in [('sizes', 'sentences'), ('lengths', 'mean_length')] :
+        if len(curves[curve]) < 1 :
+            continue
+        stages = [ stage for stage in STAGES if stage in curves[curve][0]['stages'] ]
+        print()
+        print(('%-12s' % key) + ''.join('%18s' % stage for stage in stages) + '   (us per token)')
+        for result in curves[curve] :
+            row = '%-12d' % result['config'][key]
+            for stage in stages :
+                stats = result['stages'][stage]
+                row += '%18.2f' % (1e6 * stats['seconds'] / max(stats['tokens'], 1))
+            print(row)
+
+if __name__ == '__main__' :
+    arg_parser = argparse.ArgumentParser(description='benchmarks the training and decoding stages on synthetic corpora')
+    arg_subparsers = arg_parser.add_subparsers(dest='command', metavar='command')
+    arg_subparsers.required = True
+    arg_options = argparse.ArgumentParser(add_help=False)
+    arg_options.add_argument('--vocab-size', type=int, default=1000, help='vocabulary size of both languages')
+    arg_options.add_argument('--iterations', type=int, default=2, help='number of Model 3 iterations (Model 1 and 2 use twice as many)')
+    arg_options.add_argument('--order', type=int, default=3, help='language model order')
+    arg_options.add_argument('--decode-sentences', type=int, default=200, help='number of decoded sentences')
+    arg_options.add_argument('--stages', nargs='+', choices=STAGES, default=None, help='benchmarked stages (default all)')
+    arg_options.add_argument('--no-memory', action='store_true', help='do not trace the peak memory (tracing slows all stages down)')
+    arg_options.add_argument('--seed', type=int, default=0, help='random seed of the synthetic corpora')
+    arg_run = arg_subparsers.add_parser('run', parents=[arg_options], help='benchmarks all stages once')
+    arg_run.add_argument('output', help='path of the JSON results')
+    arg_run.add_argument('--sentences', type=int, default=2000, help='number of sentence pairs')
+    arg_run.add_argument('--mean-length', type=int, default=10, help='mean sentence length')
+    arg_run.add_argument('--length-spread', type=int, default=3, help='standard deviation of the sentence length')
+    arg_compare = arg_subparsers.add_parser('compare', help='compares two JSON results and flags regressions')
+    arg_compare.add_argument('baseline', help='JSON results of the baseline')
+    arg_compare.add_argument('current', help='JSON results to check')
+    arg_compare.add_argument('--tolerance', type=float, default=0.2, help='relative increase which is flagged as a regression')
+    arg_scale = arg_subparsers.add_parser('scale', parents=[arg_options], help='measures scaling curves over corpus size and sentence length')
+    arg_scale.add_argument('output', help='path of the JSON curves')
+    arg_scale.add_argument('--sizes', type=int, nargs='+', default=[500, 1000, 2000, 4000], help='corpus sizes')
+    arg_scale.add_argument('--lengths', type=int, nargs='+', default=[5, 10, 20, 40], help='mean sentence lengths')
+    args = arg_parser.parse_args()
+
+    if args.command == 'compare' :
+        with open(args.baseline, 'r', encoding='utf8') as fop :
+            baseline = json.load(fop)
+        with open(args.current, 'r', encoding='utf8') as fop :
+            current = json.load(fop)
+        print("baseline : %s | current : %s" % (baseline.get('commit'), current.get('commit')))
+        if baseline['config'] != current['config'] :
+            print("warning : the benchmark configurations differ")
+        regressions = 0
+        for stage, metric, value_baseline, value_current, ratio, regression in compare_results(baseline, current, args.tolerance) :
+            print("%-18s %-8s %12.3f %12.3f %8.2fx %s" % (stage, metric, value_baseline, value_current, ratio, 'REGRESSION' if regression else ''))
+            regressions += regression
+        sys.exit(1 if regressions > 0 else 0)
+    options = {'vocab_size':args.vocab_size, 'iterations':args.iterations, 'order':args.order, 'decode_sentences':args.decode_sentences, 'stages':args.stages, 'memory':not args.no_memory, 'seed':args.seed}
+    if args.command == 'run' :
+        res = run_benchmark(sentences=args.sentences, mean_length=args.mean_length, length_spread=args.length_spread, verbose=True, **options)
+    else :
+        res = run_scaling(args.sizes, args.lengths, verbose=True, **options)
+        print_scaling(res)
+    with open(args.output, 'w', encoding='utf8') as fop :
+        json.dump(res, fop, indent=2)
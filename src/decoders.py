@@ -3,86 +3,223 @@
 '''
 from utils import *
 from math import log, exp
-from sys import stdout
+import os, gc, atexit, multiprocessing
+
+_CHUNK_SIZE = 64 # sentences per worker task
+_shared = {}
+_pools = {} # persistent decoder pools by (decoder, workers) : (pool, arguments the workers were forked with)
 
 #
 # functions
 #
 
-def decode_lexical(corpus, distribution, verbose=False) :
+def _init_worker(shared) :
+    _shared.clear()
+    _shared.update(shared)
+    if shared['arguments'].get('cache') is not None :
+        shared['arguments']['cache'].reset_stats() # the worker reports only its own hits and misses
+
+def _decode_chunk(chunk) :
+    '''
+        returns the translations of a chunk and (process id, statistics of its cache or None)
+    '''
+    res = _shared['decoder'](chunk, **_shared['arguments'])
+    cache = _shared['arguments'].get('cache')
+    return res, (os.getpid(), cache.get_stats() if cache is not None else None)
+
+def _get_pool(decoder, workers, arguments) :
+    '''
+        returns the persistent pool of forked decoder processes of a decoder and number of workers
+
+        the pool is reused by all calls with the same argument objects (i.e. the loaded models, decoder
+        parameters and cache) and replaced when they change. The objects are frozen out of the garbage
+        collector only while the workers are forked, so the workers never touch the inherited pages
+        and nothing stays frozen in this process.
+    '''
+    key = (decoder, workers)
+    entry = _pools.get(key)
+    if entry is not None :
+        pool, pool_arguments = entry
+        if (pool_arguments.keys() == arguments.keys()) and all(pool_arguments[name] is value for name, value in arguments.items()) :
+            return pool
+        pool.terminate()
+        del _pools[key]
+    if 'fork' in multiprocessing.get_all_start_methods() :
+        context = multiprocessing.get_context('fork')
+    else :
+        context = multiprocessing.get_context()
+    gc.freeze()
+    try :
+        res = context.Pool(workers, initializer=_init_worker, initargs=({'decoder':decoder, 'arguments':arguments},))
+    finally :
+        gc.unfreeze()
+    _pools[key] = (res, arguments)
+    return res
+
+@atexit.register
+def close_decoder_pools() :
+    '''
+        terminates the persistent decoder pools, e.g. after the models were unloaded (also called at exit)
+    '''
+    for pool, arguments in _pools.values() :
+        pool.terminate()
+    _pools.clear()
+
+def _iter_decode_parallel(decoder, corpus, workers, verbose=False, monitor=None, **arguments) :
+    '''
+        decodes a corpus in chunks of sentences with a persistent pool of forked worker processes (see _get_pool)
+
+        the pool is forked after the models are loaded, so all workers share the read-only tables
+        copy-on-write instead of receiving pickled copies, and only the sentence chunks and translations
+        are sent between processes. The pool is kept for later calls with the same models, so e.g. a server
+        only pays the fork once. The corpus is read in windows of 2 chunks per worker, so memory does not
+        grow with the corpus size. Every worker fills its own copy of a decoder_cache, which persists with
+        the pool, and its statistics are collected into the cache of the calling process (see decoder_cache.get_stats).
+
+        arguments
+            decoder : decoding function called as decoder(chunk, **arguments) in the workers
+            corpus : foreign corpus (any iterable of token lists)
+            workers : number of processes
+            monitor=None : progress_monitor receiving the progress (stage 'decode')
+        yields [translated tokens] in corpus order
+    '''
+    if monitor is not None : monitor.start('decode', get_corpus_length(corpus), workers=workers)
+    pool = _get_pool(decoder, workers, arguments)
+    sentences = iter(corpus)
+    count_decoded = 0
+    while True :
+        chunks = [ chunk for chunk in (list(islice(sentences, _CHUNK_SIZE)) for index in range(2*workers)) if len(chunk) > 0 ]
+        if len(chunks) < 1 :
+            break
+        for chunk_res, (worker, cache_stats) in pool.imap(_decode_chunk, chunks) :
+            if cache_stats is not None : arguments['cache'].set_worker_stats(worker, cache_stats)
+            for sentence_e in chunk_res :
+                yield sentence_e
+            count_decoded += len(chunk_res)
+            if monitor is not None : monitor.progress('decode', count_decoded)
+    if monitor is not None : monitor.end('decode', count_decoded)
+    if verbose : print(" - decoding complete - ")
+
+def _get_top_k(dist, name, token, k, cache=None) :
+    '''
+        top k options of dist given (token,), memoized in the candidate level of cache
+    '''
+    if cache is None :
+        return dist.top_k((token,), k)
+    key = (name, token, k)
+    res = cache.candidates.get(key)
+    if res is None :
+        res = list(dist.top_k((token,), k))
+        cache.candidates.put(key, res)
+    return res
+
+def _get_lm_scorer(dists_lm, lm_weights, cache=None) :
+    '''
+        lm_scorer of the language model, shared through the lm level of cache
+    '''
+    if cache is None :
+        return lm_scorer(dists_lm, lm_weights)
+    return cache.get_lm_scorer(dists_lm, lm_weights)
+
+def iter_decode_lexical(corpus, distribution, verbose=False, workers=None, cache=None, monitor=None) :
     if verbose : print(" - decoding lexical - ")
-    res = []
+    monitor = get_monitor(monitor, verbose)
+    if workers :
+        yield from _iter_decode_parallel(decode_lexical, corpus, workers, verbose, monitor, distribution=distribution, cache=cache)
+        return
     dist_t = distribution
+    if monitor is not None : monitor.start('decode', get_corpus_length(corpus))
     for index_sen, sentence_f in enumerate(corpus) :
-        if (verbose) and ((index_sen+1)%5 == 0):
-            stdout.write(('\rdecoding : %d of %d sentences'+(' '*10)) % (index_sen+1, len(corpus.sentences)))
-            stdout.flush()
+        if monitor is not None : monitor.progress('decode', index_sen+1)
+        if cache is not None :
+            sentence_key = ('lexical', tuple(sentence_f))
+            sentence_e = cache.sentences.get(sentence_key)
+            if sentence_e is not None :
+                yield list(sentence_e)
+                continue
         sentence_e = []
         # lexical translation step
         for index_f, token_f in enumerate(sentence_f) :
-            sorted_options = dist_t.get_options_sorted((token_f,))
+            sorted_options = _get_top_k(dist_t, 't', token_f, 1, cache)
             if len(sorted_options) > 0 :
                 sentence_e.append(sorted_options[0][0])
             else :
                 sentence_e.append(token_f)
-        res.append(sentence_e)
-    if verbose : print("\n - decoding complete - ")
-    return res
+        if cache is not None : cache.sentences.put(sentence_key, tuple(sentence_e))
+        yield sentence_e
+    if monitor is not None : monitor.end('decode')
+    if verbose : print(" - decoding complete - ")
 
-def decode_lexical_lm(corpus, dist_t, dists_lm, lm_weights, verbose=False) :
+def decode_lexical(corpus, distribution, verbose=False, workers=None, cache=None, monitor=None) :
+    '''
+        returns the list of all translations of iter_decode_lexical
+    '''
+    return list(iter_decode_lexical(corpus, distribution, verbose, workers, cache, monitor))
+
+def iter_decode_lexical_lm(corpus, dist_t, dists_lm, lm_weights, verbose=False, workers=None, cache=None, monitor=None) :
     if verbose : print(" - decoding lexical (with language model) - ")
-    res = []
-    n_length = len(dists_lm.keys())
+    monitor = get_monitor(monitor, verbose)
+    if workers :
+        yield from _iter_decode_parallel(decode_lexical_lm, corpus, workers, verbose, monitor, dist_t=dist_t, dists_lm=dists_lm, lm_weights=lm_weights, cache=cache)
+        return
+    scorer = _get_lm_scorer(dists_lm, lm_weights, cache)
+    if monitor is not None : monitor.start('decode', get_corpus_length(corpus))
     for index_sen, sentence_f in enumerate(corpus) :
-        if (verbose) and ((index_sen+1)%5 == 0):
-            stdout.write(('\rdecoding : %d of %d sentences'+(' '*10)) % (index_sen+1, len(corpus)))
-            stdout.flush()
-        sentence_f = ["<s>"] + sentence_f + ["<\s>"] # add start and end tags
+        if monitor is not None : monitor.progress('decode', index_sen+1)
+        if cache is not None :
+            sentence_key = ('lexical_lm', tuple(sentence_f))
+            sentence_e = cache.sentences.get(sentence_key)
+            if sentence_e is not None :
+                yield list(sentence_e)
+                continue
         sentence_e = []
-        for index_f in range(len(sentence_f)) :
-            ngram_options = sentence_e[max(index_f-n_length+1,0):index_f] # get the n-1 previous tokens
-            ngram_options.append(dist_t.get_options_sorted((sentence_f[index_f],))[:10]) # add top 10 hyps as n-th token
-            max_option = sentence_f[index_f] # initialize as foreign token
+        state = scorer.start
+        for token_f in sentence_f :
+            max_option = token_f # foreign token if there is no lexical translation
+            max_state = None
             max_prob = None
-            if len(ngram_options[-1]) > 0 :
-                max_option = ngram_options[-1][0][0] # top lexical translation if it exists
-            for token_n in ngram_options[-1] : # iterate over all hyps
-                ngram_prob = 0.
-                for n in range(1,len(ngram_options)+1) :
-                    cur_ngram = (token_n[0],)
-                    if n > 1 :
-                        cur_ngram += tuple(ngram_options[-n:-1])
-                    # cur_prob = dists_lm[n].get_probability(cur_ngram)
-                    # if cur_prob is None :
-                    #     cur_prob = 1/len(dists_lm[n].lookup.items())
-                    if cur_ngram in dists_lm[n] :
-                        cur_prob = dists_lm[n][cur_ngram] # get ngram-probability if it exists
-                    else :
-                        cur_prob = 1/len(dists_lm[n].keys()) # 1/count_unique(n) else
-                    ngram_prob += cur_prob * lm_weights[n] # apply weights
-                ngram_prob += token_n[1] # add to lexical probability
-                if (max_prob is None) or (ngram_prob > max_prob) :
-                    max_prob = ngram_prob
-                    max_option = token_n[0]
+            for token_e, lex_prob in _get_top_k(dist_t, 't', token_f, 10, cache) : # top 10 hyps
+                lm_prob, new_state = scorer.score(state, token_e)
+                if (max_prob is None) or (lex_prob + lm_prob > max_prob) :
+                    max_prob = lex_prob + lm_prob
+                    max_option, max_state = token_e, new_state
+            if max_state is None :
+                max_state = scorer.score(state, max_option)[1]
             sentence_e.append(max_option) # append maximum option
-        sentence_e = sentence_e[1:-1] # remove start and end tags
-        res.append(sentence_e)
-    if verbose : print("\n - decoding complete - ")
-    return res
+            state = max_state
+        if cache is not None : cache.sentences.put(sentence_key, tuple(sentence_e))
+        yield sentence_e
+    if monitor is not None : monitor.end('decode')
+    if verbose : print(" - decoding complete - ")
 
-def decode_model3_lm(corpus, dist_t, dist_d, dist_f, prob_p0, dists_lm, lm_weights, verbose=False) :
-    print(" - decoding with model 3 distributions (+ language model) - ")
-    res = []
+def decode_lexical_lm(corpus, dist_t, dists_lm, lm_weights, verbose=False, workers=None, cache=None, monitor=None) :
+    '''
+        returns the list of all translations of iter_decode_lexical_lm
+    '''
+    return list(iter_decode_lexical_lm(corpus, dist_t, dists_lm, lm_weights, verbose, workers, cache, monitor))
+
+def iter_decode_model3_lm(corpus, dist_t, dist_d, dist_f, prob_p0, dists_lm, lm_weights, verbose=False, workers=None, cache=None, monitor=None) :
+    if verbose : print(" - decoding with model 3 distributions (+ language model) - ")
+    monitor = get_monitor(monitor, verbose)
+    if workers :
+        yield from _iter_decode_parallel(decode_model3_lm, corpus, workers, verbose, monitor, dist_t=dist_t, dist_d=dist_d, dist_f=dist_f, prob_p0=prob_p0, dists_lm=dists_lm, lm_weights=lm_weights, cache=cache)
+        return
+    scorer = _get_lm_scorer(dists_lm, lm_weights, cache)
+    if monitor is not None : monitor.start('decode', get_corpus_length(corpus))
     for index_sen, sentence_f in enumerate(corpus) :
-        if (verbose) :
-            stdout.write(('\rdecoding : %d of %d sentences'+(' '*10)) % (index_sen+1, len(corpus)))
-            stdout.flush()
+        if monitor is not None : monitor.progress('decode', index_sen+1)
+        if cache is not None :
+            sentence_key = ('model3_lm', tuple(sentence_f))
+            sentence_e = cache.sentences.get(sentence_key)
+            if sentence_e is not None :
+                yield list(sentence_e)
+                continue
         sentence_e = []
         sentence_hyp = [] # initialize empty hypothesis
         # fertility and lexical translation step
         for index_f, token_f in enumerate(sentence_f) :
-            fert_options = dist_f.get_options_sorted((token_f,))[:1] # get top fertility option
-            lex_options = dist_t.get_options_sorted((token_f,))[:5] # get top 5 lexical translation options
+            fert_options = _get_top_k(dist_f, 'f', token_f, 1, cache) # get top fertility option
+            lex_options = _get_top_k(dist_t, 't', token_f, 5, cache) # get top 5 lexical translation options
             if len(fert_options) < 1 :
                 fert_options = [(1,0.)]
             if len(lex_options) < 1 :
@@ -90,111 +227,194 @@ def decode_model3_lm(corpus, dist_t, dist_d, dist_f, prob_p0, dists_lm, lm_weigh
             if fert_options[0][0] == 0 :
                 sentence_hyp.append([('',0.)])
             else :
+                if any(lex_option[0] != '' for lex_option in lex_options) :
+                    lex_options = [lex_option for lex_option in lex_options if lex_option[0] != ''] # the fertility step decides on dropped tokens
                 if (token_f not in ['.', '!', '?', ',', "'", '-']) and (len(lex_options) > 1) :
                     lex_options = [lex_option for lex_option in lex_options if lex_option[0] not in ['.', '!', '?', ',', "'", '-']]
                 sentence_hyp += [lex_options for i in range(fert_options[0][0])]
         # distortion step
+        sentence_dist = [None] * len(sentence_hyp) # one slot per hypothesis token
+        length_f = len(sentence_f)+1
+        length_hyp = len(sentence_hyp)+1
         for index_hyp in range(1, len(sentence_hyp)+1) :
             token_hyp = sentence_hyp[index_hyp-1]
-            length_f = len(sentence_f)+1
-            length_hyp = len(sentence_hyp)+1
-            sentence_dist = [token_hyp for token_hyp in sentence_hyp]
-            align_options = dist_d.get_options_sorted((index_hyp, length_hyp, length_f))[:1] # best option
+            align_index = index_hyp-1 # tokens without a distortion option keep their position
+            align_options = dist_d.top_k((index_hyp, length_hyp, length_f), 1) # best option
             if len(align_options) > 0 :
-                align_index = align_options[0][0]-1
-                sentence_dist[align_options[0][0]-1] = token_hyp
+                align_index = min(max(align_options[0][0]-1, 0), len(sentence_dist)-1)
+            # a taken position moves the token to the nearest free one, so every placement is kept
+            free_indices = [ index for index, slot in enumerate(sentence_dist) if slot is None ]
+            align_index = min(free_indices, key=lambda index: (abs(index - align_index), index))
+            sentence_dist[align_index] = token_hyp
         sentence_hyp = sentence_dist
         # apply language model
-        n_length = len(dists_lm.keys())
-        sentence_lm = [[('<s>',0.)]] + sentence_hyp + [[('</s>',0.)]] # add start and end tags
-        for index_hyp, token_hyp in enumerate(sentence_lm) :
+        state = scorer.start
+        for token_hyp in sentence_hyp :
             max_hyp = token_hyp[0]
+            max_state = state
             max_prob = None
             for hyp in token_hyp : # iterate over all hyps
-                hyp_prob = 0.
-                for n in range(1,min(n_length, index_hyp+1)+1) :
-                    cur_ngram = (hyp[0],)
-                    if n > 1 :
-                        cur_ngram += tuple(sentence_e[-n:-1])
-                    if cur_ngram in dists_lm[n] :
-                        hyp_prob = exp(dists_lm[n][cur_ngram]) * lm_weights[n] # get ngram-probability if it exists
-                    else :
-                        hyp_prob = 1/len(dists_lm[n].keys()) * lm_weights[n] # 1/count_unique(n) else
-                hyp_prob += exp(hyp[1]) # add to lexical probability
+                if hyp[0] == '' :
+                    hyp_prob, new_state = hyp[1], state # dropped tokens do not extend the history
+                else :
+                    hyp_prob, new_state = scorer.score(state, hyp[0])
+                    hyp_prob += hyp[1] # add to lexical probability
                 if (max_prob is None) or (hyp_prob > max_prob) :
                     max_prob = hyp_prob
-                    max_hyp = hyp
+                    max_hyp, max_state = hyp, new_state
             if max_hyp[0] != '' :
                 sentence_e.append(max_hyp[0]) # append maximum option
-        sentence_e = sentence_e[1:len(sentence_e)-1] # remove start and end tags
-        res.append(sentence_e)
-    if verbose : print("\n - decoding complete - ")
-    return res
+            state = max_state
+        if cache is not None : cache.sentences.put(sentence_key, tuple(sentence_e))
+        yield sentence_e
+    if monitor is not None : monitor.end('decode')
+    if verbose : print(" - decoding complete - ")
+
+def decode_model3_lm(corpus, dist_t, dist_d, dist_f, prob_p0, dists_lm, lm_weights, verbose=False, workers=None, cache=None, monitor=None) :
+    '''
+        returns the list of all translations of iter_decode_model3_lm
+    '''
+    return list(iter_decode_model3_lm(corpus, dist_t, dist_d, dist_f, prob_p0, dists_lm, lm_weights, verbose, workers, cache, monitor))
 
-def decode_brute(corpus, dist_t, dist_d, dist_f, prob_p0, dists_lm, lm_weights, verbose=False) :
-    if verbose : print(" - decoding as brute with model 3 distributions (+ language model) - ")
+
+def _get_translation_options(token_f, dist_t, dist_f, fert_count, lex_count, cache=None) :
+    '''
+        fertility and lexical options of a foreign token as [(translated tokens, log prob)]
+    '''
+    if cache is not None :
+        key = ('options', token_f, fert_count, lex_count)
+        res = cache.candidates.get(key)
+        if res is None :
+            res = _get_translation_options(token_f, dist_t, dist_f, fert_count, lex_count)
+            cache.candidates.put(key, res)
+        return res
+    fert_options = dist_f.top_k((token_f,), fert_count)
+    lex_options = dist_t.top_k((token_f,), lex_count)
+    if len(fert_options) < 1 :
+        fert_options = [(1,0.)]
+    if len(lex_options) < 1 :
+        lex_options = [(token_f,0.)]
     res = []
+    for fert_option in fert_options :
+        if fert_option[0] == 0 :
+            res.append(((), fert_option[1]))
+            continue
+        for lex_option in lex_options :
+            res.append(((lex_option[0],) * fert_option[0], fert_option[1] + lex_option[1] * fert_option[0]))
+    return res
+
+def iter_decode_beam(corpus, dist_t, dist_d, dist_f, prob_p0, dists_lm, lm_weights, beam_width=16, threshold=10., distortion_limit=4, fert_count=3, lex_count=5, log_unseen_d=-10., verbose=False, workers=None, cache=None, monitor=None) :
+    '''
+        Stack decoder over the Model 3 distributions and the n-gram language model
+
+        Hypotheses are kept in one stack per number of covered foreign tokens and are expanded by translating
+        one more foreign token (with one of its fertility and lexical options) within the distortion limit.
+        Hypotheses with the same coverage, output length and language model state are recombined and every
+        stack is pruned to beam_width hypotheses and to those within threshold of the best score, both ranked
+        by score plus the future cost estimate of the uncovered tokens. Decoding time therefore grows linearly
+        with the sentence length instead of exponentially.
+
+        arguments
+            corpus : foreign corpus
+            dist_t, dist_d, dist_f : Model 3 distributions (log space)
+            prob_p0 : null insertion probability (unused, no null tokens are generated)
+            dists_lm : ngram_model or {n : {(w_n, w_1, ..., w_n-1) : log prob}}
+            lm_weights : {n : weight}
+            beam_width=16 : maximum number of hypotheses per stack
+            threshold=10. : maximum log score distance to the best hypothesis of a stack (None to disable)
+            distortion_limit=4 : maximum distance of a translated token to the first uncovered token
+            fert_count=3, lex_count=5 : number of fertility and lexical options per foreign token
+            log_unseen_d=-10. : log probability of distortions which are not in dist_d
+            workers=None : number of processes decoding chunks of sentences in parallel
+            cache=None : decoder_cache memoizing translations, candidates and language model scores
+            monitor=None : progress_monitor receiving the progress (stage 'decode'), console if verbose
+        yields [translated tokens] per sentence while reading the corpus
+    '''
+    if verbose : print(" - decoding with beam search over model 3 distributions (+ language model) - ")
+    monitor = get_monitor(monitor, verbose)
+    if workers :
+        yield from _iter_decode_parallel(decode_beam, corpus, workers, verbose, monitor, dist_t=dist_t, dist_d=dist_d, dist_f=dist_f, prob_p0=prob_p0, dists_lm=dists_lm, lm_weights=lm_weights,
+            beam_width=beam_width, threshold=threshold, distortion_limit=distortion_limit, fert_count=fert_count, lex_count=lex_count, log_unseen_d=log_unseen_d, cache=cache)
+        return
+    scorer = _get_lm_scorer(dists_lm, lm_weights, cache)
+    if monitor is not None : monitor.start('decode', get_corpus_length(corpus))
     for index_sen, sentence_f in enumerate(corpus) :
-        if (verbose) and ((index_sen+1)%5 == 0):
-            stdout.write(('\rdecoding : %d of %d sentences'+(' '*10)) % (index_sen+1, len(corpus)))
-            stdout.flush()
+        if monitor is not None : monitor.progress('decode', index_sen+1)
+        if cache is not None :
+            sentence_key = ('beam', beam_width, threshold, distortion_limit, fert_count, lex_count, log_unseen_d, tuple(sentence_f))
+            sentence_e = cache.sentences.get(sentence_key)
+            if sentence_e is not None :
+                yield list(sentence_e)
+                continue
+        length_f = len(sentence_f)
+        options = [ _get_translation_options(token_f, dist_t, dist_f, fert_count, lex_count, cache) for token_f in sentence_f ]
+        # future cost of a foreign token is its best option without distortion and language model
+        future_costs = [ max(option[1] for option in token_options) for token_options in options ]
+        # estimated target length (with null) from the most probable options
+        length_e = 1 + sum(len(max(token_options, key=lambda option: option[1])[0]) for token_options in options)
+        distortions = [ dist_d.get_options((index_f+1, length_e, length_f+1)) for index_f in range(length_f) ]
+        # hypothesis : (score, future cost, coverage, lm state, output length, previous hypothesis, tokens)
+        start_hyp = (0., sum(future_costs), 0, scorer.start, 0, None, ())
+        stacks = [{} for index_stack in range(length_f+1)]
+        stacks[0][(0, scorer.start, 0)] = start_hyp
+        for index_stack in range(length_f) :
+            stack = list(stacks[index_stack].values())
+            if len(stack) < 1 :
+                continue
+            # histogram and threshold pruning on score plus future cost
+            stack.sort(key=lambda hyp: hyp[0] + hyp[1], reverse=True)
+            stack = stack[:beam_width]
+            if threshold is not None :
+                best_score = stack[0][0] + stack[0][1]
+                stack = [hyp for hyp in stack if hyp[0] + hyp[1] >= best_score - threshold]
+            for hyp in stack :
+                score, future_cost, coverage, state, length_hyp = hyp[:5]
+                first_uncovered = 0
+                while coverage & (1 << first_uncovered) :
+                    first_uncovered += 1
+                for index_f in range(first_uncovered, min(first_uncovered + distortion_limit, length_f)) :
+                    if coverage & (1 << index_f) :
+                        continue
+                    for tokens, option_prob in options[index_f] :
+                        new_score = score + option_prob
+                        new_state = state
+                        for index_token, token in enumerate(tokens) :
+                            new_score += distortions[index_f].get(length_hyp+index_token+1, log_unseen_d)
+                            lm_prob, new_state = scorer.score(new_state, token)
+                            new_score += lm_prob
+                        new_coverage = coverage | (1 << index_f)
+                        new_length = length_hyp + len(tokens)
+                        recombination_key = (new_coverage, new_state, new_length)
+                        next_stack = stacks[index_stack+1]
+                        if (recombination_key not in next_stack) or (next_stack[recombination_key][0] < new_score) :
+                            next_stack[recombination_key] = (new_score, future_cost - future_costs[index_f], new_coverage, new_state, new_length, hyp, tokens)
+            stacks[index_stack] = None
+        # close the best complete hypothesis with the end tag
+        max_hyp = None
+        max_score = None
+        for hyp in stacks[length_f].values() :
+            hyp_score = hyp[0] + scorer.score(hyp[3], '</s>')[0]
+            if (max_score is None) or (hyp_score > max_score) :
+                max_hyp, max_score = hyp, hyp_score
         sentence_e = []
-        sentence_hyps = [([],0.)] # initialize empty hypothesis
-        for index_f, token_f in enumerate(sentence_f) :
-            # fertility and lexical translation step
-            fert_options = dist_f.get_options_sorted((token_f,))[:3] # get top 3 fertility options
-            lex_options = dist_t.get_options_sorted((token_f,))[:5] # get top 5 lexical translation options
-            if len(fert_options) < 1 :
-                fert_options = [(1,0.)]
-            if len(lex_options) < 1 :
-                lex_options = [(token_f,0.)]
-            updated_sentence_hyps = []
-            for sentence_hyp in sentence_hyps :
-                for fert_option in fert_options :
-                    for lex_option in lex_options :
-                        updated_sentence = sentence_hyp[0] + [lex_option[0] for i in range(fert_option[0])] # append translated token with fertility frequency
-                        updated_prob = sentence_hyp[1] + fert_option[1] + lex_option[1] # log probability
-                        updated_sentence_hyps.append((updated_sentence, updated_prob))
-            sentence_hyps = updated_sentence_hyps
-        # distortion step
-        updated_sentence_hyps = []
-        for sentence_hyp in sentence_hyps :
-            length_f = len(sentence_f)
-            length_hyp = len(sentence_hyp[0])
-            distorted_sentence_hyps = [sentence_hyp]
-            for index_hyp, token_hyp in enumerate(sentence_hyp[0]) :
-                align_options = dist_d.get_options_sorted((index_hyp, length_hyp, length_f)) # best option
-                updated_distorted_sentence_hyps = []
-                for distorted_sentence_hyp in distorted_sentence_hyps :
-                    for align_option in align_options :
-                        distorted_sentence = distorted_sentence_hyp[0]
-                        distorted_sentence[align_option[0]] = token_hyp
-                        distorted_prob = distorted_sentence_hyp[1] + align_option[1]
-                        updated_distorted_sentence_hyps.append((distorted_sentence, distorted_prob))
-                distorted_sentence_hyps = updated_distorted_sentence_hyps
-            updated_sentence_hyps.append(distorted_sentence_hyp)
-        sentence_hyps = updated_sentence_hyps
-        # apply language model
-        n_length = len(dists_lm.keys())
-        max_index = None
-        for index_hyp in range(len(sentence_hyps)) :
-            sentence_lm = ['<s>'] + sentence_hyps[index_hyp][0] + ['</s>'] # add start and end tags
-            sentence_prob = sentence_hyps[index_hyp][1]
-            # for index_hyp, token_hyp in enumerate(sentence_lm) :
-            #     for n in range(1, min(n_length, index_hyp+1)) :
-            #         cur_ngram = (token_hyp,)
-            #         if n > 1:
-            #             cur_ngram += tuple(sentence_lm[-n:index_hyp])
-            #         if cur_ngram in dists_lm[n] :
-            #             sentence_prob += dists_lm[n][cur_ngram] * lm_weights[n] # get ngram-probability if it exists
-            #         else :
-            #             sentence_prob += log(1/len(dists_lm[n].keys())) * lm_weights[n] # 1/count_unique(n) else
-            sentence_hyps[index_hyp] = (sentence_hyps[index_hyp][0], sentence_prob)
-            if (max_index is None) or (sentence_prob > sentence_hyps[max_index][1]) :
-                max_index = index_hyp
-        sentence_e = sentence_hyps[max_index][0]
-        print(sentence_f)
-        print(sentence_e)
-        res.append(sentence_e)
-    if verbose : print("\n - decoding complete - ")
-    return res
+        while max_hyp is not None :
+            sentence_e = list(max_hyp[6]) + sentence_e
+            max_hyp = max_hyp[5]
+        if cache is not None : cache.sentences.put(sentence_key, tuple(sentence_e))
+        yield sentence_e
+    if monitor is not None : monitor.end('decode')
+    if verbose : print(" - decoding complete - ")
+
+def decode_beam(corpus, dist_t, dist_d, dist_f, prob_p0, dists_lm, lm_weights, beam_width=16, threshold=10., distortion_limit=4, fert_count=3, lex_count=5, log_unseen_d=-10., verbose=False, workers=None, cache=None, monitor=None) :
+    '''
+        returns the list of all translations of iter_decode_beam
+    '''
+    return list(iter_decode_beam(corpus, dist_t, dist_d, dist_f, prob_p0, dists_lm, lm_weights, beam_width, threshold, distortion_limit, fert_count, lex_count, log_unseen_d, verbose, workers, cache, monitor))
+
+def decode_brute(corpus, dist_t, dist_d, dist_f, prob_p0, dists_lm, lm_weights, verbose=False, workers=None, cache=None, monitor=None) :
+    '''
+        formerly enumerated all fertility, lexical and distortion options, now a wide beam search
+
+        returns [[translated tokens]]
+    '''
+    return decode_beam(corpus, dist_t, dist_d, dist_f, prob_p0, dists_lm, lm_weights, beam_width=256, threshold=None, verbose=verbose, workers=workers, cache=cache, monitor=monitor)
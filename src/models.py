@@ -4,113 +4,839 @@
 from utils import *
 from math import log, exp
 from collections import defaultdict
-from sys import stdout
+from array import array
+from itertools import groupby
+import os, heapq, pickle, atexit, shutil, hashlib, tempfile, multiprocessing
+from functools import partial
+try :
+    import numpy as np
+except ImportError :
+    np = None # the numpy backends are optional
+
+_SHARD_SIZE = 2000 # sentences (pairs) per worker shard (independent of the number of workers)
+_shared = {} # read-only tables of the E-step worker processes
+_pools = {} # E-step process pools by number of workers, reused by all iterations and stages
 
 #
 # functions
 #
 
-def train_model1(corpus, iterations, verbose=False) :
+def train_model1(corpus, iterations, verbose=False, backend='python', workers=None, checkpoint=None, monitor=None, compact=True, train_cache=None, init_t=None, init_weight=0., tolerance=None) :
     '''
         EM training function according to IBM Model 1
+        arguments
+            backend='python' : 'python' or 'numpy' (sparse, vectorized E-step)
+            workers=None : number of processes computing the E-step on corpus shards (python backend)
+            checkpoint=None : path prefix of a checkpoint which is written after every iteration and resumed from
+                              (only if it was written for the same corpus content and parameters, see _get_stamp)
+            monitor=None : progress_monitor receiving the progress and metrics (stage 'model1'), console if verbose
+            compact=True : returns t as compact_table (float32 values), else as dict
+            train_cache=None : training_cache the result is loaded from or stored in (stage 'model1')
+            init_t=None : t = {(e,f) : prob} of earlier training to warm start from (python backend, see _estimate),
+                          unseen pairs start uniformly and contexts f which do not occur in corpus are kept
+            init_weight=0. : number of pseudo-counts per f of init_t in the M-step (0 : re-estimate from corpus only)
+            tolerance=None : stops before iterations when the relative improvement of the corpus log-likelihood
+                             falls below tolerance (see _converged), None always runs all iterations
 
         returns the translation probability t = {(e,f) : prob}
     '''
+    if (init_t is not None) and (backend == 'numpy') :
+        raise ValueError('warm starts (init_t) require the python backend')
+    params = {'iterations':iterations, 'tolerance':tolerance, 'backend':backend, 'init':_get_tables_fingerprint(init_t), 'init_weight':init_weight}
+    t = _load_cached(train_cache, 'model1', corpus, params, verbose)
+    if t is None :
+        if backend == 'numpy' :
+            t = _train_model1_numpy(corpus, iterations, verbose=verbose, monitor=monitor, tolerance=tolerance)
+        else :
+            stamp = _get_stamp(corpus, 'model1', params, train_cache) if checkpoint else None
+            t = _train_model1_python(corpus, iterations, verbose, workers, checkpoint, monitor, init_t, init_weight, tolerance, stamp)
+        _save_cached(train_cache, 'model1', corpus, params, t)
+    return compact_table(t) if compact else t
+
+def _train_model1_python(corpus, iterations, verbose=False, workers=None, checkpoint=None, monitor=None, init_t=None, init_weight=0., tolerance=None, stamp=None) :
+    '''
+        IBM Model 1 with t stored as dict (see train_model1)
+    '''
     if verbose : print(" - training IBM Model 1 - ")
+    monitor = get_monitor(monitor, verbose)
     # initialize t uniformly
-    t = defaultdict(lambda: 1./corpus.count_unique_f())
+    t = defaultdict(partial(float, 1./corpus.count_unique_f()))
+    if init_t is not None : t.update(init_t)
+    state = _load_state(checkpoint, 'model1', corpus, iterations, stamp, verbose)
+    if state : t.update(state['t'])
+    first_iteration, log_likelihood, converged = _get_resume_point(state, iterations)
+    if monitor is not None : monitor.start('model1', get_corpus_length(corpus), iterations)
+    # training loop
+    for i in range(first_iteration, iterations) :
+        previous_log_likelihood = log_likelihood
+        # sharded E-step (in this process without workers)
+        uniform = 1./corpus.count_unique_f()
+        shared = {'t' : t, 'uniform' : uniform, 'corpus' : corpus.get_reader_args()}
+        count, total, metrics = _reduce_counts(_map_shards(_estep_model1, shared, corpus, workers, monitor, 'model1', i+1))
+        log_likelihood = metrics['log_likelihood']
+        for pair in count :
+            if pair not in t : t[pair] = uniform # unseen pairs start uniformly
+        # probability estimation
+        if init_t is None :
+            for token_e, token_f in corpus.get_token_pairs() :
+                t[(token_e,token_f)] = count[(token_e,token_f)] / total[token_f]
+        else :
+            estimate = _estimate(count, total, lambda pair: pair[1], init_t, init_weight)
+            t.clear()
+            t.update(estimate)
+        corpus.reset_iter()
+        converged = _converged(log_likelihood, previous_log_likelihood, tolerance)
+        _save_state(checkpoint, 'model1', corpus, i+1, {'t' : dict(t), 'log_likelihood' : log_likelihood, 'converged' : converged}, stamp)
+        if monitor is not None : monitor.iteration('model1', i+1, len(corpus), tables={'t':len(t)}, log_likelihood=log_likelihood)
+        if converged :
+            break
+    _report_convergence('model1', converged, tolerance, verbose)
+    if monitor is not None : monitor.end('model1', tables={'t':len(t)}, log_likelihood=log_likelihood, converged=converged)
+    if verbose : print(" - training of IBM Model 1 complete - ")
+    return dict(t)
+
+def _estimate(count, total, context, init=None, init_weight=0., log_space=False) :
+    '''
+        M-step p(key) = count(key) / total(context(key)) of all counted keys (in log space, zero probabilities are dropped)
+
+        for a warm start, the options of the initial table init are merged in : contexts which do not occur in the
+        counts keep their initial options and with init_weight > 0 the initial table (normalized per context) is a prior
+        of init_weight pseudo-counts per context, i.e. p(key) = (count(key) + init_weight * init(key)) / (total + init_weight)
+
+        returns {key : prob}
+    '''
+    res = {}
+    mass = {} # prior mass per context, the initial table may be pruned so its options are normalized per context
+    if (init is not None) and (init_weight > 0) :
+        for key, prob in init.items() :
+            given = context(key)
+            if given in total :
+                mass[given] = mass.get(given, 0.) + (exp(prob) if log_space else prob)
+    for key, value in count.items() :
+        given = context(key)
+        cur_prob = value / (total[given] + init_weight) if mass.get(given, 0.) > 0 else value / total[given]
+        if not log_space :
+            res[key] = cur_prob
+        elif cur_prob > 0 :
+            res[key] = log(cur_prob) # log probability
+    if init is not None :
+        for key, prob in init.items() :
+            given = context(key)
+            if given not in total :
+                res[key] = prob # contexts without new data keep their initial options
+            elif mass.get(given, 0.) > 0 :
+                cur_prob = (count.get(key, 0.) + init_weight * (exp(prob) if log_space else prob) / mass[given]) / (total[given] + init_weight)
+                res[key] = log(cur_prob) if log_space else cur_prob
+    return res
+
+def _load_cached(train_cache, stage, corpus, params, verbose=False) :
+    '''
+        returns the result of a training stage stored in train_cache for the corpus content, else None
+    '''
+    if train_cache is None :
+        return None
+    res = train_cache.get(stage, train_cache.get_fingerprint(corpus.path), params)
+    if (res is not None) and verbose : print("loaded %s from the training cache..." % stage)
+    return res
+
+def _save_cached(train_cache, stage, corpus, params, value) :
+    if train_cache is not None :
+        train_cache.put(stage, train_cache.get_fingerprint(corpus.path), params, value)
+
+def _get_tables_fingerprint(*tables) :
+    '''
+        returns the sha256 of the entries of initial tables (None tables are skipped) or None if no table is given
+    '''
+    if all(table is None for table in tables) :
+        return None
+    sha = hashlib.sha256()
+    for table in tables :
+        sha.update(b'\n')
+        if table is not None :
+            for key, value in table.items() :
+                sha.update(repr((key, value)).encode('utf8'))
+    return sha.hexdigest()
+
+def _get_stamp(corpus, stage, params, train_cache=None) :
+    '''
+        returns the stamp of the checkpoints of a training stage, i.e. its key in the training cache :
+        the content fingerprint of the corpus, the stage and the parameters (including the backend and
+        the fingerprint of the initial tables), so that a checkpoint is never resumed for another corpus
+        content or other parameters and a resumed result belongs to the cache key it is stored under
+    '''
+    fingerprint = train_cache.get_fingerprint(corpus.path) if train_cache is not None else get_file_fingerprint(corpus.path)
+    return {'fingerprint':fingerprint, 'stage':stage, 'params':params}
+
+def _load_state(checkpoint, stage, corpus, iterations, stamp=None, verbose=False) :
+    '''
+        returns the checkpointed state of a training stage if it can be resumed (same stamp), else None
+    '''
+    if not checkpoint :
+        return None
+    state = load_checkpoint(checkpoint + '.' + stage + '.ckpt', corpus.path, stamp)
+    if (state is None) or (state['iteration'] > iterations) :
+        return None
+    if verbose : print("resuming %s from checkpoint after iteration %d of %d..." % (stage, state['iteration'], iterations))
+    return state
+
+def _save_state(checkpoint, stage, corpus, iteration, state, stamp=None) :
+    if checkpoint :
+        state['iteration'] = iteration
+        save_checkpoint(checkpoint + '.' + stage + '.ckpt', corpus.path, state, stamp)
+
+def remove_checkpoints(checkpoint, stages=('model1', 'model2', 'model3')) :
+    '''
+        removes the checkpoints of the given stages written with the path prefix checkpoint, e.g. once training finished
+
+        returns the number of removed checkpoints
+    '''
+    return sum(remove_checkpoint(checkpoint + '.' + stage + '.ckpt') for stage in stages)
+
+def _get_resume_point(state, iterations) :
+    '''
+        returns (first iteration, log-likelihood, converged) of a checkpointed state, converged stages are not continued
+    '''
+    if not state :
+        return 0, None, False
+    converged = state.get('converged', False)
+    return (iterations if converged else state['iteration']), state.get('log_likelihood'), converged
+
+def _converged(log_likelihood, previous, tolerance) :
+    '''
+        returns True if the corpus log-likelihood improved by less than tolerance (relative to the previous iteration)
+    '''
+    if (tolerance is None) or (previous is None) :
+        return False
+    return log_likelihood - previous <= tolerance * abs(previous)
+
+def _report_convergence(stage, converged, tolerance, verbose=False) :
+    if verbose and (tolerance is not None) and not converged :
+        print("warning : %s has not converged within the maximum number of iterations (tolerance %g)" % (stage, tolerance))
+
+def _estep_model1_pair(sentence_e, sentence_f, t, uniform, count, total, stotal) :
+    '''
+        IBM Model 1 E-step of a single sentence pair (including null tokens), unseen pairs are uniform
+
+        returns the log-likelihood of the pair
+    '''
+    res = 0.
+    # compute normalization
+    for token_e in sentence_e :
+        stotal[token_e] = 0
+        for token_f in sentence_f :
+            stotal[token_e] += t.get((token_e,token_f), uniform)
+        res += log(stotal[token_e] / len(sentence_f))
+    # collect counts
+    for token_e in sentence_e :
+        for token_f in sentence_f :
+            update_c = t.get((token_e,token_f), uniform) / stotal[token_e]
+            count[(token_e,token_f)] += update_c
+            total[token_f] += update_c
+    return res
+
+def _estep_model1(shard) :
+    '''
+        IBM Model 1 E-step over a corpus shard, returns the partial (count, total, {'log_likelihood'})
+    '''
+    count = defaultdict(lambda:0.)
+    total = defaultdict(lambda:0.)
+    stotal = {}
+    log_likelihood = 0.
+    for pair in corpus_parallel(*_shared['corpus']).iter_range(*shard) :
+        log_likelihood += _estep_model1_pair([""] + pair[1], [""] + pair[0], _shared['t'], _shared['uniform'], count, total, stotal)
+    return dict(count), dict(total), {'log_likelihood':log_likelihood}
+
+def _estep_model2_pair(sentence_e, sentence_f, t, a, count_t, total_t, count_a, stotal) :
+    '''
+        IBM Model 2 E-step of a single sentence pair (including null tokens)
+
+        returns the log-likelihood of the pair
+    '''
+    length_f = len(sentence_f)
+    length_e = len(sentence_e)
+    bucket = a.get_bucket(length_e, length_f, 1./(length_f+1))
+    bucket_count = count_a.get((length_e, length_f))
+    if bucket_count is None :
+        bucket_count = array('d', [0.]) * (length_e * length_f)
+        count_a[(length_e, length_f)] = bucket_count
+    res = 0.
+    # compute normalization
+    for index_e, token_e in enumerate(sentence_e) :
+        stotal[token_e] = 0
+        row = index_e * length_f
+        for index_f, token_f in enumerate(sentence_f) :
+            stotal[token_e] += t[(token_e,token_f)] * bucket[row+index_f]
+        res += log(stotal[token_e])
+    # collect counts
+    for index_e, token_e in enumerate(sentence_e) :
+        row = index_e * length_f
+        for index_f, token_f in enumerate(sentence_f) :
+            update_c = t[(token_e,token_f)] * bucket[row+index_f] / stotal[token_e]
+            count_t[(token_e,token_f)] += update_c
+            total_t[token_f] += update_c
+            bucket_count[row+index_f] += update_c
+    return res
+
+def _estep_model2(shard) :
+    '''
+        IBM Model 2 E-step over a corpus shard, returns the partial (count_t, total_t, count_a, {'log_likelihood'})
+    '''
+    t = _shared['t']
+    a = _shared['a']
+    count_t = defaultdict(lambda:0.)
+    total_t = defaultdict(lambda:0.)
+    count_a = {}
+    stotal = {}
+    log_likelihood = 0.
+    for pair in corpus_parallel(*_shared['corpus']).iter_range(*shard) :
+        log_likelihood += _estep_model2_pair([""] + pair[1], [""] + pair[0], t, a, count_t, total_t, count_a, stotal)
+    return dict(count_t), dict(total_t), count_a, {'log_likelihood':log_likelihood}
+
+def _estep_group(task) :
+    '''
+        runs an E-step function over a group of shards in a worker process, with the tables of the iteration
+
+        returns the partial tables of every shard of the group
+    '''
+    estep, shared, shards = task
+    _shared.clear()
+    _shared.update(pickle.loads(shared))
+    res = [ estep(shard) for shard in shards ]
+    _shared.clear()
+    return res
+
+def _get_pool(workers) :
+    '''
+        returns the E-step process pool of a number of workers, which is started on first use
+        and reused until the interpreter exits
+    '''
+    res = _pools.get(workers)
+    if res is None :
+        res = multiprocessing.Pool(workers)
+        _pools[workers] = res
+    return res
+
+@atexit.register
+def _close_pools() :
+    for pool in _pools.values() :
+        pool.terminate()
+    _pools.clear()
+
+def _map_shards(estep, shared, corpus, workers, monitor=None, stage=None, iteration=None) :
+    '''
+        runs an E-step function over all corpus shards in the persistent process pool (in this process without workers)
+
+        the shards are split into one contiguous group per worker and the partial tables of every shard are
+        yielded in shard order. Since the shard size is fixed, the reduced counts are identical for any number
+        of workers and without workers. The read-only tables in shared are pickled once per iteration.
+    '''
+    shards = corpus.get_shards(_SHARD_SIZE) or [(0, 0)]
+    if not workers :
+        _shared.clear()
+        _shared.update(shared)
+        for shard in shards :
+            partial = estep(shard)
+            if monitor is not None : monitor.progress(stage, shard[1], iteration)
+            yield partial
+        _shared.clear()
+        return
+    count_groups = max(min(workers, len(shards)), 1)
+    groups = [ shards[index_group*len(shards)//count_groups:(index_group+1)*len(shards)//count_groups] for index_group in range(count_groups) ]
+    shared = pickle.dumps(shared, pickle.HIGHEST_PROTOCOL)
+    for index_group, partials in enumerate(_get_pool(workers).imap(_estep_group, [ (estep, shared, group) for group in groups ])) :
+        if monitor is not None and groups[index_group] : monitor.progress(stage, groups[index_group][-1][1], iteration, workers=workers)
+        yield from partials
+
+def _reduce_counts(partials) :
+    '''
+        sums partial count tables (tuples of dicts) in the order they are given,
+        values may also be flat count matrices (alignment buckets)
+    '''
+    res = None
+    for partial in partials :
+        if res is None :
+            res = tuple(defaultdict(lambda:0.) for table in partial)
+        for table, partial_table in zip(res, partial) :
+            for key, value in partial_table.items() :
+                if not isinstance(value, array) :
+                    table[key] += value
+                elif key in table :
+                    cur_value = table[key]
+                    for index, update_c in enumerate(value) :
+                        cur_value[index] += update_c
+                else :
+                    table[key] = array('d', value)
+    return res
+
+def _encoded_arrays(corpus) :
+    '''
+        returns numpy views (tokens_f, offsets_f, tokens_e, offsets_e) and the vocabularies of a parallel corpus
+
+        the corpus is encoded into a corpus_cache if it is not cached yet
+    '''
+    cache = corpus.cache
+    if cache is None :
+        cache = corpus_cache.open(corpus.path, sides=2)
+    arrays = []
+    for side in range(2) :
+        arrays.append(np.frombuffer(cache.tokens[side], dtype=np.uint32).astype(np.int64))
+        arrays.append(np.frombuffer(cache.offsets[side], dtype=np.uint64).astype(np.int64))
+    return arrays, cache.vocab
+
+def _encoded_batches(offsets_f, offsets_e, batch_cells=1<<22) :
+    '''
+        splits the corpus into sentence ranges of roughly batch_cells (e,f) cells each
+    '''
+    cells = (np.diff(offsets_e) + 1) * (np.diff(offsets_f) + 1)
+    bounds = np.searchsorted(np.cumsum(cells), np.arange(batch_cells, cells.sum()+batch_cells, batch_cells), side='right')
+    bounds = np.unique(np.concatenate(([0], np.minimum(bounds, len(cells)), [len(cells)])))
+    return list(zip(bounds[:-1], bounds[1:]))
+
+def _unique(keys) :
+    # sort based unique, considerably faster than hashing for large int64 key arrays
+    keys = np.sort(keys)
+    return keys[np.concatenate(([True], keys[1:] != keys[:-1]))]
+
+def _gather_tokens(tokens, offsets, sentence, index) :
+    # position 0 of every sentence is the null token (id 0)
+    res = np.zeros(len(index), dtype=np.int64)
+    mask = index > 0
+    res[mask] = tokens[offsets[sentence[mask]] + index[mask] - 1]
+    return res
+
+def _encoded_cells(arrays, start, stop) :
+    '''
+        enumerates all (e,f) cells of the sentence pairs [start, stop) including null tokens
+
+        returns (token_e, token_f, index_e, index_f, row_e, sentence, length_e, length_f)
+            where row_e enumerates the target positions of the batch (normalization groups)
+    '''
+    tokens_f, offsets_f, tokens_e, offsets_e = arrays
+    length_f = np.diff(offsets_f[start:stop+1]) + 1
+    length_e = np.diff(offsets_e[start:stop+1]) + 1
+    cells = length_e * length_f
+    sentence = np.repeat(np.arange(stop-start), cells)
+    local = np.arange(cells.sum()) - np.repeat(np.cumsum(cells) - cells, cells)
+    index_e = local // length_f[sentence]
+    index_f = local % length_f[sentence]
+    row_e = (np.cumsum(length_e) - length_e)[sentence] + index_e
+    token_e = _gather_tokens(tokens_e, offsets_e[start:stop], sentence, index_e)
+    token_f = _gather_tokens(tokens_f, offsets_f[start:stop], sentence, index_f)
+    return token_e, token_f, index_e, index_f, row_e, sentence, length_e, length_f
+
+def _encoded_pair_keys(arrays, batches, count_f) :
+    '''
+        returns the sorted sparse pair index of all co-occurring (e,f) pairs : key = id_e * |V_f| + id_f
+    '''
+    res = []
+    for start, stop in batches :
+        token_e, token_f = _encoded_cells(arrays, start, stop)[:2]
+        res.append(_unique(token_e * count_f + token_f))
+    return _unique(np.concatenate(res))
+
+def _train_model1_numpy(corpus, iterations, verbose=False, monitor=None, tolerance=None) :
+    '''
+        IBM Model 1 with t stored as a sparse vector over the co-occurring (e,f) pairs
+
+        the E-step gathers t for all cells of a batch of sentences, normalizes per target token
+        and scatter-adds the expected counts (bincount), the results match train_model1
+    '''
+    if np is None :
+        raise ImportError('the numpy backend requires numpy to be installed')
+    if verbose : print(" - training IBM Model 1 (numpy) - ")
+    monitor = get_monitor(monitor, verbose)
+    arrays, (vocab_f, vocab_e) = _encoded_arrays(corpus)
+    count_f = len(vocab_f)
+    batches = _encoded_batches(arrays[1], arrays[3])
+    pair_keys = _encoded_pair_keys(arrays, batches, count_f)
+    pair_e = pair_keys // count_f
+    pair_f = pair_keys % count_f
+    # pairs with a null token are not re-estimated (see train_model1)
+    fixed = (pair_e == 0) | (pair_f == 0)
+    t = np.full(len(pair_keys), 1./(count_f-1))
+    count_pairs = len(arrays[1])-1
+    log_likelihood, converged = None, False
+    if monitor is not None : monitor.start('model1', count_pairs, iterations)
     # training loop
     for i in range(iterations) :
-        count = defaultdict(lambda:0.)
-        total = defaultdict(lambda:0.)
-        stotal = {}
-        for index_pair, pair in enumerate(corpus) :
-            if (verbose) and ( ((index_pair+1)%100 == 0) or (i+1 == iterations) ):
-                stdout.write(('\rtraining iteration : %d of %d | %d of %d sentence pairs | %d token pairs'+(' '*10)) % (i+1, iterations, index_pair+1, len(corpus), len(t.keys())))
-                stdout.flush()
-            # insert null token
-            sentence_f = [""] + pair[0]
-            sentence_e = [""] + pair[1]
+        previous_log_likelihood = log_likelihood
+        log_likelihood = 0.
+        count = np.zeros(len(pair_keys))
+        for index_batch, (start, stop) in enumerate(batches) :
+            if monitor is not None : monitor.progress('model1', stop, i+1)
+            token_e, token_f, _, _, row_e, _, length_e, length_f = _encoded_cells(arrays, start, stop)
+            pair = np.searchsorted(pair_keys, token_e * count_f + token_f)
+            values = t[pair]
             # compute normalization
-            for token_e in sentence_e :
-                stotal[token_e] = 0
-                for token_f in sentence_f :
-                    stotal[token_e] += t[(token_e,token_f)]
+            stotal = np.bincount(row_e, weights=values)
+            log_likelihood += float(np.log(stotal).sum() - (length_e * np.log(length_f)).sum())
             # collect counts
-            for token_e in sentence_e :
-                for token_f in sentence_f :
-                    count[(token_e,token_f)] += t[(token_e,token_f)] / stotal[token_e]
-                    total[token_f] += t[(token_e,token_f)] / stotal[token_e]
-                    if total[token_f] == 0 :
-                        print(token_f, total[token_f])
+            count += np.bincount(pair, weights=values / stotal[row_e], minlength=len(pair_keys))
         # probability estimation
-        for token_e, token_f in corpus.get_token_pairs() :
-            t[(token_e,token_f)] = count[(token_e,token_f)] / total[token_f]
-        corpus.reset_iter()
-    if verbose : print("\n - training of IBM Model 1 complete - ")
-    return dict(t)
+        total = np.bincount(pair_f, weights=count, minlength=count_f)
+        t = np.where(fixed, t, count / total[pair_f])
+        converged = _converged(log_likelihood, previous_log_likelihood, tolerance)
+        if monitor is not None : monitor.iteration('model1', i+1, count_pairs, tables={'t':len(pair_keys)}, log_likelihood=log_likelihood)
+        if converged :
+            break
+    _report_convergence('model1', converged, tolerance, verbose)
+    if monitor is not None : monitor.end('model1', tables={'t':len(pair_keys)}, log_likelihood=log_likelihood, converged=converged)
+    if verbose : print(" - training of IBM Model 1 complete - ")
+    return { (vocab_e[e], vocab_f[f]) : prob for e, f, prob in zip(pair_e.tolist(), pair_f.tolist(), t.tolist()) }
 
-def train_model2(corpus, iterations, verbose=False) :
+def train_model2(corpus, iterations, verbose=False, backend='python', workers=None, checkpoint=None, monitor=None, compact=True, train_cache=None, init_t=None, init_a=None, init_weight=0., tolerance=None) :
     '''
         EM training function according to IBM Model 2
+        arguments
+            backend='python' : 'python' or 'numpy' (length-grouped tensor E-step of Model 1 and 2, requires numpy,
+                               see _train_model2_numpy)
+            workers=None : number of processes computing the E-step on corpus shards
+            checkpoint=None : path prefix of a checkpoint which is written after every iteration and resumed from
+            monitor=None : progress_monitor receiving the progress and metrics (stages 'model1' and 'model2'), console if verbose
+            compact=True : returns t as compact_table (float32 values), else as dict
+            train_cache=None : training_cache the results of Model 1 and 2 are loaded from or stored in
+            init_t=None, init_a=None : t and a of earlier training to warm start Model 1 and 2 from (see train_model1),
+                                       a may be an alignment_table or {(i,j,l_e,l_f) : prob}
+            init_weight=0. : number of pseudo-counts per context of the initial tables in the M-step
+            tolerance=None : relative log-likelihood improvement below which Model 1 and 2 stop early (see train_model1)
 
         returns (t, a)
             the translation probability t = {(e,f) : prob}
-            the alignment probability a = {(i,j,l_e,l_f) : prob }
+            the alignment probability a = {(i,j,l_e,l_f) : prob } (as alignment_table)
+    '''
+    params = {'iterations':iterations, 'tolerance':tolerance, 'backend':backend, 'init':_get_tables_fingerprint(init_t, init_a), 'init_weight':init_weight}
+    cached = _load_cached(train_cache, 'model2', corpus, params, verbose)
+    if cached is not None :
+        t, a = cached
+        return (compact_table(t) if compact else t), a
+    if backend == 'numpy' :
+        if (init_t is not None) or (init_a is not None) :
+            raise ValueError('warm starts (init_t, init_a) require the python backend')
+        t, a = _train_model2_numpy(corpus, iterations, verbose, monitor, train_cache, tolerance)
+    else :
+        stamp = _get_stamp(corpus, 'model2', params, train_cache) if checkpoint else None
+        t, a = _train_model2_python(corpus, iterations, verbose, workers, checkpoint, monitor, train_cache, init_t, init_a, init_weight, tolerance, stamp)
+    _save_cached(train_cache, 'model2', corpus, params, (t, a))
+    return (compact_table(t) if compact else t), a
+
+def _train_model2_python(corpus, iterations, verbose=False, workers=None, checkpoint=None, monitor=None, train_cache=None, init_t=None, init_a=None, init_weight=0., tolerance=None, stamp=None) :
+    '''
+        IBM Model 2 with t stored as dict (see train_model2)
     '''
     if verbose : print(" - training IBM Model 2 - ")
+    monitor = get_monitor(monitor, verbose)
     t = {}
-    a = {}
     # initialize t according to Model 1
     if verbose : print("initialize t according to Model 1...")
-    t = train_model1(corpus, iterations, verbose=verbose)
-    # initialize a uniformly
-    for pair in corpus :
-        length_f = len(pair[0])+1
-        length_e = len(pair[1])+1
-        for index_f in range(length_f) :
-            for index_e in range(length_e) :
-                a[(index_f,index_e,length_e,length_f)] = 1./(length_f+1)
+    state = _load_state(checkpoint, 'model2', corpus, iterations, stamp, verbose)
+    if state :
+        t, a = state['t'], state['a']
+    else :
+        t = train_model1(corpus, iterations, verbose=verbose, workers=workers, checkpoint=checkpoint, monitor=monitor, compact=False, train_cache=train_cache, init_t=init_t, init_weight=init_weight, tolerance=tolerance)
+        # a is initialized uniformly per (length_e, length_f) bucket when the bucket is first seen
+        a = alignment_table()
+        if init_a is not None : a.update(init_a)
+    prior_a = None
+    if (init_a is not None) and (init_weight > 0) :
+        prior_a = alignment_table()
+        prior_a.update(init_a)
+    first_iteration, log_likelihood, converged = _get_resume_point(state, iterations)
+    if monitor is not None : monitor.start('model2', get_corpus_length(corpus), iterations)
+    # training loop
+    for i in range(first_iteration, iterations) :
+        previous_log_likelihood = log_likelihood
+        # sharded E-step (in this process without workers)
+        shared = {'t' : t, 'a' : a, 'corpus' : corpus.get_reader_args()}
+        count_t, total_t, count_a, metrics = _reduce_counts(_map_shards(_estep_model2, shared, corpus, workers, monitor, 'model2', i+1))
+        log_likelihood = metrics['log_likelihood']
+        # probability estimation
+        if init_t is None :
+            for token_e, token_f in t.keys() :
+                t[(token_e, token_f)] = count_t[(token_e, token_f)] / total_t[token_f]
+        else :
+            t = _estimate(count_t, total_t, lambda pair: pair[1], init_t, init_weight)
+        a.estimate(count_a, prior_a, init_weight)
+        converged = _converged(log_likelihood, previous_log_likelihood, tolerance)
+        _save_state(checkpoint, 'model2', corpus, i+1, {'t' : t, 'a' : a, 'log_likelihood' : log_likelihood, 'converged' : converged}, stamp)
+        if monitor is not None : monitor.iteration('model2', i+1, len(corpus), tables={'t':len(t), 'a':len(a)}, log_likelihood=log_likelihood)
+        if converged :
+            break
+    _report_convergence('model2', converged, tolerance, verbose)
+    if monitor is not None : monitor.end('model2', tables={'t':len(t), 'a':len(a)}, log_likelihood=log_likelihood, converged=converged)
+    if verbose : print(" - training of IBM Model 2 complete - ")
+    return dict(t), a
+
+def _encoded_length_groups(arrays, group_cells=1<<22) :
+    '''
+        groups the sentence pairs by (length_e, length_f) including null tokens
+
+        returns [(length_e, length_f, sentences)] with the sentence indices of a group split into
+        chunks of roughly group_cells (e,f) cells
+    '''
+    offsets_f, offsets_e = arrays[1], arrays[3]
+    length_f = np.diff(offsets_f) + 1
+    length_e = np.diff(offsets_e) + 1
+    order = np.lexsort((length_f, length_e))
+    bounds = np.flatnonzero((np.diff(length_e[order]) != 0) | (np.diff(length_f[order]) != 0)) + 1
+    res = []
+    for sentences in np.split(order, bounds) :
+        if len(sentences) < 1 :
+            continue
+        group_e, group_f = int(length_e[sentences[0]]), int(length_f[sentences[0]])
+        chunk = max(group_cells // (group_e * group_f), 1)
+        for start in range(0, len(sentences), chunk) :
+            res.append((group_e, group_f, sentences[start:start+chunk]))
+    return res
+
+def _gather_group(tokens, offsets, sentences, length) :
+    # (sentences, length) token ids of a length group, column 0 is the null token (id 0)
+    res = np.zeros((len(sentences), length), dtype=np.int64)
+    if length > 1 :
+        res[:, 1:] = tokens[offsets[sentences][:, None] + np.arange(length-1)[None, :]]
+    return res
+
+def _train_model2_numpy(corpus, iterations, verbose=False, monitor=None, train_cache=None, tolerance=None) :
+    '''
+        IBM Model 2 with t stored as a sparse vector over the co-occurring (e,f) pairs
+
+        all sentence pairs of a (length_e, length_f) group share one alignment matrix, so the E-step
+        gathers t of a whole group into a (sentences, length_e, length_f) tensor, multiplies it with the
+        broadcast alignment matrix and computes the normalization and the expected counts of t and a
+        with a few array operations per group. t is initialized by the numpy backend of train_model1
+        and the results match train_model2 (up to rounding)
+    '''
+    if np is None :
+        raise ImportError('the numpy backend requires numpy to be installed')
+    if verbose : print(" - training IBM Model 2 (numpy) - ")
+    monitor = get_monitor(monitor, verbose)
+    if verbose : print("initialize t according to Model 1...")
+    prob_t = train_model1(corpus, iterations, verbose=verbose, backend='numpy', monitor=monitor, compact=False, train_cache=train_cache, tolerance=tolerance)
+    arrays, (vocab_f, vocab_e) = _encoded_arrays(corpus)
+    tokens_f, offsets_f, tokens_e, offsets_e = arrays
+    count_f = len(vocab_f)
+    pair_keys = _encoded_pair_keys(arrays, _encoded_batches(offsets_f, offsets_e), count_f)
+    pair_e = pair_keys // count_f
+    pair_f = pair_keys % count_f
+    uniform = 1./(count_f-1)
+    t = np.fromiter((prob_t.get((vocab_e[e], vocab_f[f]), uniform) for e, f in zip(pair_e.tolist(), pair_f.tolist())), dtype=np.float64, count=len(pair_keys))
+    prob_t = None
+    groups = _encoded_length_groups(arrays)
+    # a is initialized uniformly per (length_e, length_f) bucket as in the python E-step
+    a = { (length_e, length_f) : np.full((length_e, length_f), 1./(length_f+1)) for length_e, length_f, _ in groups }
+    count_pairs = len(offsets_f)-1
+    log_likelihood, converged = None, False
+    if monitor is not None : monitor.start('model2', count_pairs, iterations)
     # training loop
     for i in range(iterations) :
-        count_t = defaultdict(lambda:0)
-        total_t = defaultdict(lambda:0)
-        count_a = defaultdict(lambda:0)
-        total_a = defaultdict(lambda:0)
-        stotal = {}
-        corpus.reset_iter()
-        for index_pair, pair in enumerate(corpus) :
-            if (verbose) and ( ((index_pair+1)%100 == 0) or (i+1 == iterations) ):
-                stdout.write(('\rtraining iteration : %d of %d | %d of %d sentence pairs | %d alignments'+(' '*10)) % (i+1, iterations, index_pair+1, len(corpus), len(a.keys())))
-                stdout.flush()
-            sentence_f = [""] + pair[0] # insert null token
-            sentence_e = [""] + pair[1]
-            length_f = len(sentence_f)
-            length_e = len(sentence_e)
+        previous_log_likelihood = log_likelihood
+        log_likelihood = 0.
+        count_t = np.zeros(len(pair_keys))
+        count_a = { bucket : np.zeros(bucket_a.shape) for bucket, bucket_a in a.items() }
+        pairs_done = 0
+        for length_e, length_f, sentences in groups :
+            sentence_e = _gather_group(tokens_e, offsets_e, sentences, length_e)
+            sentence_f = _gather_group(tokens_f, offsets_f, sentences, length_f)
+            pair = np.searchsorted(pair_keys, sentence_e[:, :, None] * count_f + sentence_f[:, None, :])
+            values = t[pair] * a[(length_e, length_f)][None, :, :]
             # compute normalization
-            for index_e, token_e in enumerate(sentence_e) :
-                stotal[token_e] = 0
-                for index_f, token_f in enumerate(sentence_f) :
-                    stotal[token_e] += t[(token_e,token_f)] * a[(index_f,index_e,length_e,length_f)]
+            stotal = values.sum(axis=2)
+            log_likelihood += float(np.log(stotal).sum())
+            # a repeated target token is normalized by its last position (stotal per token in _estep_model2_pair)
+            same = sentence_e[:, :, None] == sentence_e[:, None, :]
+            last = length_e - 1 - np.argmax(same[:, :, ::-1], axis=2)
+            values /= np.take_along_axis(stotal, last, axis=1)[:, :, None]
             # collect counts
-            for index_e, token_e in enumerate(sentence_e) :
-                for index_f, token_f in enumerate(sentence_f) :
-                    update_c = t[(token_e,token_f)] * a[(index_f,index_e,length_e,length_f)]/stotal[token_e]
-                    count_t[(token_e,token_f)] += update_c
-                    total_t[token_f] += update_c
-                    count_a[(index_f,index_e,length_e,length_f)] += update_c
-                    total_a[(index_e,length_e,length_f)] += update_c
+            count_t += np.bincount(pair.ravel(), weights=values.ravel(), minlength=len(pair_keys))
+            count_a[(length_e, length_f)] += values.sum(axis=0)
+            pairs_done += len(sentences)
+            if monitor is not None : monitor.progress('model2', pairs_done, i+1)
         # probability estimation
-        for token_e, token_f in t.keys() :
-            t[(token_e, token_f)] = count_t[(token_e, token_f)] / total_t[token_f]
-        for alignment in a.keys() :
-            a[alignment] = count_a[alignment] / total_a[alignment[1:]]
-    if verbose : print("\n - training of IBM Model 2 complete - ")
-    return dict(t), dict(a)
+        total_t = np.bincount(pair_f, weights=count_t, minlength=count_f)
+        t = count_t / total_t[pair_f]
+        for bucket, bucket_count in count_a.items() :
+            a[bucket] = bucket_count / bucket_count.sum(axis=1, keepdims=True)
+        converged = _converged(log_likelihood, previous_log_likelihood, tolerance)
+        if monitor is not None : monitor.iteration('model2', i+1, count_pairs, tables={'t':len(pair_keys), 'a':sum(bucket_a.size for bucket_a in a.values())}, log_likelihood=log_likelihood)
+        if converged :
+            break
+    _report_convergence('model2', converged, tolerance, verbose)
+    res_a = alignment_table()
+    for (length_e, length_f), bucket_a in a.items() :
+        res_a.buckets[(length_e, length_f)] = array('d', bucket_a.ravel().tolist())
+    if monitor is not None : monitor.end('model2', tables={'t':len(pair_keys), 'a':len(res_a)}, log_likelihood=log_likelihood, converged=converged)
+    if verbose : print(" - training of IBM Model 2 complete - ")
+    return { (vocab_e[e], vocab_f[f]) : prob for e, f, prob in zip(pair_e.tolist(), pair_f.tolist(), t.tolist()) }, res_a
+
+class _stepwise_t :
+    '''
+        translation probabilities t(e,f) = count(e,f) / total(f) read from running stepwise statistics
+    '''
+    def __init__(self, statistics, uniform) :
+        self.count, self.total = statistics.tables[:2]
+        self.uniform = uniform
+
+    def get(self, key, default=None) :
+        res = self.count.get(key)
+        if res is None :
+            return self.uniform if default is None else default
+        return res / self.total[key[1]]
+
+    def __getitem__(self, key) :
+        return self.get(key)
+
+    def to_dict(self) :
+        return { key : self.get(key) for key in self.count }
+
+class _stepwise_model2_t(_stepwise_t) :
+    '''
+        stepwise translation probabilities falling back to the Model 1 estimate for unseen pairs
+    '''
+    def __init__(self, prior, statistics) :
+        _stepwise_t.__init__(self, statistics, 0.)
+        self.prior = prior
+
+    def get(self, key, default=None) :
+        res = self.count.get(key)
+        if res is None :
+            return self.prior.get(key, 0.)
+        return res / self.total[key[1]]
+
+    def to_dict(self) :
+        res = dict(self.prior)
+        res.update(_stepwise_t.to_dict(self))
+        return res
+
+def _iter_batches(corpus, passes, batch_size) :
+    '''
+        yields (index_pass, pairs done, batch, last) with batches of at most batch_size sentence pairs,
+        last marks the final batch of a pass (batches are yielded one batch late, since the length
+        of a corpus is only known after its first pass)
+    '''
+    for index_pass in range(passes) :
+        corpus.reset_iter()
+        pending = None
+        batch = []
+        for index_pair, pair in enumerate(corpus) :
+            batch.append(pair)
+            if len(batch) >= batch_size :
+                if pending is not None :
+                    yield index_pass, pending[0], pending[1], False
+                pending = (index_pair+1, batch)
+                batch = []
+        if batch :
+            if pending is not None :
+                yield index_pass, pending[0], pending[1], False
+            pending = (index_pair+1, batch)
+        if pending is not None :
+            yield index_pass, pending[0], pending[1], True
+    corpus.reset_iter()
+
+def _report_batch(monitor, stage, index_pass, pairs_done, last, tables, log_likelihood=None) :
+    '''
+        reports the progress of a stepwise EM batch and the end of a pass (last batch) to monitor
+    '''
+    monitor.progress(stage, pairs_done, index_pass+1)
+    if last :
+        monitor.iteration(stage, index_pass+1, pairs_done, tables=tables, log_likelihood=log_likelihood)
+
+def train_model1_stepwise(corpus, passes=1, batch_size=1000, step_power=0.7, step_offset=2, verbose=False, monitor=None, compact=True, tolerance=None) :
+    '''
+        stepwise (online) EM training function according to IBM Model 1
+
+        t is updated after every mini-batch of batch_size pairs using the step size
+        eta_k = (k + step_offset)^-step_power (0.5 < step_power <= 1), so memory depends on the
+        batch and table size only and one or two passes are usually sufficient
+        (monitor=None : progress_monitor receiving a 'model1' iteration per pass, console if verbose,
+        compact=True : returns t as compact_table, else as dict, tolerance=None : stops before passes
+        when the log-likelihood of a pass, summed over its batches, improved by less than tolerance)
+
+        returns the translation probability t = {(e,f) : prob}
+    '''
+    if verbose : print(" - training IBM Model 1 (stepwise) - ")
+    monitor = get_monitor(monitor, verbose)
+    statistics = stepwise_counts(2, step_power, step_offset)
+    t = _stepwise_t(statistics, 1./corpus.count_unique_f())
+    log_likelihood, pass_log_likelihood, converged = None, 0., False
+    if monitor is not None : monitor.start('model1', get_corpus_length(corpus), passes)
+    for index_pass, index_pair, batch, last in _iter_batches(corpus, passes, batch_size) :
+        count = defaultdict(lambda:0.)
+        total = defaultdict(lambda:0.)
+        stotal = {}
+        for pair in batch :
+            pass_log_likelihood += _estep_model1_pair([""] + pair[1], [""] + pair[0], t, t.uniform, count, total, stotal)
+        statistics.update((count, total))
+        if last :
+            previous_log_likelihood, log_likelihood, pass_log_likelihood = log_likelihood, pass_log_likelihood, 0.
+            converged = _converged(log_likelihood, previous_log_likelihood, tolerance)
+        if monitor is not None : _report_batch(monitor, 'model1', index_pass, index_pair, last, {'t':len(t.count)}, log_likelihood)
+        if converged :
+            break
+    corpus.reset_iter()
+    _report_convergence('model1', converged, tolerance, verbose)
+    if monitor is not None : monitor.end('model1', tables={'t':len(t.count)}, log_likelihood=log_likelihood, converged=converged)
+    if verbose : print(" - training of IBM Model 1 complete - ")
+    return compact_table(t.to_dict()) if compact else t.to_dict()
+
+def train_model2_stepwise(corpus, passes=1, batch_size=1000, step_power=0.7, step_offset=2, verbose=False, monitor=None, compact=True, tolerance=None) :
+    '''
+        stepwise (online) EM training function according to IBM Model 2
+
+        t is initialized by train_model1_stepwise, afterwards t and the touched alignment buckets of a
+        are updated after every mini-batch (see train_model1_stepwise)
+
+        returns (t, a)
+            the translation probability t = {(e,f) : prob}
+            the alignment probability a = {(i,j,l_e,l_f) : prob } (as alignment_table)
+    '''
+    if verbose : print(" - training IBM Model 2 (stepwise) - ")
+    monitor = get_monitor(monitor, verbose)
+    if verbose : print("initialize t according to Model 1...")
+    t = train_model1_stepwise(corpus, passes, batch_size, step_power, step_offset, verbose=verbose, monitor=monitor, compact=False, tolerance=tolerance)
+    statistics = stepwise_counts(3, step_power, step_offset)
+    # the first batch starts from the Model 1 estimate
+    t = _stepwise_model2_t(t, statistics)
+    a = alignment_table()
+    log_likelihood, pass_log_likelihood, converged = None, 0., False
+    if monitor is not None : monitor.start('model2', get_corpus_length(corpus), passes)
+    for index_pass, index_pair, batch, last in _iter_batches(corpus, passes, batch_size) :
+        count_t = defaultdict(lambda:0.)
+        total_t = defaultdict(lambda:0.)
+        count_a = {}
+        stotal = {}
+        for pair in batch :
+            pass_log_likelihood += _estep_model2_pair([""] + pair[1], [""] + pair[0], t, a, count_t, total_t, count_a, stotal)
+        statistics.update((count_t, total_t, count_a))
+        a.estimate({ bucket : statistics.tables[2][bucket] for bucket in count_a })
+        if last :
+            previous_log_likelihood, log_likelihood, pass_log_likelihood = log_likelihood, pass_log_likelihood, 0.
+            converged = _converged(log_likelihood, previous_log_likelihood, tolerance)
+        if monitor is not None : _report_batch(monitor, 'model2', index_pass, index_pair, last, {'t':len(t.count), 'a':len(a)}, log_likelihood)
+        if converged :
+            break
+    corpus.reset_iter()
+    _report_convergence('model2', converged, tolerance, verbose)
+    if monitor is not None : monitor.end('model2', tables={'t':len(t.count), 'a':len(a)}, log_likelihood=log_likelihood, converged=converged)
+    if verbose : print(" - training of IBM Model 2 complete - ")
+    return (compact_table(t.to_dict()) if compact else t.to_dict()), a
 
-def train_model3(corpus, iterations, verbose=False) :
+def train_model3(corpus, iterations, verbose=False, samples=64, sample_time=None, sample_pegged=4, backend='python', workers=None, checkpoint=None, monitor=None, compact=True, train_cache=None, init_t=None, init_d=None, init_f=None, init_weight=0., tolerance=None) :
     '''
         EM training function according to IBM Model 3
+        arguments
+            samples=64 : maximum number of sampled alignments per sentence pair
+            sample_time=None : maximum seconds spent on sampling per sentence pair
+            sample_pegged=4 : number of target positions every source position is pegged to when sampling (None : all)
+            backend='python' : backend of Model 1 and 2 (see train_model2)
+            workers=None : number of processes computing the E-steps of Model 1 and 2
+            checkpoint=None : path prefix of the checkpoints of all models (written after every iteration)
+            monitor=None : progress_monitor receiving the progress and metrics (stages 'model1' to 'model3'), console if verbose
+            compact=True : returns t, d and f as compact_tables sharing one token_vocabulary, else as dicts
+            train_cache=None : training_cache the results of Model 1 to 3 are loaded from or stored in
+            init_t=None, init_d=None, init_f=None : log tables of an earlier Model 3 (e.g. of a saved model) to warm start
+                                                   from instead of training Model 1 and 2, t and d are required
+            init_weight=0. : number of pseudo-counts per context of the initial tables in the M-step (see _estimate)
+            tolerance=None : relative log-likelihood improvement below which Model 1 to 3 stop early (see train_model1),
+                             Model 3 uses the log probability of the Viterbi alignment of every pair
 
         returns (t, d, f, n)
             the translation probability t = {(e,f) : prob}
@@ -118,72 +844,77 @@ def train_model3(corpus, iterations, verbose=False) :
             the fertility probability f = {(n,f) : prob }
             the null non-insertion probability p0 = prob
     '''
+    if (init_t is not None) and (init_d is None) :
+        raise ValueError('a warm start of Model 3 requires init_t and init_d')
+    params = {'iterations':iterations, 'samples':samples, 'sample_time':sample_time, 'sample_pegged':sample_pegged, 'tolerance':tolerance, 'backend':backend, 'init':_get_tables_fingerprint(init_t, init_d, init_f), 'init_weight':init_weight}
+    cached = _load_cached(train_cache, 'model3', corpus, params, verbose)
+    if cached is not None :
+        return _get_model3_tables(cached, compact)
     if verbose : print(" - training IBM Model 3 - ")
+    monitor = get_monitor(monitor, verbose)
     t = {}
     d = {}
     f = {}
     p0 = None
-    # initialize t,d according to Model 2
-    if verbose : print("initialize t, d according to Model 2...")
-    t, d = train_model2(corpus, iterations*2, verbose=verbose)
-    # remap distributions t, d
-    for pair in t :
-         # convert and filter 0 probabilites
-        if t[pair] > 0 : t[pair] = log(t[pair])
-    remap_d = {}
-    for align in d :
-        # convert and filter 0 probabilites
-        if d[align] > 0 : remap_d[(align[1], align[0], align[2], align[3])] = log(d[align])
-    d = remap_d
+    stamp = _get_stamp(corpus, 'model3', params, train_cache) if checkpoint else None
+    state = _load_state(checkpoint, 'model3', corpus, iterations, stamp, verbose)
+    if state :
+        t, d, f, p0 = state['t'], state['d'], state['f'], state['p0']
+    elif init_t is not None :
+        if verbose : print("initialize t, d, f from the given tables...")
+        t, d = dict(init_t), dict(init_d)
+        f = dict(init_f) if init_f is not None else {}
+        _extend_model3_tables(corpus, t, d)
+    else :
+        # initialize t,d according to Model 2
+        if verbose : print("initialize t, d according to Model 2...")
+        t, d = train_model2(corpus, iterations*2, verbose=verbose, backend=backend, workers=workers, checkpoint=checkpoint, monitor=monitor, compact=False, train_cache=train_cache, tolerance=tolerance)
+        # remap distributions t, d
+        for pair in t :
+             # convert and filter 0 probabilites
+            if t[pair] > 0 : t[pair] = log(t[pair])
+        remap_d = {}
+        for align in d :
+            # convert and filter 0 probabilites
+            if d[align] > 0 : remap_d[(align[1], align[0], align[2], align[3])] = log(d[align])
+        d = remap_d
+    first_iteration, log_likelihood, converged = _get_resume_point(state, iterations)
+    if monitor is not None : monitor.start('model3', get_corpus_length(corpus), iterations)
     # training loop
-    for i in range(iterations) :
+    for i in range(first_iteration, iterations) :
+        previous_log_likelihood = log_likelihood
+        log_likelihood = 0.
         count_t = defaultdict(lambda:0)
         total_t = defaultdict(lambda:0)
         count_d = defaultdict(lambda:0)
         total_d = defaultdict(lambda:0)
         count_f = defaultdict(lambda:0)
         total_f = defaultdict(lambda:0)
-        count_null = 0
         count_p1 = 0
         count_p0 = 0
         stotal = {}
         corpus.reset_iter()
         for index_pair, pair in enumerate(corpus) :
-            if (verbose) :
-                stdout.write(('\rtraining iteration : %d of %d | %d of %d sentence pairs | %d alignments | %d fertiliy values |'+(' '*10)) % (i+1, iterations, index_pair+1, len(corpus), len(d.keys()), len(f.keys())))
-                stdout.flush()
+            if monitor is not None : monitor.progress('model3', index_pair+1, i+1)
             # initialize local pair variables
             sentence_f = [""] + pair[0] # insert null token
             sentence_e = [""] + pair[1]
             length_f = len(sentence_f)
             length_e = len(sentence_e)
             # get sample alignments
-            sample_alignments = sample_model3(sentence_e, sentence_f, t, d)
+            sample_alignments = sample_model3(sentence_e, sentence_f, t, d, f, max_samples=samples, time_budget=sample_time, max_pegged=sample_pegged)
             if sample_alignments is None :
                 # skip if no valid alignments are found
                 continue
-            sample_probs = []
-            count_total = 0
-            valid_alignments = []
-            for align in sample_alignments :
-                align_prob = align.get_probability(d)
-                for index_f, token_f in enumerate(sentence_f) :
-                    token_e = sentence_e[align.get_index_e(index_f)]
-                    if (token_e, token_f) in t :
-                        cur_sample_prob = t[(token_e, token_f)]+align_prob # log probability
-                        valid_alignments.append(align)
-                        sample_probs.append(cur_sample_prob)
-            sample_alignments = valid_alignments
-            min_sample_prob = min(sample_probs)
-            for index_prob in range(len(sample_probs)) :
-                sample_probs[index_prob] = -1*min_sample_prob + sample_probs[index_prob]
-            count_norm = -1*min_sample_prob
-            for index_align, align in enumerate(sample_alignments) :
-                # normalize log probabilities as count
-                if sample_probs[index_align] == 0 :
-                    count = 1
-                else :
-                    count = sample_probs[index_align] / count_norm
+            # normalize the sample log probabilities as counts
+            max_sample_prob = sample_alignments[0][1]
+            count_norm = sum(exp(align_prob - max_sample_prob) for align, align_prob in sample_alignments)
+            # the first sample is the Viterbi alignment (the per position argmax), so the convergence criterion
+            # does not depend on which or how many other alignments were sampled
+            log_likelihood += max_sample_prob
+            for align, align_prob in sample_alignments :
+                count = exp(align_prob - max_sample_prob) / count_norm
+                count_null = 0
                 for index_f, token_f in enumerate(sentence_f) :
                     index_e = align.get_index_e(index_f)
                     token_e = sentence_e[index_e]
@@ -202,91 +933,193 @@ def train_model3(corpus, iterations, verbose=False) :
                             fertility += 1
                     count_f[(fertility, sentence_f[index_f])] += count
                     total_f[sentence_f[index_f]] += count
-        # probability estimation
-        t = {}
-        d = {}
-        f = {}
-        for token_e, token_f in count_t.keys() :
-            cur_prob_t = count_t[(token_e, token_f)] / total_t[token_f]
-            if cur_prob_t > 0 : t[(token_e, token_f)] = log(cur_prob_t) # log probability
-        for index_e, index_f, length_e, length_f in count_d.keys() :
-            cur_prob_d = count_d[(index_e, index_f, length_e, length_f)] / total_d[(index_f, length_e, length_f)]
-            if cur_prob_d > 0 : d[(index_e, index_f, length_e, length_f)] = log(cur_prob_d) # log probability
-        for fertility, token_f in count_f.keys() :
-            cur_prob_f = count_f[(fertility, token_f)] / total_f[token_f]
-            if cur_prob_f > 0 : f[(fertility, token_f)] = log(cur_prob_f) # log probability
+        # probability estimation (log probabilities)
+        t = _estimate(count_t, total_t, lambda key: key[1], init_t, init_weight, log_space=True)
+        d = _estimate(count_d, total_d, lambda key: key[1:], init_d, init_weight, log_space=True)
+        f = _estimate(count_f, total_f, lambda key: key[1], init_f, init_weight, log_space=True)
         p1 = count_p1 / (count_p0 + count_p1)
         p0 = 1 - p1
-    if verbose : print("\n - training of IBM Model 3 complete - ")
+        converged = _converged(log_likelihood, previous_log_likelihood, tolerance)
+        _save_state(checkpoint, 'model3', corpus, i+1, {'t' : t, 'd' : d, 'f' : f, 'p0' : p0, 'log_likelihood' : log_likelihood, 'converged' : converged}, stamp)
+        if monitor is not None : monitor.iteration('model3', i+1, len(corpus), tables={'t':len(t), 'd':len(d), 'f':len(f)}, log_likelihood=log_likelihood)
+        if converged :
+            break
+    _report_convergence('model3', converged, tolerance, verbose)
+    if monitor is not None : monitor.end('model3', tables={'t':len(t), 'd':len(d), 'f':len(f)}, log_likelihood=log_likelihood, converged=converged)
+    if verbose : print(" - training of IBM Model 3 complete - ")
+    _save_cached(train_cache, 'model3', corpus, params, (dict(t), dict(d), dict(f), p0))
+    return _get_model3_tables((t, d, f, p0), compact)
+
+def _extend_model3_tables(corpus, t, d) :
+    '''
+        adds the (e,f) pairs and alignment buckets of corpus which are missing from the warm start tables t and d
+        (log space) with uniform probabilities, as Model 1 and 2 initialize them
+    '''
+    log_uniform_t = log(1./corpus.count_unique_f())
+    lengths = set()
+    corpus.reset_iter()
+    for pair in corpus :
+        sentence_f = [""] + pair[0] # insert null token
+        sentence_e = [""] + pair[1]
+        for token_e in sentence_e :
+            for token_f in sentence_f :
+                t.setdefault((token_e, token_f), log_uniform_t)
+        length_f = len(sentence_f)
+        length_e = len(sentence_e)
+        if (length_e, length_f) in lengths :
+            continue
+        lengths.add((length_e, length_f))
+        for index_e in range(length_e) :
+            for index_f in range(length_f) :
+                d.setdefault((index_e, index_f, length_e, length_f), log(1./length_e))
+    corpus.reset_iter()
+
+def _get_model3_tables(model3, compact=True) :
+    '''
+        returns (t, d, f, p0) with t, d and f as compact_tables sharing one token_vocabulary or as dicts
+    '''
+    t, d, f, p0 = model3
+    if compact :
+        vocab = token_vocabulary()
+        return compact_table(t, vocab), compact_table(d, vocab), compact_table(f, vocab), p0
     return dict(t), dict(d), dict(f), p0
 
-def sample_model3(sentence_e, sentence_f, prob_t, prob_d) :
-    res = []
+def sample_model3(sentence_e, sentence_f, prob_t, prob_d, prob_f=None, max_samples=64, time_budget=None, max_pegged=4) :
+    '''
+        samples the most probable alignments around the pegged hill-climbing results (see alignment_scorer)
+
+        returns [(alignment, log_prob), ...] sorted by probability or None if there is no valid alignment
+    '''
     length_e = len(sentence_e)
     length_f = len(sentence_f)
-    # determine argmax over index_e
-    argmax_token_alignments = []
-    for index_f in range(length_f) :
-        max_alignment = (None, None)
-        for try_e in range(length_e) :
-            cur_prob_t = None
-            if (sentence_e[try_e], sentence_f[index_f]) in prob_t.keys() :
-                cur_prob_t = prob_t[(sentence_e[try_e], sentence_f[index_f])]
-            cur_prob_d = None
-            if (try_e, index_f, length_e, length_f) in prob_d.keys() :
-                cur_prob_d = prob_d[(try_e, index_f, length_e, length_f)]
-            if (cur_prob_t is not None) and (cur_prob_d is not None) :
-                cur_prob = cur_prob_t + cur_prob_d # log probability
-                if (max_alignment[1] is None) or (cur_prob > max_alignment[1]):
-                    max_alignment = (try_e, cur_prob)
-        if max_alignment[0] is None:
-            argmax_token_alignments = None
-            break
-        argmax_token_alignments.append(max_alignment[0])
-    if argmax_token_alignments is not None :
-        cur_alignment = alignment(length_e, length_f, argmax_token_alignments)
-        res.append(cur_alignment)
-    else :
-        # cur_alignment = alignment(length_e, length_f)
+    scorer = alignment_scorer(sentence_e, sentence_f, prob_t, prob_d, prob_f)
+    res = [ (alignment(length_e, length_f, token_alignments), align_prob) for token_alignments, align_prob in scorer.sample(max_samples, time_budget, max_pegged) ]
+    if len(res) < 1 :
         return None
-    # perform sampling
-    # for index_pegged in range(length_f) :
-    #     # cur_alignment = cur_alignment.hillclimb(prob_d, index_pegged)
-    #     # if cur_alignment not in res :
-    #     #     res.append(cur_alignment)
-    #     for neighbor in cur_alignment.get_neighbors(index_pegged) :
-    #         if (neighbor not in res) and (neighbor.get_probability(prob_d) is not None) :
-    #             res.append(neighbor)
     return res
 
-def train_lm(corpus, n_length, verbose=False) :
+def train_lm(corpus, n_length, verbose=False, workers=None, max_ngrams=None, monitor=None, train_cache=None) :
+    '''
+        trains an n-gram language model
+        arguments
+            workers=None : number of processes counting the n-grams of corpus shards
+            max_ngrams=None : maximum number of n-grams a worker keeps in memory before spilling
+                              its sorted partial counts to a temporary file (requires workers), this only
+                              bounds the memory of the workers, the merged counts of all n-grams and the
+                              estimated tables are still held in memory by the calling process
+            monitor=None : progress_monitor receiving the progress and metrics (stage 'lm'), console if verbose
+            train_cache=None : training_cache the result is loaded from or stored in (stage 'lm')
+
+        returns {n : {(w_n, w_1, ..., w_n-1) : log prob}}
+    '''
+    if max_ngrams and not workers :
+        raise ValueError('max_ngrams requires workers')
+    params = {'order':n_length}
+    res = _load_cached(train_cache, 'lm', corpus, params, verbose)
+    if res is not None :
+        return res
     if verbose : print(" - training "+str(n_length)+"-gram language model - ")
+    monitor = get_monitor(monitor, verbose)
+    if monitor is not None : monitor.start('lm', get_corpus_length(corpus), 1)
     res = {}
     # collect counts
     counts = {}
     for n in range(1,n_length+1) :
         res[n] = {}
         counts[n] = {}
-    for index_sen, sentence in enumerate(corpus) :
-        if (verbose) and ((index_sen+1)%100 == 0):
-            stdout.write(('\rtraining : %d of %d sentences'+(' '*10)) % (index_sen+1, len(corpus)))
-            stdout.flush()
-        sentence = ["<s>"] + sentence + ["</s>"]
-        for index_token in range(len(sentence)) :
-            for n in range(1, n_length+1):
-                ngram = tuple(sentence[index_token:(index_token+n)])
-                if index_token+n <= len(sentence) :
-                    if ngram in counts[n] :
-                        counts[n][ngram] += 1
-                    else :
-                        counts[n][ngram] = 1
+    if workers :
+        _count_ngrams_sharded(corpus, n_length, counts, workers, max_ngrams, monitor)
+    else :
+        for index_sen, sentence in enumerate(corpus) :
+            if monitor is not None : monitor.progress('lm', index_sen+1, 1)
+            _count_ngrams(sentence, n_length, counts)
+    if monitor is not None : monitor.iteration('lm', 1, len(corpus), tables={ 'lm'+str(n) : len(counts[n]) for n in counts })
     # probability estimation
-    if verbose : print("\nestimating probabilites...")
+    if verbose : print("estimating probabilites...")
     for n in range(1,n_length+1) :
         for ngram in counts[n] :
             if n > 1 :
                 res[n][(ngram[len(ngram)-1],)+ngram[:-1]] = log(counts[n][ngram] / counts[n-1][ngram[:n-1]])
             else :
                 res[n][ngram] = log(counts[n][ngram] / len(counts[n].keys()))
+    if monitor is not None : monitor.end('lm', len(corpus), tables={ 'lm'+str(n) : len(res[n]) for n in res })
     if verbose : print(" - training complete - ")
+    _save_cached(train_cache, 'lm', corpus, params, res)
     return res
+
+def _count_ngrams(sentence, n_length, counts) :
+    '''
+        adds the 1..n_length-gram counts of a sentence (with start and end tags) to counts[n]
+    '''
+    sentence = ["<s>"] + sentence + ["</s>"]
+    for index_token in range(len(sentence)) :
+        for n in range(1, min(n_length, len(sentence)-index_token)+1) :
+            ngram = tuple(sentence[index_token:(index_token+n)])
+            counts_n = counts[n]
+            counts_n[ngram] = counts_n.get(ngram, 0) + 1
+
+def _spill_ngrams(counts, spill_dir) :
+    '''
+        writes counts sorted by "n<tab>tokens" to a new temporary file and returns its path
+    '''
+    lines = [ '%d\t%s\t%d\n' % (n, ' '.join(ngram), count) for n in counts for ngram, count in counts[n].items() ]
+    lines.sort()
+    fd, path = tempfile.mkstemp(suffix='.counts', dir=spill_dir)
+    with os.fdopen(fd, 'w', encoding='utf8') as fop :
+        fop.writelines(lines)
+    return path
+
+def _count_ngrams_shard(arguments) :
+    '''
+        counts the n-grams of a corpus shard
+
+        returns the counts {n : {ngram : count}} or, if max_ngrams was exceeded, a list of spill files
+    '''
+    reader_args, shard, n_length, max_ngrams, spill_dir = arguments
+    counts = { n : {} for n in range(1, n_length+1) }
+    spills = []
+    for sentence in corpus(*reader_args).iter_range(*shard) :
+        _count_ngrams(sentence, n_length, counts)
+        if max_ngrams and (sum(len(counts_n) for counts_n in counts.values()) > max_ngrams) :
+            spills.append(_spill_ngrams(counts, spill_dir))
+            counts = { n : {} for n in range(1, n_length+1) }
+    if spills :
+        spills.append(_spill_ngrams(counts, spill_dir))
+        return spills
+    return counts
+
+def _count_ngrams_sharded(corpus, n_length, counts, workers, max_ngrams=None, monitor=None) :
+    '''
+        counts n-grams with a process pool over corpus shards (map) and merges the partial counts (reduce),
+        spilled partial counts are combined in a k-way merge of the sorted files
+
+        spilling bounds the memory of the workers only, the merged counts are collected in counts
+    '''
+    spill_dir = tempfile.mkdtemp(prefix='smu_lm_')
+    try :
+        shards = corpus.get_shards(_SHARD_SIZE)
+        spills = []
+        arguments = [ (corpus.get_reader_args(), shard, n_length, max_ngrams, spill_dir) for shard in shards ]
+        with multiprocessing.Pool(workers) as pool :
+            for index_shard, partial in enumerate(pool.imap(_count_ngrams_shard, arguments)) :
+                if monitor is not None : monitor.progress('lm', shards[index_shard][1], 1, workers=workers)
+                if isinstance(partial, list) :
+                    spills += partial
+                    continue
+                for n in partial :
+                    counts_n = counts[n]
+                    for ngram, count in partial[n].items() :
+                        counts_n[ngram] = counts_n.get(ngram, 0) + count
+        # k-way merge of the sorted spill files
+        spill_fops = [ open(path, 'r', encoding='utf8') for path in spills ]
+        try :
+            merged = heapq.merge(*spill_fops, key=lambda line: line.rsplit('\t', 1)[0])
+            for key, lines in groupby(merged, key=lambda line: line.rsplit('\t', 1)[0]) :
+                n, ngram = key.split('\t')
+                ngram = tuple(ngram.split(' '))
+                counts[int(n)][ngram] = counts[int(n)].get(ngram, 0) + sum(int(line.rsplit('\t', 1)[1]) for line in lines)
+        finally :
+            for fop in spill_fops :
+                fop.close()
+    finally :
+        shutil.rmtree(spill_dir, ignore_errors=True)
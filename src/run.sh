@@ -3,6 +3,6 @@ export INPUT=../data/devtest.de
 rm -rf ../work
 mkdir ../work
 
-python3 translate.py ../data/train.de-en ../data/train.en $INPUT devtest
-
-mv devtest* ../work
+python3 translate.py train-tm ../data/train.de-en ../work/devtest
+python3 translate.py train-lm ../data/train.en ../work/devtest
+python3 translate.py decode $INPUT ../work/devtest
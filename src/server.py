@@ -0,0 +1,261 @@
+'''
+    Translation Server
+'''
+from utils import *
+from decoders import *
+from collections import deque
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from queue import Queue, Empty
+import threading
+
+#
+# classes
+#
+
+class latency_tracker :
+    '''
+        Thread-safe window of the most recent request latencies
+    '''
+    def __init__(self, window=10000) :
+        '''
+            arguments
+                window=10000 : number of most recent latencies used for the percentiles
+        '''
+        self.latencies = deque(maxlen=window)
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def add(self, seconds) :
+        with self.lock :
+            self.latencies.append(seconds)
+            self.count += 1
+
+    def get_percentiles(self, percentiles=(50, 90, 99)) :
+        '''
+            returns {'count', 'p50', ...} with the latencies in milliseconds (nearest rank)
+        '''
+        with self.lock :
+            latencies = sorted(self.latencies)
+            res = {'count':self.count}
+        for percentile in percentiles :
+            if len(latencies) < 1 :
+                res['p%d' % percentile] = None
+                continue
+            rank = max(int(round(percentile/100. * len(latencies))) - 1, 0)
+            res['p%d' % percentile] = 1000. * latencies[rank]
+        return res
+
+class micro_batcher :
+    '''
+        Groups concurrently submitted sentences into batches for one decoder call
+
+        A background thread waits for the first pending sentence and then collects further
+        sentences until max_batch is reached or max_wait seconds have passed, so that single
+        requests are delayed by at most max_wait while bursts are decoded together.
+    '''
+    def __init__(self, decode, max_batch=32, max_wait=0.005) :
+        '''
+            arguments
+                decode : function [[foreign tokens]] -> [[translated tokens]]
+                max_batch=32 : maximum number of sentences per decoder call
+                max_wait=0.005 : maximum time in seconds to wait for further sentences
+        '''
+        self.decode = decode
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.batches = 0
+        self.sentences = 0
+        self.queue = Queue()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self) :
+        while True :
+            request = self.queue.get()
+            if request is None :
+                break
+            batch = [request]
+            deadline = perf_counter() + self.max_wait
+            while len(batch) < self.max_batch :
+                remaining = deadline - perf_counter()
+                if remaining <= 0 :
+                    break
+                try :
+                    request = self.queue.get(timeout=remaining)
+                except Empty :
+                    break
+                if request is None :
+                    self.queue.put(None) # stop after this batch
+                    break
+                batch.append(request)
+            try :
+                translations = self.decode([ request['sentence'] for request in batch ])
+                for request, translation in zip(batch, translations) :
+                    request['translation'] = translation
+            except Exception :
+                # decode the sentences separately, so that only the failing requests get the error
+                for request in batch :
+                    try :
+                        request['translation'] = self.decode([request['sentence']])[0]
+                    except Exception as error :
+                        request['error'] = error
+            self.batches += 1
+            self.sentences += len(batch)
+            for request in batch :
+                request['done'].set()
+
+    def submit(self, sentence) :
+        '''
+            queues a sentence and returns its pending request (see wait)
+        '''
+        request = {'sentence':sentence, 'done':threading.Event()}
+        self.queue.put(request)
+        return request
+
+    def wait(self, request) :
+        '''
+            returns the translation of a submitted request, raises the decoder's exception if it failed
+        '''
+        request['done'].wait()
+        if 'error' in request :
+            raise request['error']
+        return request['translation']
+
+    def translate(self, sentences) :
+        '''
+            translates a list of tokenized sentences, blocking until all of them are decoded
+        '''
+        requests = [ self.submit(sentence) for sentence in sentences ]
+        return [ self.wait(request) for request in requests ]
+
+    def close(self) :
+        self.queue.put(None)
+        self.thread.join()
+
+class _request_handler(BaseHTTPRequestHandler) :
+    '''
+        POST /translate : JSON {"sentences": [str]} (or {"sentence": str}) or plain text with one sentence per line,
+                          empty sentences are not decoded and translated as empty sentences
+        GET /stats : latency percentiles, batch and cache statistics
+
+        malformed requests are answered with 400, decoder failures with 500
+    '''
+    def _send(self, status, res, content_type='application/json') :
+        if content_type == 'application/json' :
+            res = json.dumps(res)
+        body = res.encode('utf8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type + '; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self) :
+        if self.path != '/stats' :
+            self._send(404, {'error':'unknown path'})
+            return
+        self._send(200, self.server.get_stats())
+
+    def do_POST(self) :
+        start = perf_counter()
+        if self.path != '/translate' :
+            self._send(404, {'error':'unknown path'})
+            return
+        is_json = self.headers.get('Content-Type', '').startswith('application/json')
+        try :
+            length = int(self.headers.get('Content-Length', 0))
+            if length < 0 :
+                raise ValueError('invalid Content-Length ' + str(length))
+            body = self.rfile.read(length).decode('utf8')
+            if is_json :
+                request = json.loads(body)
+                if not isinstance(request, dict) :
+                    raise ValueError('expected a JSON object')
+                sentences = request['sentences'] if 'sentences' in request else [request['sentence']]
+                if not isinstance(sentences, list) or not all(isinstance(sentence, str) for sentence in sentences) :
+                    raise ValueError('"sentences" must be a list of strings and "sentence" a string')
+            else :
+                sentences = body.splitlines()
+            sentences = [ sentence.strip().split() for sentence in sentences ]
+        except (ValueError, KeyError, TypeError, AttributeError) as error :
+            self._send(400, {'error':str(error)})
+            return
+        try :
+            translations = [ [] for sentence in sentences ]
+            indices = [ index for index, sentence in enumerate(sentences) if len(sentence) > 0 ]
+            for index, translation in zip(indices, self.server.batcher.translate([ sentences[index] for index in indices ])) :
+                translations[index] = translation
+        except Exception as error :
+            self._send(500, {'error':'translation failed : %s' % error})
+            return
+        translations = [ ' '.join(translation) for translation in translations ]
+        if is_json :
+            self._send(200, {'translations':translations})
+        else :
+            self._send(200, ''.join(translation + '\n' for translation in translations), 'text/plain')
+        self.server.latencies.add(perf_counter() - start)
+
+    def log_message(self, format, *args) :
+        if self.server.verbose :
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+class translation_server(ThreadingHTTPServer) :
+    '''
+        Resident HTTP translation service
+
+        The models are loaded once by the caller and every request thread hands its sentences
+        to a shared micro_batcher, which calls the decoder for batches of concurrent sentences.
+    '''
+    daemon_threads = True
+    request_queue_size = 128 # listen backlog for bursts of concurrent clients
+
+    def __init__(self, address, decode, max_batch=32, max_wait=0.005, cache=None, verbose=False) :
+        '''
+            arguments
+                address : (host, port)
+                decode : function [[foreign tokens]] -> [[translated tokens]]
+                max_batch=32, max_wait=0.005 : micro-batching limits (see micro_batcher)
+                cache=None : decoder_cache used by decode (only reported in the statistics)
+        '''
+        ThreadingHTTPServer.__init__(self, address, _request_handler)
+        self.batcher = micro_batcher(decode, max_batch, max_wait)
+        self.latencies = latency_tracker()
+        self.cache = cache
+        self.verbose = verbose
+
+    def get_stats(self) :
+        res = {'latency_ms':self.latencies.get_percentiles(), 'batches':self.batcher.batches, 'sentences':self.batcher.sentences}
+        res['mean_batch_size'] = self.batcher.sentences/self.batcher.batches if self.batcher.batches > 0 else 0.
+        if self.cache is not None :
+            res['cache'] = self.cache.get_stats()
+        return res
+
+    def server_close(self) :
+        ThreadingHTTPServer.server_close(self)
+        self.batcher.close()
+
+#
+# functions
+#
+
+def serve(decode, host='127.0.0.1', port=8080, max_batch=32, max_wait=0.005, cache=None, verbose=False) :
+    '''
+        runs a translation_server until it is interrupted
+
+        arguments
+            decode : function [[foreign tokens]] -> [[translated tokens]] using the loaded models
+            host='127.0.0.1', port=8080 : listening address
+            max_batch=32, max_wait=0.005 : micro-batching limits (see micro_batcher)
+            cache=None : decoder_cache used by decode
+    '''
+    server = translation_server((host, port), decode, max_batch, max_wait, cache, verbose)
+    if verbose : print(" - serving translations on http://%s:%d/translate - " % server.server_address[:2])
+    try :
+        server.serve_forever()
+    except KeyboardInterrupt :
+        pass
+    finally :
+        server.server_close()
+        if verbose :
+            print()
+            print(json.dumps(server.get_stats()))
@@ -1,53 +1,164 @@
 #!/bin/usr/python3
-import argparse
+import os, argparse
 from utils import *
 from models import *
 from decoders import *
 
 # argument parsing
 arg_parser = argparse.ArgumentParser(description='performs training and decoding steps for the smt system')
-arg_parser.add_argument('corpus_parallel', help='path to the parallel corpus')
-arg_parser.add_argument('corpus_lm', help='path to the language model corpus')
-arg_parser.add_argument('corpus_foreign', help='path to the foreign corpus')
-arg_parser.add_argument('out_prefix', help='output prefix')
+arg_parser.add_argument('--metrics', default=None, help='appends the progress metrics of all stages as JSON lines to this file')
+arg_parser.add_argument('--train-cache', default=os.path.join(os.path.expanduser('~'), '.cache', 'smu'), help='directory of the training cache of Model 1 to 3 and language model tables')
+arg_parser.add_argument('--train-cache-size', type=float, default=2048, help='maximum size of the training cache in MB (least recently used entries are evicted)')
+arg_parser.add_argument('--no-train-cache', action='store_true', help='neither loads nor stores trained tables in the training cache')
+arg_subparsers = arg_parser.add_subparsers(dest='command', metavar='command')
+arg_subparsers.required = True
+
+arg_train_tm = arg_subparsers.add_parser('train-tm', help='trains the translation model (IBM Model 3)')
+arg_train_tm.add_argument('corpus_parallel', help='path to the parallel corpus')
+arg_train_tm.add_argument('out_prefix', help='output prefix')
+arg_train_tm.add_argument('--iterations', type=int, default=2, help='maximum number of Model 3 iterations (Model 1 and 2 use twice as many)')
+arg_train_tm.add_argument('--tolerance', type=float, default=None, help='stops a model early when the relative improvement of its corpus log-likelihood falls below this value')
+arg_train_tm.add_argument('--samples', type=int, default=64, help='maximum number of sampled Model 3 alignments per sentence pair')
+arg_train_tm.add_argument('--sample-time', type=float, default=0.5, help='maximum seconds spent on sampling the Model 3 alignments of a sentence pair')
+arg_train_tm.add_argument('--sample-pegged', type=int, default=4, help='number of target positions every source position is pegged to when sampling')
+arg_train_tm.add_argument('--workers', type=int, default=None, help='number of processes for the Model 1 and 2 E-steps')
+arg_train_tm.add_argument('--backend', choices=['python', 'numpy'], default='python', help='Model 1 and 2 backend, numpy runs length-grouped array E-steps (requires numpy, ignores --workers and --checkpoint)')
+arg_train_tm.add_argument('--checkpoint', default=None, help='checkpoint prefix, written after every iteration and resumed from (default: out_prefix)')
+arg_train_tm.add_argument('--cache', action='store_true', help='encode the corpus once into a memory-mapped ".smuc" cache')
+arg_train_tm.add_argument('--prune-threshold', type=float, default=-10, help='removes options with a log probability <= threshold')
+arg_train_tm.add_argument('--prune-top-k', type=int, default=None, help='keeps the k most probable options per context')
+arg_train_tm.add_argument('--prune-mass', type=float, default=None, help='keeps the most probable options per context up to this cumulative probability')
+arg_train_tm.add_argument('--renormalize', action='store_true', help='renormalizes the distributions after pruning')
+arg_train_tm.add_argument('--quantize', action='store_true', help='stores the probabilities of the binary translation model as 8 bit codes of a codebook per table')
+arg_train_tm.add_argument('--init', default=None, metavar='MODEL', help='continues training from the t, d, f tables of a saved translation model (".smum") instead of training Model 1 and 2')
+arg_train_tm.add_argument('--init-weight', type=float, default=0., help='number of pseudo-counts per context of the initial tables (0: re-estimate from the corpus only)')
+arg_train_tm.add_argument('--old-corpus', default=None, help='parallel corpus of the initial model, a sample of it is mixed into the training corpus')
+arg_train_tm.add_argument('--old-sample', type=float, default=0.1, help='fraction of the old corpus mixed into the training corpus')
+
+arg_train_lm = arg_subparsers.add_parser('train-lm', help='trains the n-gram language model')
+arg_train_lm.add_argument('corpus_lm', help='path to the language model corpus')
+arg_train_lm.add_argument('out_prefix', help='output prefix')
+arg_train_lm.add_argument('--order', type=int, default=3, help='maximum n-gram length')
+arg_train_lm.add_argument('--cache', action='store_true', help='encode the corpus once into a memory-mapped ".smuc" cache')
+
+arg_decoding = argparse.ArgumentParser(add_help=False) # options shared by decode and serve
+arg_decoding.add_argument('--tm', default=None, help='translation model file (default: out_prefix + "_tm.smum")')
+arg_decoding.add_argument('--lm', default=None, help='language model file (default: out_prefix + "_lm.smlm")')
+arg_decoding.add_argument('--memoize', type=int, nargs=3, default=None, metavar=('SENTENCES', 'CANDIDATES', 'LM'), help='LRU cache sizes for translations, candidate lists and language model scores')
+arg_decoding.add_argument('--decoder', choices=['model3', 'beam'], default='model3', help='greedy model 3 decoder or beam search stack decoder')
+arg_decoding.add_argument('--beam-width', type=int, default=16, help='maximum number of hypotheses per stack of the beam decoder')
+arg_decoding.add_argument('--distortion-limit', type=int, default=4, help='maximum reordering distance of the beam decoder')
+arg_decoding.add_argument('--workers', type=int, default=None, help='number of processes decoding chunks of sentences in parallel (forked once and reused)')
+arg_decoding.add_argument('--lm-weights', type=float, nargs='+', default=[0, 0.6, 0.4], help='interpolation weights of the 1..n-gram probabilities')
+
+arg_decode = arg_subparsers.add_parser('decode', parents=[arg_decoding], help='translates a foreign corpus using saved models')
+arg_decode.add_argument('corpus_foreign', help='path to the foreign corpus')
+arg_decode.add_argument('out_prefix', help='output prefix')
+
+arg_serve = arg_subparsers.add_parser('serve', parents=[arg_decoding], help='serves translations over HTTP using saved models')
+arg_serve.add_argument('out_prefix', help='output prefix of the saved models')
+arg_serve.add_argument('--host', default='127.0.0.1', help='listening address')
+arg_serve.add_argument('--port', type=int, default=8080, help='listening port')
+arg_serve.add_argument('--max-batch', type=int, default=32, help='maximum number of sentences decoded together')
+arg_serve.add_argument('--max-wait', type=float, default=5, help='maximum time in milliseconds a sentence waits for further sentences of its batch')
+arg_invalidate = arg_subparsers.add_parser('invalidate-cache', help='removes entries from the training cache')
+arg_invalidate.add_argument('--stage', nargs='+', choices=['model1', 'model2', 'model3', 'lm'], default=None, help='only removes the entries of these stages')
+arg_invalidate.add_argument('--corpus', default=None, help='only removes the entries trained on the content of this corpus')
 args = arg_parser.parse_args()
 
-print(" - translating from scratch - ")
-print()
-print("importing parallel corpus...")
-corpus_ef = corpus_parallel(args.corpus_parallel)
-prob_model3 = train_model3(corpus_ef, 2, verbose=True)
-corpus_ef = None
-print("loading probability distributions...")
-dist_t = distribution(prob_model3[0])
-dist_d = distribution(prob_model3[1])
-dist_f = distribution(prob_model3[2])
-prob_p0 = prob_model3[3]
-print("pruning probability distributions...")
-dist_t.prune_probability(-10)
-dist_d.prune_probability(-10)
-dist_f.prune_probability(-10)
-print("exporting probabilities (for safety)...")
-export_probabilities(dist_t.get_probabilities(),args.out_prefix+"_t_export.txt")
-export_probabilities(dist_d.get_probabilities(),args.out_prefix+"_d_export.txt")
-export_probabilities(dist_f.get_probabilities(),args.out_prefix+"_f_export.txt")
-export_probabilities({"p0":prob_p0},args.out_prefix+"_p0_export.txt")
-print()
-
-print("importing language model corpus...")
-corpus_lm = corpus(args.corpus_lm)
-prob_lm = train_lm(corpus_lm, 3, verbose=True)
-corpus_lm = None
-print("exporting probabilities (for safety)...")
-export_probabilities(prob_lm[1],args.out_prefix+"_lm1_export.txt")
-export_probabilities(prob_lm[2],args.out_prefix+"_lm2_export.txt")
-export_probabilities(prob_lm[3],args.out_prefix+"_lm3_export.txt")
-print()
-
-print("importing foreign corpus...")
-corpus_f = corpus(args.corpus_foreign)
-res = decode_model3_lm(corpus_f, dist_t, dist_d, dist_f, prob_p0, prob_lm, {1:0, 2:0.6, 3:0.4}, verbose=True)
-print("exporting output...")
-export_sentences(res, args.out_prefix+"_output.txt")
-print()
-print(" - translation complete - ")
+monitor = progress_monitor([console_callback()])
+if args.metrics :
+    monitor.add_callback(jsonl_callback(args.metrics))
+train_cache = None
+if ((args.command in ['train-tm', 'train-lm']) and (not args.no_train_cache)) or (args.command == 'invalidate-cache') :
+    train_cache = training_cache(args.train_cache, int(args.train_cache_size * (1<<20)))
+    if (args.command != 'invalidate-cache') and (args.train_cache == arg_parser.get_default('train_cache')) :
+        print("training cache in %s (--train-cache DIR to move, --no-train-cache to disable)" % args.train_cache)
+
+if args.command == 'train-tm' :
+    print(" - training translation model - ")
+    print()
+    path_parallel = args.corpus_parallel
+    if args.old_corpus :
+        print("mixing in a sample of the old corpus...")
+        path_parallel = args.out_prefix+"_mixed.de-en"
+        mixed = mix_corpora(args.corpus_parallel, args.old_corpus, path_parallel, sample=args.old_sample)
+        print("%d new and %d old sentence pairs" % (mixed['new'], mixed['old']))
+    init = {}
+    if args.init :
+        print("loading initial translation model...")
+        model_init = import_model(args.init)
+        init = {'init_t':model_init['t'], 'init_d':model_init['d'], 'init_f':model_init['f'], 'init_weight':args.init_weight}
+    print("importing parallel corpus...")
+    corpus_ef = corpus_parallel(path_parallel, cache=args.cache)
+    checkpoint = args.checkpoint if args.checkpoint else args.out_prefix
+    prob_model3 = train_model3(corpus_ef, args.iterations, verbose=True, samples=args.samples, sample_time=args.sample_time, sample_pegged=args.sample_pegged, backend=args.backend, workers=args.workers, checkpoint=checkpoint, monitor=monitor, train_cache=train_cache, tolerance=args.tolerance, **init)
+    corpus_ef = None
+    print("loading probability distributions...")
+    dist_t = distribution(prob_model3[0])
+    dist_d = distribution(prob_model3[1])
+    dist_f = distribution(prob_model3[2])
+    prob_p0 = prob_model3[3]
+    print("pruning probability distributions...")
+    for name, dist in [('t', dist_t), ('d', dist_d), ('f', dist_f)] :
+        pruned = dist.prune(threshold=args.prune_threshold, top_k=args.prune_top_k, mass=args.prune_mass, renormalize=args.renormalize)
+        print("%s : removed %d options (%d bytes saved)" % (name, pruned["removed"], pruned["bytes"]))
+    print("exporting probabilities...")
+    export_probabilities(dist_t.get_probabilities(),args.out_prefix+"_t_export.txt")
+    export_probabilities(dist_d.get_probabilities(),args.out_prefix+"_d_export.txt")
+    export_probabilities(dist_f.get_probabilities(),args.out_prefix+"_f_export.txt")
+    export_probabilities({"p0":prob_p0},args.out_prefix+"_p0_export.txt")
+    export_model(args.out_prefix+"_tm.smum", {'t':dist_t.table, 'd':dist_d.table, 'f':dist_f.table}, {'p0':prob_p0}, value_type='B' if args.quantize else 'd')
+    remove_checkpoints(checkpoint)
+    print()
+    print(" - training complete - ")
+
+elif args.command == 'train-lm' :
+    print(" - training language model - ")
+    print()
+    print("importing language model corpus...")
+    corpus_lm = corpus(args.corpus_lm, cache=args.cache)
+    prob_lm = train_lm(corpus_lm, args.order, verbose=True, monitor=monitor, train_cache=train_cache)
+    corpus_lm = None
+    print("exporting probabilities...")
+    for n in prob_lm :
+        export_probabilities(prob_lm[n],args.out_prefix+"_lm"+str(n)+"_export.txt")
+    export_lm(args.out_prefix+"_lm.smlm", prob_lm)
+    print()
+    print(" - training complete - ")
+
+elif args.command == 'invalidate-cache' :
+    fingerprint = train_cache.get_fingerprint(args.corpus) if args.corpus else None
+    removed = train_cache.invalidate(args.stage, fingerprint)
+    stats = train_cache.get_stats()
+    print("removed %d entries, %d entries (%.1f MB) remain in %s" % (removed, stats['entries'], stats['bytes'] / (1<<20), args.train_cache))
+
+elif args.command in ['decode', 'serve'] :
+    print(" - decoding - " if args.command == 'decode' else " - serving - ")
+    print()
+    print("loading models...")
+    model_tm = import_model(args.tm if args.tm else args.out_prefix+"_tm.smum")
+    dist_t = model_tm['t']
+    dist_d = model_tm['d']
+    dist_f = model_tm['f']
+    prob_p0 = model_tm['p0']
+    prob_lm = import_lm(args.lm if args.lm else args.out_prefix+"_lm.smlm")
+    lm_weights = { n+1 : weight for n, weight in enumerate(args.lm_weights) }
+    cache = decoder_cache(*args.memoize) if args.memoize else None
+    def iter_decode(sentences, verbose=False, workers=None) :
+        if args.decoder == 'beam' :
+            return iter_decode_beam(sentences, dist_t, dist_d, dist_f, prob_p0, prob_lm, lm_weights, beam_width=args.beam_width, distortion_limit=args.distortion_limit, verbose=verbose, workers=workers, cache=cache, monitor=monitor if verbose else None)
+        return iter_decode_model3_lm(sentences, dist_t, dist_d, dist_f, prob_p0, prob_lm, lm_weights, verbose=verbose, workers=workers, cache=cache, monitor=monitor if verbose else None)
+    if args.command == 'serve' :
+        from server import serve
+        serve(lambda sentences : list(iter_decode(sentences, workers=args.workers)), args.host, args.port, args.max_batch, args.max_wait/1000., cache=cache, verbose=True)
+    else :
+        print("importing foreign corpus...")
+        corpus_f = corpus(args.corpus_foreign)
+        print("decoding and exporting output...")
+        export_sentences(iter_decode(corpus_f, verbose=True, workers=args.workers), args.out_prefix+"_output.txt")
+        if cache is not None :
+            for level, stats in cache.get_stats().items() :
+                print("%s cache : %d hits, %d misses (%.1f%%), %d of %d entries" % (level, stats['hits'], stats['misses'], 100*stats['hit_rate'], stats['size'], stats['max_size']))
+        print()
+        print(" - translation complete - ")
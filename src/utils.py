@@ -1,21 +1,150 @@
 '''
     Utilities for the SMT System
 '''
+import os, sys, json, mmap, struct, heapq, pickle, random, hashlib, threading
+from math import log, exp
+from bisect import bisect_left, bisect_right
+from time import perf_counter, time as wall_time
+from array import array
+from itertools import islice, accumulate
+from collections import OrderedDict
+from collections.abc import Mapping, Sequence
+
 #
 # classes
 #
 
+class corpus_cache :
+    '''
+        Memory-mapped, integer encoded corpus cache
+
+        The text corpus is parsed once, every side (1 for monolingual, 2 for parallel corpora)
+        gets its own vocabulary and the token ids and sentence offsets are written to a binary
+        file which is memory-mapped on subsequent runs. Token id 0 is reserved for the null token "".
+
+        sections (see _write_sectioned)
+            per side : vocabulary (utf8, newline separated), sentence offsets (uint64), token ids (uint32)
+    '''
+    MAGIC = b'SMUC'
+    VERSION = 1
+
+    def __init__(self, cache_path) :
+        self.cache_path = cache_path
+        self.mmap, self.header, sections = _read_sectioned(cache_path, corpus_cache.MAGIC, corpus_cache.VERSION)
+        self.sentence_count = self.header['sentences']
+        self.vocab = []
+        self.offsets = []
+        self.tokens = []
+        for side in range(self.header['side_count']) :
+            vocab, offsets, tokens = sections[side*3:side*3+3]
+            self.vocab.append(bytes(vocab).decode('utf8').split('\n'))
+            self.offsets.append(offsets.cast('Q'))
+            self.tokens.append(tokens.cast('I'))
+
+    def __len__(self) :
+        return self.sentence_count
+
+    def get_ids(self, index, side) :
+        '''
+            returns a memoryview of the token ids of a sentence (no copy)
+        '''
+        offsets = self.offsets[side]
+        return self.tokens[side][offsets[index]:offsets[index+1]]
+
+    def get_tokens(self, index, side) :
+        '''
+            returns the tokens of a sentence as a list of (interned) strings
+        '''
+        vocab = self.vocab[side]
+        return [ vocab[token_id] for token_id in self.get_ids(index, side) ]
+
+    def iter_ids(self) :
+        '''
+            iterates over all sentences as tuples of token id memoryviews (one per side)
+        '''
+        sides = range(len(self.tokens))
+        for index in range(self.sentence_count) :
+            yield tuple(self.get_ids(index, side) for side in sides)
+
+    @staticmethod
+    def _source_stamp(path) :
+        stat = os.stat(path)
+        return [stat.st_size, stat.st_mtime_ns]
+
+    @staticmethod
+    def open(path, cache_path=None, sides=1) :
+        '''
+            opens the cache of a corpus, (re)building it if it is missing or outdated
+            arguments
+                path : path to the text corpus
+                cache_path=None : path to the cache file (default: path + ".smuc")
+                sides=1 : number of "|||" separated sides per line
+        '''
+        if cache_path is None :
+            cache_path = path + '.smuc'
+        try :
+            res = corpus_cache(cache_path)
+            if (res.header['source'] == corpus_cache._source_stamp(path)) and (res.header['side_count'] == sides) :
+                return res
+        except (IOError, ValueError, KeyError, struct.error) :
+            pass
+        return corpus_cache.build(path, cache_path, sides)
+
+    @staticmethod
+    def build(path, cache_path, sides=1) :
+        '''
+            encodes a text corpus and writes it to a cache file
+        '''
+        lookups = [ {'' : 0} for side in range(sides) ]
+        offsets = [ array('Q', [0]) for side in range(sides) ]
+        tokens = [ array('I') for side in range(sides) ]
+        sentence_count = 0
+        with open(path, 'r', encoding='utf8') as fop :
+            for raw_line in fop :
+                sentences = raw_line.split('|||') if sides > 1 else [raw_line]
+                for side in range(sides) :
+                    lookup = lookups[side]
+                    side_tokens = tokens[side]
+                    for token in sentences[side].strip().split() :
+                        token_id = lookup.get(token)
+                        if token_id is None :
+                            token_id = len(lookup)
+                            lookup[token] = token_id
+                        side_tokens.append(token_id)
+                    offsets[side].append(len(side_tokens))
+                sentence_count += 1
+        # serialize sections
+        sections = []
+        header = {'source' : corpus_cache._source_stamp(path), 'sentences' : sentence_count, 'side_count' : sides}
+        for side in range(sides) :
+            vocab = sorted(lookups[side], key=lookups[side].get)
+            sections += ['\n'.join(vocab).encode('utf8'), offsets[side].tobytes(), tokens[side].tobytes()]
+        _write_sectioned(cache_path, corpus_cache.MAGIC, corpus_cache.VERSION, header, sections)
+        return corpus_cache(cache_path)
+
 class corpus :
     '''
         Corpus helper class
     '''
-    def __init__(self, path) :
+    def __init__(self, path, cache=False) :
+        '''
+            arguments
+                path : path to the corpus
+                cache=False : True or a cache path to iterate over a memory-mapped corpus_cache
+        '''
         self.path = path
         self.line_count = 0
         self.lines_counted = False
         self.fop = None
         self.file_iter = None
         self.iter_line = None
+        self.cache = None
+        self.iter_index = 0
+        if cache :
+            self.cache = corpus_cache.open(path, cache if isinstance(cache, str) else None, sides=1)
+            self.line_count = len(self.cache)
+            self.lines_counted = True
+            return
         try :
             self.fop = open(path, 'r', encoding='utf8')
             self.file_iter = iter(self.fop)
@@ -34,6 +163,11 @@ class corpus :
         return self
 
     def __next__(self) :
+        if self.cache is not None :
+            if self.iter_index >= len(self.cache) :
+                raise StopIteration
+            self.iter_index += 1
+            return self.cache.get_tokens(self.iter_index-1, 0)
         res = self.iter_line
         try :
             self.iter_line = next(self.file_iter)
@@ -50,7 +184,45 @@ class corpus :
     def __len__(self) :
         return self.line_count
 
+    def iter_encoded(self) :
+        '''
+            iterates over the sentences as memoryviews of token ids (requires cache)
+        '''
+        for index in range(len(self.cache)) :
+            yield self.cache.get_ids(index, 0)
+
+    def iter_range(self, start, stop) :
+        '''
+            iterates over the sentences with line indices in [start, stop) independently of the main iterator
+        '''
+        if self.cache is not None :
+            for index in range(start, min(stop, len(self.cache))) :
+                yield self.cache.get_tokens(index, 0)
+            return
+        with open(self.path, 'r', encoding='utf8') as fop :
+            for raw_line in islice(fop, start, stop) :
+                yield raw_line.strip().split()
+
+    def get_shards(self, shard_size) :
+        '''
+            returns the line ranges [(start, stop), ...] of at most shard_size sentences covering the corpus
+        '''
+        if not self.lines_counted :
+            with open(self.path, 'r', encoding='utf8') as fop :
+                self.line_count = sum(1 for raw_line in fop)
+            self.lines_counted = True
+        return [ (start, min(start+shard_size, self.line_count)) for start in range(0, self.line_count, shard_size) ]
+
+    def get_reader_args(self) :
+        '''
+            returns the constructor arguments of an independent reader (e.g. for worker processes)
+        '''
+        return (self.path, self.cache.cache_path if self.cache is not None else False)
+
     def reset_iter(self) :
+        if self.cache is not None :
+            self.iter_index = 0
+            return
         try :
             self.fop.close()
             self.fop = open(self.path, 'r', encoding='utf8')
@@ -69,13 +241,30 @@ class corpus_parallel :
     '''
         Parallel corpus helper class
     '''
-    def __init__(self, path) :
+    def __init__(self, path, cache=False) :
+        '''
+            arguments
+                path : path to the parallel corpus
+                cache=False : True or a cache path to iterate over a memory-mapped corpus_cache
+        '''
         self.path = path
         self.pair_count = 0
         self.pairs_counted = False
         self.fop = None
         self.file_iter = None
         self.iter_pair = None
+        self.cache = None
+        self.iter_index = 0
+        self._unique_token_pairs = None
+        self._count_unique_e = None
+        self._count_unique_f = None
+        if cache :
+            self.cache = corpus_cache.open(path, cache if isinstance(cache, str) else None, sides=2)
+            self.pair_count = len(self.cache)
+            self.pairs_counted = True
+            self._count_unique_f = len(self.cache.vocab[0]) - 1 # exclude null token
+            self._count_unique_e = len(self.cache.vocab[1]) - 1
+            return
         try :
             self.fop = open(path, 'r', encoding='utf8')
             self.file_iter = iter(self.fop)
@@ -89,14 +278,16 @@ class corpus_parallel :
             if self.fop :
                 self.fop.close()
             print('Error : IOError occured while opening "' + path + '"')
-        self._unique_token_pairs = None
-        self._count_unique_e = None
-        self._count_unique_f = None
 
     def __iter__(self) :
         return self
 
     def __next__(self) :
+        if self.cache is not None :
+            if self.iter_index >= len(self.cache) :
+                raise StopIteration
+            self.iter_index += 1
+            return [self.cache.get_tokens(self.iter_index-1, 0), self.cache.get_tokens(self.iter_index-1, 1)]
         res = self.iter_pair
         if res is None :
             raise StopIteration
@@ -113,6 +304,40 @@ class corpus_parallel :
     def __len__(self) :
         return self.pair_count
 
+    def iter_encoded(self) :
+        '''
+            iterates over the pairs as (ids_f, ids_e) memoryviews of token ids (requires cache)
+        '''
+        return self.cache.iter_ids()
+
+    def iter_range(self, start, stop) :
+        '''
+            iterates over the pairs with line indices in [start, stop) independently of the main iterator
+        '''
+        if self.cache is not None :
+            for index in range(start, min(stop, len(self.cache))) :
+                yield [self.cache.get_tokens(index, 0), self.cache.get_tokens(index, 1)]
+            return
+        with open(self.path, 'r', encoding='utf8') as fop :
+            for raw_line in islice(fop, start, stop) :
+                yield [ sentence.strip().split() for sentence in raw_line.split("|||") ]
+
+    def get_shards(self, shard_size) :
+        '''
+            returns the line ranges [(start, stop), ...] of at most shard_size pairs covering the corpus
+        '''
+        if not self.pairs_counted :
+            with open(self.path, 'r', encoding='utf8') as fop :
+                self.pair_count = sum(1 for raw_line in fop)
+            self.pairs_counted = True
+        return [ (start, min(start+shard_size, self.pair_count)) for start in range(0, self.pair_count, shard_size) ]
+
+    def get_reader_args(self) :
+        '''
+            returns the constructor arguments of an independent reader (e.g. for worker processes)
+        '''
+        return (self.path, self.cache.cache_path if self.cache is not None else False)
+
     def get_token_pairs(self) :
         res = None
         if self._unique_token_pairs is None :
@@ -135,6 +360,9 @@ class corpus_parallel :
         return res
 
     def _get_unique(self) :
+        if self.cache is not None :
+            self._get_unique_cached()
+            return
         unique_token_pairs = set()
         unique_tokens_e = set()
         unique_tokens_f = set()
@@ -153,7 +381,20 @@ class corpus_parallel :
         self._count_unique_e = len(unique_tokens_e)
         self._count_unique_f = len(unique_tokens_f)
 
+    def _get_unique_cached(self) :
+        # collect the co-occurring token ids from the cache and decode them once
+        unique_id_pairs = set()
+        for ids_f, ids_e in self.iter_encoded() :
+            for id_e in ids_e :
+                for id_f in ids_f :
+                    unique_id_pairs.add((id_e, id_f))
+        vocab_f, vocab_e = self.cache.vocab
+        self._unique_token_pairs = set((vocab_e[id_e], vocab_f[id_f]) for id_e, id_f in unique_id_pairs)
+
     def reset_iter(self) :
+        if self.cache is not None :
+            self.iter_index = 0
+            return
         try :
             self.fop.close()
             self.fop = open(self.path, 'r', encoding='utf8')
@@ -168,36 +409,307 @@ class corpus_parallel :
                 self.fop.close()
             print('Error : IOError occured while opening "' + self.path + '"')
 
+class token_vocabulary :
+    '''
+        Interned strings of compact_tables, token ids are assigned in the order of first occurrence
+    '''
+    def __init__(self, tokens=None) :
+        self.tokens = []
+        self.ids = {}
+        for token in (tokens or []) :
+            self.add(token)
+
+    def __len__(self) :
+        return len(self.tokens)
+
+    def add(self, token) :
+        '''
+            returns the id of token, which is added if it is new
+        '''
+        res = self.ids.get(token)
+        if res is None :
+            res = len(self.tokens)
+            self.tokens.append(token)
+            self.ids[token] = res
+        return res
+
+    def get_id(self, token) :
+        return self.ids.get(token)
+
+    def get_token(self, token_id) :
+        return self.tokens[token_id]
+
+class options_view(Sequence) :
+    '''
+        Read-only view of a range of ranked rows of a table (without copying)
+
+        The rows are a memoryview slice of the ranking of the table and an option (arg, prob) is only decoded
+        when it is accessed, so top_k costs the binary search of the context and nothing per option.
+    '''
+    __slots__ = ('rows', 'get_option')
+
+    def __init__(self, rows, get_option) :
+        '''
+            arguments
+                rows : memoryview of row indices
+                get_option : function row => (arg, prob)
+        '''
+        self.rows = rows
+        self.get_option = get_option
+
+    def __len__(self) :
+        return len(self.rows)
+
+    def __getitem__(self, index) :
+        if isinstance(index, slice) :
+            return options_view(self.rows[index], self.get_option)
+        return self.get_option(self.rows[index])
+
+    def __iter__(self) :
+        get_option = self.get_option
+        for row in self.rows :
+            yield get_option(row)
+
+class compact_table(Mapping) :
+    '''
+        Read-only probability table of packed integer keys and float32 values
+
+        Like model_table, p(arg|given) with key = (arg,)+given is stored ordered by (given, arg), but every key
+        is packed into one 64 bit integer of its column ids (strings are interned in a token_vocabulary),
+        e.g. t[(e,f)] => packed_keys[row] = id(f) << bits(e) | id(e). Lookups are binary searches over the sorted keys,
+        the options of a context are one contiguous range of rows and a permutation of the rows orders the
+        options of every context by probability. An entry takes 16 bytes (13 bytes with quantized values)
+        instead of more than 100 bytes for a dict entry of a key tuple and a float.
+    '''
+    def __init__(self, probabilities, vocab=None, value_type='f') :
+        '''
+            arguments
+                probabilities : {key tuple : prob} (all keys have the same length and column types)
+                vocab=None : token_vocabulary shared with other tables (a new one by default)
+                value_type='f' : 'f' (float32) or 'd' (float64) values
+        '''
+        self.vocab = vocab if vocab is not None else token_vocabulary()
+        self.value_type = value_type
+        self.codebook = None
+        # stored key order : given columns, arg column
+        arity = len(next(iter(probabilities))) if len(probabilities) > 0 else 0
+        positions = list(range(1, arity)) + [0][:arity]
+        columns = [ array('q') for position in positions ]
+        column_types = [ set() for position in positions ]
+        for key in probabilities.keys() :
+            for column, types, position in zip(columns, column_types, positions) :
+                item = key[position]
+                types.add(type(item))
+                column.append(self.vocab.add(item) if isinstance(item, str) else item)
+        self.kinds = []
+        for index, types in enumerate(column_types) :
+            if types == set([str]) :
+                self.kinds.append('s')
+            elif types == set([int]) :
+                self.kinds.append('i')
+            else :
+                raise ValueError('column ' + str(index) + ' mixes types ' + str(types))
+            if min(columns[index]) < 0 :
+                raise ValueError('column ' + str(index) + ' contains negative integers')
+        self.bits = [ max(max(column).bit_length(), 1) for column in columns ]
+        if sum(self.bits) > 64 :
+            raise ValueError('keys of ' + str(self.bits) + ' bits do not fit into 64 bits')
+        packed_keys = array('Q', [0]) * len(probabilities)
+        for column, bits in zip(columns, self.bits) :
+            for row, item in enumerate(column) :
+                packed_keys[row] = (packed_keys[row] << bits) | item
+        columns = None
+        probs = array(value_type, probabilities.values())
+        rows = sorted(range(len(packed_keys)), key=packed_keys.__getitem__)
+        self._set_rows(array('Q', [ packed_keys[row] for row in rows ]), array(value_type, [ probs[row] for row in rows ]))
+
+    def _set_rows(self, packed_keys, probs, codebook=None) :
+        # the permutation orders the rows of every context by descending probability
+        self.packed_keys = packed_keys
+        self.probs = probs
+        self.codebook = codebook
+        self.arg_mask = (1 << self.bits[-1]) - 1 if self.bits else 0
+        self.order = array('I')
+        for start, end in self.iter_contexts() :
+            self.order.extend(sorted(range(start, end), key=lambda row: -self.get_value(row)))
+
+    def _encode(self, items) :
+        # packs the stored columns (prefix) items or returns None if an item is unknown
+        res = 0
+        for item, kind, bits in zip(items, self.kinds, self.bits) :
+            if kind == 's' :
+                item = self.vocab.get_id(item) if isinstance(item, str) else None
+            elif not isinstance(item, int) :
+                item = None
+            if (item is None) or (item < 0) or (item >> bits) :
+                return None
+            res = (res << bits) | item
+        return res
+
+    def _decode(self, row) :
+        packed = self.packed_keys[row]
+        res = []
+        for kind, bits in zip(reversed(self.kinds), reversed(self.bits)) :
+            item = packed & ((1 << bits) - 1)
+            res.append(self.vocab.get_token(item) if kind == 's' else item)
+            packed >>= bits
+        return (res[0],) + tuple(reversed(res[1:]))
+
+    def _decode_arg(self, row) :
+        item = self.packed_keys[row] & self.arg_mask
+        return self.vocab.tokens[item] if self.kinds[-1] == 's' else item
+
+    def _get_range(self, context) :
+        if (len(context) != len(self.kinds) - 1) or (len(self.kinds) < 1) :
+            return 0, 0
+        query = self._encode(context)
+        if query is None :
+            return 0, 0
+        arg_bits = self.bits[-1]
+        return bisect_left(self.packed_keys, query << arg_bits), bisect_left(self.packed_keys, (query+1) << arg_bits)
+
+    def _find(self, key) :
+        # row of key or None
+        if len(key) != len(self.kinds) :
+            return None
+        query = self._encode(tuple(key[1:]) + (key[0],))
+        if query is None :
+            return None
+        row = bisect_left(self.packed_keys, query)
+        if (row < len(self.packed_keys)) and (self.packed_keys[row] == query) :
+            return row
+        return None
+
+    def get_value(self, row) :
+        if self.codebook is None :
+            return self.probs[row]
+        return self.codebook[self.probs[row]]
+
+    def __getitem__(self, key) :
+        row = self._find(key)
+        if row is None :
+            raise KeyError(key)
+        return self.get_value(row)
+
+    def __contains__(self, key) :
+        return self._find(key) is not None
+
+    def __iter__(self) :
+        for row in range(len(self.packed_keys)) :
+            yield self._decode(row)
+
+    def __len__(self) :
+        return len(self.packed_keys)
+
+    def items(self) :
+        for row in range(len(self.packed_keys)) :
+            yield self._decode(row), self.get_value(row)
+
+    def get_probability(self, query) :
+        return self.get(tuple(query), 0.)
+
+    def get_probabilities(self) :
+        return dict(self.items())
+
+    def get_options(self, query) :
+        '''
+            returns a dict of options given a query p(res|query)
+        '''
+        start, end = self._get_range(query)
+        return { self._decode_arg(row) : self.get_value(row) for row in range(start, end) }
+
+    def get_options_sorted(self, query) :
+        '''
+            returns a list of options given a query p(res|query) sorted by p
+        '''
+        start, end = self._get_range(query)
+        return self._get_sorted(start, end)
+
+    def top_k(self, query, k) :
+        '''
+            returns an options_view of the k most probable options given a query p(res|query)
+        '''
+        start, end = self._get_range(query)
+        return options_view(memoryview(self.order)[start:min(start+k, end)], self._get_option)
+
+    def _get_option(self, row) :
+        return (self._decode_arg(row), self.get_value(row))
+
+    def _get_sorted(self, start, end) :
+        return [ self._get_option(row) for row in self.order[start:end] ]
+
+    def iter_contexts(self) :
+        '''
+            yields (start, end) of the rows of every context, the rows order[start:end] are sorted by probability
+        '''
+        arg_bits = self.bits[-1] if self.bits else 0
+        start = 0
+        for end in range(1, len(self.packed_keys)+1) :
+            if (end == len(self.packed_keys)) or (self.packed_keys[end] >> arg_bits != self.packed_keys[start] >> arg_bits) :
+                yield start, end
+                start = end
+
+    def select(self, rows, values=None) :
+        '''
+            returns a compact_table of the given rows (ascending) sharing the vocabulary
+            arguments
+                rows : row indices in ascending order
+                values=None : new values of the rows (default : current values, dequantized)
+        '''
+        res = compact_table.__new__(compact_table)
+        res.vocab = self.vocab
+        res.value_type = self.value_type
+        res.kinds = self.kinds
+        res.bits = self.bits
+        if values is None :
+            values = [ self.get_value(row) for row in rows ]
+        res._set_rows(array('Q', [ self.packed_keys[row] for row in rows ]), array(self.value_type, values))
+        return res
+
+    def quantize(self, levels=256) :
+        '''
+            replaces the values by 8 bit codes of a codebook with levels entries (see quantize_values)
+
+            returns {'bytes' : number of bytes saved, 'max_error' : maximum absolute error of a value}
+        '''
+        if self.codebook is not None :
+            return {'bytes':0, 'max_error':0.}
+        size = self.get_size()
+        probs = self.probs
+        codes, codebook = quantize_values(probs, levels)
+        self.probs, self.codebook = codes, codebook
+        max_error = max([ abs(codebook[code] - prob) for code, prob in zip(codes, probs) ] or [0.])
+        return {'bytes':size - self.get_size(), 'max_error':max_error}
+
+    def get_size(self) :
+        '''
+            returns the number of bytes of the key, value, order and codebook arrays
+        '''
+        res = len(self.packed_keys) * self.packed_keys.itemsize + len(self.probs) * self.probs.itemsize + len(self.order) * self.order.itemsize
+        if self.codebook is not None :
+            res += len(self.codebook) * self.codebook.itemsize
+        return res
+
 class distribution :
     '''
         Probability distribution helper class
     '''
-    def __init__(self, probabilities) :
-        # save probabilities in a lookup dict for much faster recall
-        # p(arg|given) => lookup[given] = [(arg, prob), ...]
-        self.lookup = {}
-        for probability in probabilities.keys() :
-            if probability[1:] in self.lookup :
-                self.lookup[probability[1:]].append((probability[0], probabilities[probability]))
-            else :
-                self.lookup[probability[1:]] = [(probability[0], probabilities[probability])]
+    def __init__(self, probabilities, vocab=None) :
+        # p(arg|given) is kept in a compact_table (rows ordered by (given, arg), options sorted by prob)
+        # probabilities may already be a compact_table (as returned by the trainers), which is shared
+        if isinstance(probabilities, compact_table) :
+            self.table = probabilities
+        else :
+            self.table = compact_table(probabilities, vocab)
 
     def get_probabilities(self) :
         '''
             returns a dict of all probabilities p[(arg|given)] = prob
         '''
-        res = {}
-        for key in self.lookup.keys() :
-            for option in self.lookup[key] :
-                res[(option[0],)+key] = option[1]
-        return res
+        return self.table.get_probabilities()
 
     def get_probability(self, query) :
-        res = 0.
-        options = self.get_options(query[1:])
-        if query[0] in options.keys() :
-            res = options[query[0]]
-        return res
+        return self.table.get_probability(query)
 
     def get_options(self, query) :
         '''
@@ -205,27 +717,184 @@ class distribution :
             arguments
                 query : tuple
         '''
-        res = {}
-        if query in self.lookup :
-            for option in self.lookup[query] :
-                res[(option[0])] = option[1]
-        return res
+        return self.table.get_options(query)
 
     def get_options_sorted(self, query) :
         '''
             returns a list of options given a query p(res|query) sorted by p
         '''
-        res = self.get_options(query)
-        return sorted(res.items(), key=lambda item: item[1], reverse=True)
+        return self.table.get_options_sorted(query)
+
+    def top_k(self, query, k) :
+        '''
+            returns an options_view of the k most probable options given a query p(res|query) (a binary search, options are decoded on access)
+        '''
+        return self.table.top_k(query, k)
 
     def prune_probability(self, threshold) :
         '''
             prunes options according to a probability threshold value
         '''
-        for key in self.lookup.keys() :
-            for index_option, option in enumerate(self.lookup[key]) :
-                if option[1] <= threshold :
-                    del(self.lookup[key][index_option])
+        return self.prune(threshold=threshold)
+
+    def prune(self, threshold=None, top_k=None, mass=None, renormalize=False, log_space=True) :
+        '''
+            prunes the options of every context, contexts without options are removed
+            arguments
+                threshold=None : removes options with a probability <= threshold
+                top_k=None : keeps the k most probable options per context (histogram pruning)
+                mass=None : keeps the most probable options until their cumulative probability reaches mass
+                renormalize=False : rescales the remaining options of every context to sum to one
+                log_space=True : whether the probabilities are log probabilities (as in the Model 3 tables)
+
+            returns {'removed' : number of removed options, 'bytes' : number of bytes saved}
+        '''
+        table = self.table
+        size = table.get_size()
+        kept = {}
+        for start, end in table.iter_contexts() :
+            options = [ (row, table.get_value(row)) for row in table.order[start:end] ] # sorted by probability
+            length = len(options)
+            if threshold is not None :
+                while (length > 0) and (options[length-1][1] <= threshold) :
+                    length -= 1
+            if top_k is not None :
+                length = min(length, top_k)
+            if mass is not None :
+                cumulative = 0.
+                for index_option in range(length) :
+                    cumulative += exp(options[index_option][1]) if log_space else options[index_option][1]
+                    if cumulative >= mass :
+                        length = index_option + 1
+                        break
+            del options[length:]
+            if renormalize and (length > 0) :
+                if log_space :
+                    norm = options[0][1] + log(sum(exp(option[1] - options[0][1]) for option in options))
+                    options = [ (option[0], option[1] - norm) for option in options ]
+                else :
+                    norm = sum(option[1] for option in options)
+                    options = [ (option[0], option[1] / norm) for option in options ]
+            kept.update(options)
+        rows = sorted(kept)
+        self.table = table.select(rows, [ kept[row] for row in rows ])
+        return {'removed' : len(table) - len(rows), 'bytes' : size - self.table.get_size()}
+
+    def quantize(self, levels=256) :
+        '''
+            quantizes the probabilities to 8 bit codes (see compact_table.quantize)
+        '''
+        return self.table.quantize(levels)
+
+class alignment_table(Mapping) :
+    '''
+        Alignment probabilities stored as one dense matrix per (length_e, length_f) bucket
+
+        a[(index_f, index_e, length_e, length_f)] => buckets[(length_e, length_f)][index_e*length_f + index_f]
+        buckets are created lazily and the table can be used like the former dict (read-only view)
+    '''
+    def __init__(self) :
+        self.buckets = {}
+
+    def get_bucket(self, length_e, length_f, init=0.) :
+        '''
+            returns the flat row-major (index_e, index_f) matrix of a bucket, creating it with init if needed
+        '''
+        res = self.buckets.get((length_e, length_f))
+        if res is None :
+            res = array('d', [init]) * (length_e * length_f)
+            self.buckets[(length_e, length_f)] = res
+        return res
+
+    def update(self, probabilities) :
+        '''
+            sets the given cells, new buckets are initialized uniformly as in the Model 2 E-step
+            arguments
+                probabilities : alignment_table or {(index_f, index_e, length_e, length_f) : prob}
+        '''
+        for (index_f, index_e, length_e, length_f), prob in probabilities.items() :
+            if (0 <= index_e < length_e) and (0 <= index_f < length_f) :
+                self.get_bucket(length_e, length_f, 1./(length_f+1))[index_e*length_f + index_f] = prob
+
+    def estimate(self, counts, prior=None, prior_weight=0.) :
+        '''
+            sets the buckets to the counts normalized per index_e row
+            arguments
+                counts : {(length_e, length_f) : flat count matrix}
+                prior=None : alignment_table whose buckets are added as prior_weight pseudo-counts per row
+                prior_weight=0. : weight of the prior
+        '''
+        for (length_e, length_f), count in counts.items() :
+            bucket = self.get_bucket(length_e, length_f)
+            prior_bucket = prior.buckets.get((length_e, length_f)) if (prior is not None) and (prior_weight > 0) else None
+            for row in range(0, length_e*length_f, length_f) :
+                total = sum(count[row:row+length_f])
+                prior_total = sum(prior_bucket[row:row+length_f]) if prior_bucket is not None else 0.
+                if prior_total <= 0 :
+                    for index in range(row, row+length_f) :
+                        bucket[index] = count[index] / total
+                    continue
+                for index in range(row, row+length_f) :
+                    bucket[index] = (count[index] + prior_weight * prior_bucket[index] / prior_total) / (total + prior_weight)
+
+    def __getitem__(self, key) :
+        index_f, index_e, length_e, length_f = key
+        bucket = self.buckets.get((length_e, length_f))
+        if (bucket is None) or not ((0 <= index_e < length_e) and (0 <= index_f < length_f)) :
+            raise KeyError(key)
+        return bucket[index_e*length_f + index_f]
+
+    def __iter__(self) :
+        for length_e, length_f in self.buckets :
+            for index_e in range(length_e) :
+                for index_f in range(length_f) :
+                    yield (index_f, index_e, length_e, length_f)
+
+    def __len__(self) :
+        return sum(len(bucket) for bucket in self.buckets.values())
+
+class stepwise_counts :
+    '''
+        Running sufficient statistics for stepwise (online) EM (Liang and Klein, 2009)
+
+        mu = (1 - eta_k) * mu + eta_k * s_k with eta_k = (k + offset)^-power for the statistics s_k
+        of the k-th mini-batch. mu is stored relative to a global scale, so that an update only
+        touches the entries of the batch. Values are floats or flat count matrices (arrays).
+    '''
+    def __init__(self, table_count, power=0.7, offset=2) :
+        self.tables = [ {} for index in range(table_count) ]
+        self.power = power
+        self.offset = offset
+        self.step = 0
+        self.scale = 1.
+
+    def update(self, batch_tables) :
+        self.step += 1
+        eta = (self.step + self.offset) ** -self.power
+        self.scale *= (1. - eta)
+        if self.scale < 1e-100 :
+            self._rescale()
+        weight = eta / self.scale
+        for table, batch_table in zip(self.tables, batch_tables) :
+            for key, value in batch_table.items() :
+                if not isinstance(value, array) :
+                    table[key] = table.get(key, 0.) + weight * value
+                elif key in table :
+                    cur_value = table[key]
+                    for index, update_c in enumerate(value) :
+                        cur_value[index] += weight * update_c
+                else :
+                    table[key] = array('d', [weight * update_c for update_c in value])
+
+    def _rescale(self) :
+        for table in self.tables :
+            for key, value in table.items() :
+                if isinstance(value, array) :
+                    for index in range(len(value)) :
+                        value[index] *= self.scale
+                else :
+                    table[key] = value * self.scale
+        self.scale = 1.
 
 class alignment :
     '''
@@ -245,6 +914,9 @@ class alignment :
         res = (self.token_alignments == other.token_alignments) and (self.length_e == other.length_e)
         return res
 
+    def __hash__(self) :
+        return hash((self.length_e, tuple(self.token_alignments)))
+
     def get_index_e(self, index_f) :
         return self.token_alignments[index_f]
 
@@ -263,24 +935,24 @@ class alignment :
 
     def get_neighbors(self, pegged) :
         res = []
-        token_alignments = []
+        seen = set([tuple(self.token_alignments)])
         for index_f in range(self.length_f) :
             if index_f != pegged :
                 for index_e in range(self.length_e) :
                     move_list = list(self.token_alignments)
                     move_list[index_f] = index_e
-                    if move_list not in res :
-                        token_alignments.append(move_list)
+                    if tuple(move_list) not in seen :
+                        seen.add(tuple(move_list))
+                        res.append(alignment(self.length_e, self.length_f, move_list))
         for index_f in range(self.length_f) :
-            for index_swap in range(self.length_f) :
-                if (index_f != index_swap) and (index_f != pegged) and (index_swap != pegged) :
+            for index_swap in range(index_f+1, self.length_f) :
+                if (index_f != pegged) and (index_swap != pegged) :
                     swap_list = list(self.token_alignments)
                     swap_list[index_swap] = self.token_alignments[index_f]
                     swap_list[index_f] = self.token_alignments[index_swap]
-                    if swap_list not in res :
-                        token_alignments.append(swap_list)
-        for token_alignment in token_alignments :
-            res.append(alignment(self.length_e, self.length_f, token_alignment))
+                    if tuple(swap_list) not in seen :
+                        seen.add(tuple(swap_list))
+                        res.append(alignment(self.length_e, self.length_f, swap_list))
         return res
 
     def hillclimb(self, prob_d, pegged) :
@@ -295,49 +967,1313 @@ class alignment :
                 res_prob = neighbor_prob
         return res
 
-#
-# functions
-#
-
-def export_probabilities(dist, path) :
-    '''
-        exports a distribution to text file
+class alignment_scorer :
     '''
-    with open(path, "w", encoding="utf8") as fop :
-        for key in dist.keys() :
-            fop_line = ""
-            for key_index in key :
-                fop_line += str(key_index) + " ||| "
-            fop_line += str(dist[key]) + "\n"
-            fop.write(fop_line)
+        Incremental Model 3 alignment scorer for a sentence pair
 
-def import_probabilities(path, datatype=str()) :
+        log p(a) = sum_j t(e_a_j, f_j) + d(a_j, j, l_e, l_f) + n(phi_j, f_j)
+        where phi_j is 0 for null alignments and 1 otherwise (as estimated in train_model3).
+        All terms are tabulated once per pair, so moves and swaps are scored by their delta in O(1).
+        Missing t or d entries make an alignment invalid (-inf).
     '''
-        imports a distribution from ||| separated text file
-        arguments
-            path : path to distribution file
-            datatype=str() : the type the entries should be cast to
+    def __init__(self, sentence_e, sentence_f, prob_t, prob_d, prob_f=None) :
+        self.length_e = len(sentence_e)
+        self.length_f = len(sentence_f)
+        self.cells = []
+        invalid = float('-inf')
+        for index_f, token_f in enumerate(sentence_f) :
+            fertility = [0., 0.]
+            if prob_f :
+                fertility = [prob_f.get((0, token_f), 0.), prob_f.get((1, token_f), 0.)]
+            row = []
+            for index_e, token_e in enumerate(sentence_e) :
+                cur_prob_t = prob_t.get((token_e, token_f))
+                cur_prob_d = prob_d.get((index_e, index_f, self.length_e, self.length_f))
+                if (cur_prob_t is None) or (cur_prob_d is None) :
+                    row.append(invalid)
+                else :
+                    row.append(cur_prob_t + cur_prob_d + fertility[index_e > 0]) # log probability
+            self.cells.append(row)
+
+    def get_probability(self, token_alignments) :
+        return sum(row[index_e] for row, index_e in zip(self.cells, token_alignments))
+
+    def get_argmax(self) :
+        '''
+            returns the best alignment (list of index_e per index_f) or None if there is no valid one
+        '''
+        res = []
+        for row in self.cells :
+            index_e = max(range(self.length_e), key=row.__getitem__)
+            if row[index_e] == float('-inf') :
+                return None
+            res.append(index_e)
+        return res
+
+    def get_move_delta(self, token_alignments, index_f, index_e) :
+        row = self.cells[index_f]
+        return row[index_e] - row[token_alignments[index_f]]
+
+    def get_swap_delta(self, token_alignments, index_f, index_swap) :
+        index_e, index_e_swap = token_alignments[index_f], token_alignments[index_swap]
+        row, row_swap = self.cells[index_f], self.cells[index_swap]
+        return (row[index_e_swap] + row_swap[index_e]) - (row[index_e] + row_swap[index_e_swap])
+
+    def hillclimb(self, token_alignments, pegged=None) :
+        '''
+            greedily applies the best improving move or swap (keeping the pegged position fixed)
+
+            returns (token_alignments, log_prob) of the local maximum
+        '''
+        res = list(token_alignments)
+        res_prob = self.get_probability(res)
+        while True :
+            best = (0., None, None, None)
+            for index_f in range(self.length_f) :
+                if index_f == pegged : continue
+                for index_e in range(self.length_e) :
+                    delta = self.get_move_delta(res, index_f, index_e)
+                    if delta > best[0] : best = (delta, 'move', index_f, index_e)
+                for index_swap in range(index_f+1, self.length_f) :
+                    if index_swap == pegged : continue
+                    delta = self.get_swap_delta(res, index_f, index_swap)
+                    if delta > best[0] : best = (delta, 'swap', index_f, index_swap)
+            if best[1] is None :
+                break
+            if best[1] == 'move' :
+                res[best[2]] = best[3]
+            else :
+                res[best[2]], res[best[3]] = res[best[3]], res[best[2]]
+            res_prob += best[0]
+        return res, res_prob
+
+    def sample(self, max_samples=64, time_budget=None, max_pegged=4) :
+        '''
+            samples the neighbourhoods of the hill-climbed alignments of the peggings (Brown et al., 1993)
+
+            every source position is only pegged to its max_pegged most probable target positions, which bounds
+            the number of hill-climbs by length_f * max_pegged instead of length_f * length_e
+            arguments
+                max_samples=64 : number of (most probable) unique alignments which are kept
+                time_budget=None : maximum seconds spent on the pair
+                max_pegged=4 : number of target positions every source position is pegged to (None : all)
+
+            returns [(token_alignments, log_prob), ...] sorted by probability or [] if there is no valid alignment
+        '''
+        start = self.get_argmax()
+        if start is None :
+            return []
+        deadline = None if time_budget is None else perf_counter() + time_budget
+        samples = [] # min-heap of (log_prob, token_alignments)
+        seen = set()
+        def add(prob, token_alignments) :
+            if (len(samples) >= max_samples) and (prob <= samples[0][0]) :
+                return
+            key = tuple(token_alignments)
+            if key in seen :
+                return
+            seen.add(key)
+            if len(samples) < max_samples :
+                heapq.heappush(samples, (prob, key))
+            else :
+                heapq.heapreplace(samples, (prob, key))
+        add(self.get_probability(start), start)
+        for pegged in range(self.length_f) :
+            row = self.cells[pegged]
+            candidates = sorted(range(self.length_e), key=row.__getitem__, reverse=True)[:max_pegged]
+            for pegged_e in candidates :
+                if (deadline is not None) and (perf_counter() > deadline) :
+                    return [ (list(key), prob) for prob, key in sorted(samples, reverse=True) ]
+                if row[pegged_e] == float('-inf') :
+                    break
+                cur_alignments = list(start)
+                cur_alignments[pegged] = pegged_e
+                cur_alignments, cur_prob = self.hillclimb(cur_alignments, pegged)
+                add(cur_prob, cur_alignments)
+                # neighbourhood of the pegged local maximum, scored by deltas
+                for index_f in range(self.length_f) :
+                    if index_f == pegged : continue
+                    for index_e in range(self.length_e) :
+                        prob = cur_prob + self.get_move_delta(cur_alignments, index_f, index_e)
+                        if (prob > float('-inf')) and ((len(samples) < max_samples) or (prob > samples[0][0])) :
+                            neighbor = list(cur_alignments)
+                            neighbor[index_f] = index_e
+                            add(prob, neighbor)
+                    for index_swap in range(index_f+1, self.length_f) :
+                        if index_swap == pegged : continue
+                        prob = cur_prob + self.get_swap_delta(cur_alignments, index_f, index_swap)
+                        if (prob > float('-inf')) and ((len(samples) < max_samples) or (prob > samples[0][0])) :
+                            neighbor = list(cur_alignments)
+                            neighbor[index_f], neighbor[index_swap] = neighbor[index_swap], neighbor[index_f]
+                            add(prob, neighbor)
+        return [ (list(key), prob) for prob, key in sorted(samples, reverse=True) ]
+
+class ngram_model :
     '''
-    res = {}
-    with open(path, "r", encoding="utf8") as fop :
-        for line in fop :
-            fop_items = [ item.strip() for item in line.split("|||") ]
-            for fop_index, fop_item in enumerate(fop_items) :
-                try :
-                    fop_items[fop_index] = type(datatype)(fop_item) # cast fop_item to datatype
-                except (TypeError, ValueError) :
-                    fop_items[fop_index] = fop_item # if not possible, just use str
-            res[tuple(fop_items[:-1])] = float(fop_items[len(fop_items)-1])
-    return res
+        Array-backed n-gram language model with stupid backoff (Brants et al., 2007)
+
+        The n-grams are stored in a reversed trie over integer token ids: level k holds all k-grams
+        as (parent node, token id) sorted by parent, where the path of (w_1, ..., w_k) is w_k, w_k-1, ..., w_1.
+        The longest matching history of a token is therefore found in a single walk of at most n-1
+        binary searches and every level only consists of flat token id, child offset and float32 arrays.
+        The levels are written to a versioned ".smlm" file by export_lm and memory-mapped by import_lm.
 
-def export_sentences(sentences, path) :
+        sections (see _write_sectioned)
+            vocabulary offsets (uint64), vocabulary (utf8)
+            per level k > 1 : child offsets (int64) of the nodes of level k-1
+            per level k : token ids (int32), log probs (float32)
     '''
-        exports tokenized sentences to path
+    MAGIC = b'SMLM'
+    VERSION = 1
+
+    def __init__(self, dists_lm, backoff=0.4) :
+        '''
+            arguments
+                dists_lm : {n : {(w_n, w_1, ..., w_n-1) : log prob}} as returned by train_lm,
+                           or the path of a file written by export_lm
+                backoff=0.4 : backoff factor for every order which is not matched
+        '''
+        self.mmap = None
+        if isinstance(dists_lm, str) :
+            self._load(dists_lm)
+        else :
+            self._build(dists_lm, backoff)
+        self.order = len(self.words) - 1
+        self.log_backoff = log(self.backoff)
+        # unknown tokens get the probability of a singleton
+        self.log_unknown = log(1./max(len(self.tokens), 1))
+
+    def _build(self, dists_lm, backoff) :
+        self.backoff = backoff
+        self.tokens = sorted(key[0] for key in dists_lm[1].keys())
+        self.ids = { token : token_id for token_id, token in enumerate(self.tokens) }
+        self.words = [None, array('i', range(len(self.tokens)))]
+        self.probs = [None, array('f', [ dists_lm[1][(token,)] for token in self.tokens ])]
+        self.children = [None]
+        nodes = { (token_id,) : token_id for token_id in range(len(self.tokens)) }
+        for n in range(2, max(dists_lm.keys())+1) :
+            entries = []
+            for key, prob in dists_lm[n].items() :
+                path = tuple(self.ids.get(token) for token in (key[0],) + tuple(reversed(key[1:])))
+                parent = nodes.get(path[:-1])
+                if (parent is None) or (path[-1] is None) :
+                    continue
+                entries.append((parent, path[-1], prob, path))
+            entries.sort(key=lambda entry: entry[:2])
+            children = array('q', [0]) * (len(nodes) + 1)
+            for entry in entries :
+                children[entry[0]+1] += 1
+            for index in range(len(nodes)) :
+                children[index+1] += children[index]
+            self.children.append(children)
+            self.words.append(array('i', [ entry[1] for entry in entries ]))
+            self.probs.append(array('f', [ entry[2] for entry in entries ]))
+            nodes = { entry[3] : index for index, entry in enumerate(entries) }
+
+    def _load(self, path) :
+        self.mmap, header, sections = _read_sectioned(path, ngram_model.MAGIC, ngram_model.VERSION)
+        self.backoff = header['backoff']
+        vocab_offsets = sections[0].cast('Q')
+        self.tokens = [ bytes(sections[1][vocab_offsets[index]:vocab_offsets[index+1]]).decode('utf8') for index in range(len(vocab_offsets)-1) ]
+        self.ids = { token : token_id for token_id, token in enumerate(self.tokens) }
+        self.words, self.probs, self.children = [None], [None], [None]
+        for level in header['levels'] :
+            if 'children' in level :
+                self.children.append(sections[level['children']].cast('q'))
+            self.words.append(sections[level['words']].cast('i'))
+            self.probs.append(sections[level['probs']].cast('f'))
+
+    def __len__(self) :
+        return sum(len(words) for words in self.words[1:])
+
+    def get_id(self, token) :
+        return self.ids.get(token)
+
+    def get_count(self, n) :
+        '''
+            returns the number of stored n-grams of length n
+        '''
+        return len(self.words[n]) if 0 < n <= self.order else 0
+
+    def get_probs(self, history_ids, token_id) :
+        '''
+            walks the trie for a token id given the ids of its history (most recent last)
+
+            returns [log p(token), log p(token | 1 history token), ...] up to the longest matching n-gram
+            (empty for unknown tokens), every longer n-gram is unseen
+        '''
+        if token_id is None :
+            return []
+        node = token_id
+        res = [self.probs[1][node]]
+        for level in range(2, min(len(history_ids) + 1, self.order)+1) :
+            history_id = history_ids[-(level-1)]
+            if history_id is None :
+                break
+            children = self.children[level-1]
+            start, end = children[node], children[node+1]
+            words = self.words[level]
+            index = bisect_left(words, history_id, start, end)
+            if (index == end) or (words[index] != history_id) :
+                break
+            node = index
+            res.append(self.probs[level][node])
+        return res
+
+    def score_ids(self, history_ids, token_id) :
+        '''
+            scores a token id given the ids of its history (most recent last)
+
+            returns (log prob, matched order) where matched order is the length of the longest
+            matching n-gram (0 for unknown tokens)
+        '''
+        order = min(len(history_ids) + 1, self.order)
+        probs = self.get_probs(history_ids, token_id)
+        if len(probs) < 1 :
+            return self.log_unknown + (order-1) * self.log_backoff, 0
+        return probs[-1] + (order - len(probs)) * self.log_backoff, len(probs)
+
+    def score(self, history, token) :
+        '''
+            scores a token given its history (list of tokens, most recent last) with stupid backoff
+
+            returns (log prob, matched order)
+        '''
+        history = history[max(len(history)-self.order+1, 0):] if self.order > 1 else []
+        return self.score_ids([ self.ids.get(history_token) for history_token in history ], self.ids.get(token))
+
+class lm_scorer :
     '''
-    with open(path, "w", encoding="utf8") as fop:
-        for sentence in sentences :
+        Incremental interpolated n-gram scorer over opaque language model states
+
+        A state is the truncated context (tuple of the n-1 most recent tokens). score(state, token)
+        returns the interpolated log probability sum_n weight_n * log p_n(token | context) together with the
+        state after token, where unseen n-grams get the log probability of 1/count_unique(n). The n-gram
+        probabilities of all orders come from a single walk of the ngram_model trie. The weights and unseen
+        probabilities are precomputed and the computed transitions are memoized in an lru_cache, so repeated
+        extensions cost a single lookup without building any n-gram tuples and the memory stays bounded.
+    '''
+    def __init__(self, dists_lm, lm_weights, max_transitions=1<<20) :
+        '''
+            arguments
+                dists_lm : ngram_model, or {n : {(w_n, w_1, ..., w_n-1) : log prob}} which is compacted into one
+                lm_weights : {n : weight}
+                max_transitions=1<<20 : maximum number of memoized transitions (least recently used are evicted)
+        '''
+        self.model = dists_lm if isinstance(dists_lm, ngram_model) else ngram_model(dists_lm)
+        self.order = self.model.order
+        # (n, weight, log prob of unseen n-grams) of all orders with a weight
+        self.weights = [ (n, lm_weights[n], log(1./max(self.model.get_count(n), 1))) for n in range(1, self.order+1) if lm_weights.get(n, 0.) != 0. ]
+        self.transitions = lru_cache(max_transitions)
+        self.start = self.get_state(('<s>',))
+
+    def get_state(self, context) :
+        '''
+            returns the state of a context (tuple of tokens, most recent last)
+        '''
+        return tuple(context[max(len(context)-self.order+1, 0):]) if self.order > 1 else ()
+
+    def get_context(self, state) :
+        return state
+
+    def score(self, state, token) :
+        '''
+            returns (log prob of token after state, new state)
+        '''
+        res = self.transitions.get((state, token))
+        if res is not None :
+            return res
+        probs = self.model.get_probs([ self.model.get_id(token_context) for token_context in state ], self.model.get_id(token))
+        logprob = 0.
+        for n, weight, log_unseen in self.weights :
+            if n-1 > len(state) :
+                break
+            logprob += (probs[n-1] if n <= len(probs) else log_unseen) * weight
+        res = (logprob, self.get_state(state + (token,)))
+        self.transitions.put((state, token), res)
+        return res
+
+    def get_stats(self) :
+        '''
+            returns {'size', 'max_size', 'hits', 'misses', 'hit_rate'} of the memoized transitions
+        '''
+        return self.transitions.get_stats()
+
+class model_table(Mapping) :
+    '''
+        Lazily memory-mapped probability table of a model_file
+
+        Keys are stored as integer columns (interned strings or ints) sorted by context, i.e.
+        p(arg|given) with key = (arg,)+given is ordered by (given, arg), so that lookups are binary
+        searches and all options of a context are contiguous. The rows of every context are also
+        ranked by probability in the file, so the most probable options are a slice of the ranking.
+        The table offers the query methods of distribution (get_probability, get_options,
+        get_options_sorted, top_k) and a read-only dict view.
+    '''
+    def __init__(self, model, columns, kinds, values, codebook=None, ranking=None) :
+        self.model = model
+        self.columns = columns # stored order : given columns, arg column
+        self.kinds = kinds # 's' (vocabulary id) or 'i' (int) per stored column
+        self.values = values
+        self.codebook = codebook # values are codes of the codebook if the table is quantized
+        self.ranking = ranking # rows of every context range ordered by decreasing probability
+        self.row_count = len(values)
+
+    def get_value(self, row) :
+        if self.codebook is None :
+            return self.values[row]
+        return self.codebook[self.values[row]]
+
+    def _encode(self, items) :
+        res = []
+        for item, kind in zip(items, self.kinds) :
+            if kind == 's' :
+                item = self.model.get_id(item) if isinstance(item, str) else None
+            elif not isinstance(item, int) :
+                item = None
+            if item is None :
+                return None
+            res.append(item)
+        return tuple(res)
+
+    def _decode(self, row) :
+        res = [ self.model.get_token(column[row]) if kind == 's' else column[row] for column, kind in zip(self.columns, self.kinds) ]
+        return (res[-1],) + tuple(res[:-1])
+
+    def _bisect(self, query, upper=False) :
+        # first row whose prefix is >= (or > if upper) the encoded query prefix
+        low, high = 0, self.row_count
+        width = len(query)
+        while low < high :
+            middle = (low + high) // 2
+            row = tuple(column[middle] for column in self.columns[:width])
+            if (row < query) or (upper and row == query) :
+                low = middle + 1
+            else :
+                high = middle
+        return low
+
+    def _get_range(self, context) :
+        query = self._encode(context)
+        if query is None :
+            return 0, 0
+        return self._bisect(query), self._bisect(query, upper=True)
+
+    def __getitem__(self, key) :
+        query = self._encode(tuple(key[1:]) + (key[0],))
+        if query is not None :
+            row = self._bisect(query)
+            if (row < self.row_count) and (tuple(column[row] for column in self.columns) == query) :
+                return self.get_value(row)
+        raise KeyError(key)
+
+    def __iter__(self) :
+        for row in range(self.row_count) :
+            yield self._decode(row)
+
+    def __len__(self) :
+        return self.row_count
+
+    def get_probability(self, query) :
+        return self.get(tuple(query), 0.)
+
+    def get_probabilities(self) :
+        return dict(self.items())
+
+    def get_options(self, query) :
+        '''
+            returns a dict of options given a query p(res|query)
+        '''
+        start, end = self._get_range(query)
+        arg_column = self.columns[-1]
+        if self.kinds[-1] == 's' :
+            return { self.model.get_token(arg_column[row]) : self.get_value(row) for row in range(start, end) }
+        return { arg_column[row] : self.get_value(row) for row in range(start, end) }
+
+    def _get_option(self, row) :
+        if self.kinds[-1] == 's' :
+            return (self.model.get_token(self.columns[-1][row]), self.get_value(row))
+        return (self.columns[-1][row], self.get_value(row))
+
+    def _get_ranking(self) :
+        if self.ranking is None :
+            # files without a ranking are ranked once on first use
+            self.ranking = get_ranking(self.columns, self.get_value, self.row_count)
+        return self.ranking
+
+    def get_options_sorted(self, query) :
+        start, end = self._get_range(query)
+        return [ self._get_option(row) for row in self._get_ranking()[start:end] ]
+
+    def top_k(self, query, k) :
+        start, end = self._get_range(query)
+        return options_view(memoryview(self._get_ranking())[start:min(start+k, end)], self._get_option)
+
+class model_file :
+    '''
+        Versioned binary model file (t, d, f, language model tables and scalars such as p0)
+
+        All strings of all tables are interned into one sorted vocabulary, which is searched
+        lazily on the memory-mapped file, so opening a model only parses the json header.
+
+        sections (see _write_sectioned)
+            vocabulary offsets (uint64), vocabulary (utf8)
+            per table : one int64 array per key column, values (float64 or float32) or uint8 codes and a float32 codebook,
+                        the rows of every context ordered by decreasing probability (int64)
+    '''
+    MAGIC = b'SMUM'
+    VERSION = 1
+
+    def __init__(self, path) :
+        self.path = path
+        self.mmap, self.header, sections = _read_sectioned(path, model_file.MAGIC, model_file.VERSION)
+        self.vocab_offsets = sections[0].cast('Q')
+        self.vocab = sections[1]
+        self.scalars = self.header['scalars']
+        self.tables = {}
+        self._ids = {}
+        for name, table in self.header['tables'].items() :
+            columns = [ sections[index].cast('q') for index in table['columns'] ]
+            values = sections[table['values']].cast(table['value_type'])
+            codebook = sections[table['codebook']].cast('f') if 'codebook' in table else None
+            ranking = sections[table['ranking']].cast('q') if 'ranking' in table else None
+            self.tables[name] = model_table(self, columns, table['kinds'], values, codebook, ranking)
+
+    def __getitem__(self, name) :
+        if name in self.tables :
+            return self.tables[name]
+        return self.scalars[name]
+
+    def get_token(self, token_id) :
+        return bytes(self.vocab[self.vocab_offsets[token_id]:self.vocab_offsets[token_id+1]]).decode('utf8')
+
+    def get_id(self, token) :
+        '''
+            returns the id of a token (binary search over the sorted vocabulary) or None
+        '''
+        res = self._ids.get(token, -1)
+        if res != -1 :
+            return res
+        query = token.encode('utf8')
+        low, high = 0, len(self.vocab_offsets) - 1
+        while low < high :
+            middle = (low + high) // 2
+            if bytes(self.vocab[self.vocab_offsets[middle]:self.vocab_offsets[middle+1]]) < query :
+                low = middle + 1
+            else :
+                high = middle
+        res = None
+        if (low < len(self.vocab_offsets) - 1) and (self.get_token(low) == token) :
+            res = low
+        self._ids[token] = res
+        return res
+
+class lru_cache :
+    '''
+        Bounded mapping with least recently used eviction and hit/miss counters
+
+        All operations hold a lock, so a cache can be shared by the threads of a long-running process.
+    '''
+    def __init__(self, max_size=10000) :
+        '''
+            arguments
+                max_size=10000 : maximum number of entries (0 disables the cache)
+        '''
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def __len__(self) :
+        return len(self.entries)
+
+    def get(self, key, default=None) :
+        '''
+            returns the value of key (marking it as recently used) or default
+        '''
+        with self.lock :
+            if key in self.entries :
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+            self.misses += 1
+            return default
+
+    def put(self, key, value) :
+        with self.lock :
+            if self.max_size < 1 :
+                return
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size :
+                self.entries.popitem(last=False)
+
+    def clear(self) :
+        with self.lock :
+            self.entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def reset_stats(self) :
+        with self.lock :
+            self.hits = 0
+            self.misses = 0
+
+    def get_stats(self) :
+        '''
+            returns {'size', 'max_size', 'hits', 'misses', 'hit_rate'}
+        '''
+        with self.lock :
+            lookups = self.hits + self.misses
+            return {'size':len(self.entries), 'max_size':self.max_size, 'hits':self.hits, 'misses':self.misses, 'hit_rate':(self.hits/lookups if lookups > 0 else 0.)}
+
+class decoder_cache :
+    '''
+        Memoization of decoder results on three levels
+
+            sentences : translations keyed by (decoder, foreign tokens)
+            candidates : candidate lists keyed by (table, foreign token, number of candidates)
+            lm : the lm_scorer of the decoders, whose memoized transitions are the scores by (state, token)
+
+        A cache is only valid for one set of models, LM weights and decoder parameters. Decoders with workers
+        fill a copy of the cache per worker process, which persists with the decoder pool between calls, and
+        report the statistics of these copies to the cache.
+    '''
+    def __init__(self, sentence_size=10000, candidate_size=50000, lm_size=200000) :
+        '''
+            arguments
+                sentence_size=10000, candidate_size=50000, lm_size=200000 : maximum number of entries per level
+        '''
+        self.sentences = lru_cache(sentence_size)
+        self.candidates = lru_cache(candidate_size)
+        self.lm_size = lm_size
+        self.lm = None
+        self.worker_stats = {} # latest statistics of the copies in decoder worker processes by process id
+
+    def get_lm_scorer(self, dists_lm, lm_weights) :
+        '''
+            returns the lm_scorer of the cache, which is created on first use
+        '''
+        if self.lm is None :
+            self.lm = lm_scorer(dists_lm, lm_weights, self.lm_size)
+        return self.lm
+
+    def clear(self) :
+        self.sentences.clear()
+        self.candidates.clear()
+        self.lm = None
+        self.worker_stats = {}
+
+    def reset_stats(self) :
+        '''
+            resets the hit and miss counters of all levels, keeping their entries
+        '''
+        self.sentences.reset_stats()
+        self.candidates.reset_stats()
+        if self.lm is not None : self.lm.transitions.reset_stats()
+        self.worker_stats = {}
+
+    def set_worker_stats(self, worker, stats) :
+        '''
+            records the latest statistics (see get_stats) of the copy of the cache in a worker process
+        '''
+        self.worker_stats[worker] = stats
+
+    def get_stats(self) :
+        '''
+            returns {level : stats} (see lru_cache.get_stats) summed over this cache and its worker copies
+        '''
+        res = {'sentences':self.sentences.get_stats(), 'candidates':self.candidates.get_stats()}
+        res['lm'] = self.lm.get_stats() if self.lm is not None else {'size':0, 'max_size':self.lm_size, 'hits':0, 'misses':0, 'hit_rate':0.}
+        if self.worker_stats :
+            for level, stats in res.items() :
+                if stats['hits'] + stats['misses'] == 0 :
+                    # only the worker copies were used
+                    stats['size'], stats['max_size'] = 0, 0
+                for worker_stats in self.worker_stats.values() :
+                    for name in ['size', 'max_size', 'hits', 'misses'] :
+                        stats[name] += worker_stats[level][name]
+                lookups = stats['hits'] + stats['misses']
+                stats['hit_rate'] = stats['hits']/lookups if lookups > 0 else 0.
+        return res
+
+class training_cache :
+    '''
+        Content-addressed on-disk store of trained tables
+
+        Entries are keyed by the fingerprint (sha256) of the corpus file, the training stage and its
+        parameters, so e.g. train_model2 reuses the Model 1 result of every earlier run on the same corpus
+        content, independent of its path or the output prefix. The store is bounded by max_bytes and the
+        least recently used entries are evicted first. The entries and the fingerprints of already hashed
+        files (by size and modification time) are kept in a json index in the cache directory.
+    '''
+    VERSION = 1 # part of every key, increased when the trainers change their results
+
+    def __init__(self, path, max_bytes=1<<31) :
+        '''
+            arguments
+                path : cache directory (created on the first store)
+                max_bytes=1<<31 : maximum total size of the stored entries
+        '''
+        self.path = path
+        self.max_bytes = max_bytes
+        self.index_path = os.path.join(path, 'index.json')
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def _load_index(self) :
+        try :
+            with open(self.index_path, 'r', encoding='utf8') as fop :
+                return json.load(fop)
+        except (IOError, ValueError) :
+            return {'entries' : {}, 'fingerprints' : {}}
+
+    def _save_index(self, index) :
+        os.makedirs(self.path, exist_ok=True)
+        tmp_path = self.index_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf8') as fop :
+            json.dump(index, fop)
+        os.replace(tmp_path, self.index_path)
+
+    def _get_entry_path(self, key) :
+        return os.path.join(self.path, key + '.pkl')
+
+    def _get_key(self, stage, fingerprint, params) :
+        return hashlib.sha256(json.dumps([training_cache.VERSION, stage, fingerprint, params], sort_keys=True).encode('utf8')).hexdigest()
+
+    def get_fingerprint(self, path) :
+        '''
+            returns the sha256 of the content of a file, which is only hashed again if it was modified
+        '''
+        path = os.path.abspath(path)
+        stamp = corpus_cache._source_stamp(path)
+        with self.lock :
+            index = self._load_index()
+            known = index['fingerprints'].get(path)
+            if (known is not None) and (known[:2] == stamp) :
+                return known[2]
+        res = get_file_fingerprint(path)
+        with self.lock :
+            index = self._load_index()
+            index['fingerprints'][path] = stamp + [res]
+            self._save_index(index)
+        return res
+
+    def get(self, stage, fingerprint, params) :
+        '''
+            returns the stored result of a stage or None
+            arguments
+                stage : e.g. 'model1'
+                fingerprint : fingerprint of the corpus (see get_fingerprint)
+                params : json serializable dict of the parameters which change the result
+        '''
+        key = self._get_key(stage, fingerprint, params)
+        with self.lock :
+            index = self._load_index()
+            entry = index['entries'].get(key)
+            res = None
+            if entry is not None :
+                try :
+                    with open(self._get_entry_path(key), 'rb') as fop :
+                        res = pickle.load(fop)
+                    entry['used'] = wall_time()
+                except (IOError, EOFError, pickle.UnpicklingError) :
+                    del index['entries'][key] # missing or damaged entry
+                self._save_index(index)
+            if res is None :
+                self.misses += 1
+            else :
+                self.hits += 1
+        return res
+
+    def put(self, stage, fingerprint, params, value) :
+        '''
+            stores the result of a stage (see get) and evicts the least recently used entries beyond max_bytes
+        '''
+        key = self._get_key(stage, fingerprint, params)
+        entry_path = self._get_entry_path(key)
+        with self.lock :
+            os.makedirs(self.path, exist_ok=True)
+            with open(entry_path + '.tmp', 'wb') as fop :
+                pickle.dump(value, fop, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(entry_path + '.tmp', entry_path)
+            index = self._load_index()
+            index['entries'][key] = {'stage':stage, 'fingerprint':fingerprint, 'params':params, 'bytes':os.path.getsize(entry_path), 'used':wall_time()}
+            total = sum(entry['bytes'] for entry in index['entries'].values())
+            for old_key in sorted(index['entries'], key=lambda old_key: index['entries'][old_key]['used']) :
+                if total <= self.max_bytes :
+                    break
+                total -= index['entries'][old_key]['bytes']
+                self._remove(index, old_key)
+            self._save_index(index)
+
+    def _remove(self, index, key) :
+        del index['entries'][key]
+        try :
+            os.remove(self._get_entry_path(key))
+        except OSError :
+            pass
+
+    def invalidate(self, stages=None, fingerprint=None) :
+        '''
+            removes all entries of the given stages and corpus fingerprint (None matches everything)
+
+            returns the number of removed entries
+        '''
+        with self.lock :
+            index = self._load_index()
+            keys = [ key for key, entry in index['entries'].items() if ((stages is None) or (entry['stage'] in stages)) and ((fingerprint is None) or (entry['fingerprint'] == fingerprint)) ]
+            for key in keys :
+                self._remove(index, key)
+            if keys :
+                self._save_index(index)
+        return len(keys)
+
+    def get_stats(self) :
+        '''
+            returns {'entries', 'bytes', 'max_bytes', 'hits', 'misses'}
+        '''
+        index = self._load_index()
+        return {'entries':len(index['entries']), 'bytes':sum(entry['bytes'] for entry in index['entries'].values()), 'max_bytes':self.max_bytes, 'hits':self.hits, 'misses':self.misses}
+
+class progress_monitor :
+    '''
+        Instrumentation layer which trainers and decoders report their progress and metrics to
+
+        Every report is handed to the callbacks as an event dict with the keys
+            event : 'start', 'progress', 'iteration' or 'end'
+            stage : e.g. 'model1', 'lm' or 'decode'
+            time : wall clock time
+        and depending on the event iteration, iterations, done, total, seconds, rate (items per second),
+        rss_mb (resident memory) and the fields of the reporting function (e.g. tables={'t' : entries},
+        log_likelihood). Progress events are throttled to one per progress_interval seconds, so reporting
+        every sentence only costs a clock lookup. Totals which are not known yet (e.g. the length of a
+        corpus which has not been read completely) are reported as None.
+    '''
+    def __init__(self, callbacks=None, progress_interval=0.1) :
+        '''
+            arguments
+                callbacks=None : list of functions called with every event
+                progress_interval=0.1 : minimum number of seconds between progress events
+        '''
+        self.callbacks = list(callbacks) if callbacks else []
+        self.progress_interval = progress_interval
+        self.stages = {}
+        self.last_progress = 0.
+
+    def add_callback(self, callback) :
+        self.callbacks.append(callback)
+
+    def _emit(self, event) :
+        event['time'] = wall_time()
+        for callback in self.callbacks :
+            callback(event)
+
+    def start(self, stage, total=None, iterations=None, **fields) :
+        '''
+            starts timing a stage over total items (sentences or sentence pairs) per iteration
+        '''
+        now = perf_counter()
+        self.stages[stage] = {'start':now, 'iteration_start':now, 'total':total, 'iterations':iterations, 'done':None}
+        event = {'event':'start', 'stage':stage, 'total':total, 'iterations':iterations}
+        event.update(fields)
+        self._emit(event)
+
+    def progress(self, stage, done, iteration=None, **fields) :
+        '''
+            reports done items of the current iteration (throttled)
+        '''
+        state = self.stages[stage]
+        state['done'] = done
+        now = perf_counter()
+        if now - self.last_progress < self.progress_interval :
+            return
+        self.last_progress = now
+        elapsed = now - state['iteration_start']
+        total = state['total'] if (state['total'] is not None) and (state['total'] >= done) else None
+        event = {'event':'progress', 'stage':stage, 'iteration':iteration, 'iterations':state['iterations'], 'done':done, 'total':total, 'rate':(done/elapsed if elapsed > 0 else None)}
+        event.update(fields)
+        self._emit(event)
+
+    def iteration(self, stage, iteration, done, **fields) :
+        '''
+            reports a completed iteration over done items
+        '''
+        now = perf_counter()
+        state = self.stages[stage]
+        seconds = now - state['iteration_start']
+        state['iteration_start'] = now
+        state['total'] = max(state['total'] or 0, done)
+        event = {'event':'iteration', 'stage':stage, 'iteration':iteration, 'iterations':state['iterations'], 'done':done, 'total':state['total'], 'seconds':seconds, 'rate':(done/seconds if seconds > 0 else None), 'rss_mb':get_rss_mb()}
+        event.update(fields)
+        self._emit(event)
+
+    def end(self, stage, done=None, **fields) :
+        '''
+            reports the end of a stage, done are all items processed during the stage (default the last progress)
+        '''
+        state = self.stages.pop(stage)
+        done = state['done'] if done is None else done
+        if done is not None :
+            state['total'] = max(state['total'] or 0, done)
+        seconds = perf_counter() - state['start']
+        event = {'event':'end', 'stage':stage, 'done':done, 'seconds':seconds, 'rate':(done/seconds if (done is not None) and (seconds > 0) else None), 'rss_mb':get_rss_mb()}
+        event.update(fields)
+        self._emit(event)
+
+class console_callback :
+    '''
+        Writes the events of a progress_monitor to the console, progress at most every interval seconds
+    '''
+    def __init__(self, interval=0.5, stream=None) :
+        self.interval = interval
+        self.stream = stream if stream is not None else sys.stdout
+        self.last_write = 0.
+
+    def _format(self, event) :
+        res = event['stage']
+        if event.get('iteration') is not None :
+            res += ' | iteration %d of %d' % (event['iteration'], event['iterations'])
+        if event.get('done') is not None :
+            res += (' | %d of %d' % (event['done'], event['total'])) if event.get('total') else (' | %d' % event['done'])
+        if event.get('rate') is not None :
+            res += ' | %.1f/s' % event['rate']
+        for name, entries in event.get('tables', {}).items() :
+            res += ' | %s : %d' % (name, entries)
+        if event.get('log_likelihood') is not None :
+            res += ' | log likelihood : %.4f' % event['log_likelihood']
+        if event.get('seconds') is not None :
+            res += ' | %.2fs' % event['seconds']
+        if event.get('rss_mb') is not None :
+            res += ' | %.0f MB' % event['rss_mb']
+        return res
+
+    def __call__(self, event) :
+        if event['event'] == 'start' :
+            return
+        if event['event'] == 'progress' :
+            now = perf_counter()
+            if now - self.last_write < self.interval :
+                return
+            self.last_write = now
+            self.stream.write('\r' + self._format(event) + ' '*10)
+        else :
+            self.stream.write('\r' + self._format(event) + ' '*10 + '\n')
+        self.stream.flush()
+
+class jsonl_callback :
+    '''
+        Appends the events of a progress_monitor as JSON lines to a file
+    '''
+    def __init__(self, path, progress=False) :
+        '''
+            arguments
+                path : output file
+                progress=False : also write the (throttled) progress events
+        '''
+        self.fop = open(path, 'a', encoding='utf8')
+        self.progress = progress
+
+    def __call__(self, event) :
+        if (event['event'] == 'progress') and (not self.progress) :
+            return
+        self.fop.write(json.dumps(event) + '\n')
+        self.fop.flush()
+
+    def close(self) :
+        self.fop.close()
+
+class profiler_callback :
+    '''
+        Profiles stages with cProfile from their start to their end event
+
+        Nested stages (e.g. Model 1 within Model 2) are part of the outermost profiled stage.
+    '''
+    def __init__(self, stages=None) :
+        '''
+            arguments
+                stages=None : names of the profiled stages (default all)
+        '''
+        self.stages = stages
+        self.profiles = {}
+        self.active = None
+
+    def __call__(self, event) :
+        if (self.stages is not None) and (event['stage'] not in self.stages) :
+            return
+        if (event['event'] == 'start') and (self.active is None) :
+            import cProfile
+            self.active = event['stage']
+            self.profiles[self.active] = cProfile.Profile()
+            self.profiles[self.active].enable()
+        elif (event['event'] == 'end') and (event['stage'] == self.active) :
+            self.profiles[self.active].disable()
+            self.active = None
+
+    def print_stats(self, stage, sort='cumulative', limit=20) :
+        import pstats
+        pstats.Stats(self.profiles[stage], stream=sys.stdout).sort_stats(sort).print_stats(limit)
+
+#
+# functions
+#
+
+def get_rss_mb() :
+    '''
+        returns the resident memory of the process in MB (peak resident memory if the current one is unknown, None if both are)
+    '''
+    try :
+        with open('/proc/self/statm', 'r') as fop :
+            return int(fop.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / (1<<20)
+    except (OSError, ValueError, IndexError, AttributeError) :
+        pass
+    try :
+        import resource
+    except ImportError :
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1<<20) if sys.platform == 'darwin' else peak / (1<<10)
+
+def get_corpus_length(corpus) :
+    '''
+        returns the number of sentences (pairs) of a corpus or None if it has not been counted yet
+    '''
+    if not hasattr(corpus, '__len__') :
+        return None
+    if not getattr(corpus, 'lines_counted', getattr(corpus, 'pairs_counted', True)) :
+        return None
+    return len(corpus)
+
+def get_monitor(monitor=None, verbose=False) :
+    '''
+        returns monitor, a progress_monitor writing to the console if verbose or None if nothing consumes the reports
+    '''
+    if monitor is not None :
+        return monitor
+    if verbose :
+        return progress_monitor([console_callback()])
+    return None
+
+def _data_start(header_length) :
+    position = 16 + header_length
+    return position + (-position) % 8
+
+def _write_sectioned(path, magic, version, header, sections) :
+    '''
+        writes a binary file consisting of magic, version, header length, json header and 8 byte aligned sections
+
+        the section bounds relative to the data block are stored in header['sections'],
+        the file is written to a temporary path first and moved into place
+    '''
+    position = 0
+    header['sections'] = []
+    for section in sections :
+        position += (-position) % 8
+        header['sections'].append([position, position+len(section)])
+        position += len(section)
+    header_bytes = json.dumps(header).encode('utf8')
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as fop :
+        fop.write(struct.pack('<4sIQ', magic, version, len(header_bytes)))
+        fop.write(header_bytes)
+        data_start = _data_start(len(header_bytes))
+        for section, bound in zip(sections, header['sections']) :
+            fop.write(b'\0' * (data_start + bound[0] - fop.tell()))
+            fop.write(section)
+    os.replace(tmp_path, path)
+
+def _read_sectioned(path, magic, version) :
+    '''
+        memory-maps a file written by _write_sectioned
+
+        returns (mmap, header, [memoryview of each section])
+    '''
+    with open(path, 'rb') as fop :
+        res_mmap = mmap.mmap(fop.fileno(), 0, access=mmap.ACCESS_READ)
+    file_magic, file_version, header_length = struct.unpack_from('<4sIQ', res_mmap, 0)
+    if (file_magic != magic) or (file_version != version) :
+        raise ValueError('"' + path + '" is not a ' + magic.decode('ascii') + ' file of version ' + str(version))
+    view = memoryview(res_mmap)
+    header = json.loads(bytes(view[16:16+header_length]).decode('utf8'))
+    data = view[_data_start(header_length):]
+    return res_mmap, header, [ data[start:end] for start, end in header['sections'] ]
+
+def quantize_values(values, levels=256) :
+    '''
+        quantizes values to codes of a codebook with at most levels (<= 256) entries
+
+        the codebook starts from the means of equally populated value ranges and is refined with a few
+        Lloyd iterations (every value is mapped to its nearest entry), which keeps the error small for the
+        skewed log probabilities of the translation and language model tables
+
+        returns (codes as array('B'), codebook as array('f'))
+    '''
+    ordered = sorted(values)
+    count_bins = max(min(levels, 256, len(ordered)), 1)
+    codebook = []
+    for index_bin in range(count_bins) :
+        bin_values = ordered[index_bin*len(ordered)//count_bins:(index_bin+1)*len(ordered)//count_bins]
+        if bin_values :
+            codebook.append(sum(bin_values) / len(bin_values))
+    codebook = sorted(set(codebook)) if codebook else [0.]
+    # the values of an entry are a contiguous range of the sorted values, summed with prefix sums
+    prefix = [0.] + list(accumulate(ordered))
+    for iteration in range(4) :
+        bounds = [ (low + high) / 2 for low, high in zip(codebook[:-1], codebook[1:]) ]
+        cuts = [0] + [ bisect_right(ordered, bound) for bound in bounds ] + [len(ordered)]
+        codebook = [ (prefix[cuts[code+1]] - prefix[cuts[code]]) / (cuts[code+1] - cuts[code]) if cuts[code+1] > cuts[code] else codebook[code] for code in range(len(codebook)) ]
+    codebook = array('f', codebook)
+    bounds = [ (low + high) / 2 for low, high in zip(codebook[:-1], codebook[1:]) ]
+    return array('B', [ bisect_left(bounds, value) for value in values ]), codebook
+
+def export_model(path, tables, scalars=None, value_type='d') :
+    '''
+        exports probability tables to a binary model_file
+        arguments
+            path : path of the model file
+            tables : {name : {key tuple : prob}} e.g. {'t' : t, 'd' : d, 'f' : f}
+            scalars=None : {name : value} of json serializable values e.g. {'p0' : p0}
+            value_type='d' : 'd' (float64), 'f' (float32) or 'B' (8 bit codes of a codebook per table, see quantize_values)
+    '''
+    # intern all strings
+    vocab = set()
+    for table in tables.values() :
+        for key in table.keys() :
+            vocab.update(item for item in key if isinstance(item, str))
+    vocab = sorted(vocab, key=lambda token: token.encode('utf8'))
+    ids = { token : token_id for token_id, token in enumerate(vocab) }
+    vocab_bytes = [ token.encode('utf8') for token in vocab ]
+    vocab_offsets = array('Q', [0])
+    for token in vocab_bytes :
+        vocab_offsets.append(vocab_offsets[-1] + len(token))
+    sections = [vocab_offsets.tobytes(), b''.join(vocab_bytes)]
+    header = {'tables' : {}, 'scalars' : dict(scalars or {})}
+    for name, table in tables.items() :
+        # stored key order : given columns, arg column
+        keys = [ tuple(key[1:]) + (key[0],) for key in table.keys() ]
+        arity = len(keys[0]) if keys else 0
+        kinds = []
+        for index in range(arity) :
+            column_types = set(type(key[index]) for key in keys)
+            if column_types == set([str]) :
+                kinds.append('s')
+            elif column_types == set([int]) :
+                kinds.append('i')
+            else :
+                raise ValueError('column ' + str(index) + ' of table "' + str(name) + '" mixes types ' + str(column_types))
+        rows = sorted(( tuple(ids[item] if kind == 's' else item for item, kind in zip(key, kinds)), table[(key[-1],)+key[:-1]] ) for key in keys)
+        header['tables'][str(name)] = {
+            'kinds' : kinds,
+            'columns' : list(range(len(sections), len(sections)+arity)),
+            'values' : len(sections)+arity,
+            'value_type' : value_type
+        }
+        for index in range(arity) :
+            sections.append(array('q', [ row[0][index] for row in rows ]).tobytes())
+        if value_type == 'B' :
+            codes, codebook = quantize_values([ row[1] for row in rows ])
+            header['tables'][str(name)]['codebook'] = len(sections)+1
+            sections += [codes.tobytes(), codebook.tobytes()]
+            values = [ codebook[code] for code in codes ]
+        else :
+            values = array(value_type, [ row[1] for row in rows ])
+            sections.append(values.tobytes())
+        columns = [ [ row[0][index] for row in rows ] for index in range(arity) ]
+        header['tables'][str(name)]['ranking'] = len(sections)
+        sections.append(get_ranking(columns, values.__getitem__, len(rows)).tobytes())
+    _write_sectioned(path, model_file.MAGIC, model_file.VERSION, header, sections)
+
+def get_ranking(columns, get_value, row_count) :
+    '''
+        ranks the rows of a table sorted by context (all key columns but the last) by decreasing value per context
+
+        returns array('q') of row indices, the rows of a context range [start, end) are ranking[start:end]
+    '''
+    res = array('q')
+    contexts = list(zip(*columns[:-1])) if len(columns) > 1 else [()] * row_count
+    start = 0
+    while start < row_count :
+        end = start + 1
+        while (end < row_count) and (contexts[end] == contexts[start]) :
+            end += 1
+        res.extend(sorted(range(start, end), key=get_value, reverse=True))
+        start = end
+    return res
+
+def import_model(path) :
+    '''
+        opens a binary model_file, tables are answered lazily from the memory-mapped file
+    '''
+    return model_file(path)
+
+def export_lm(path, model) :
+    '''
+        exports a language model to a binary ".smlm" file which import_lm memory-maps
+        arguments
+            path : path of the language model file
+            model : ngram_model or {n : {(w_n, w_1, ..., w_n-1) : log prob}} as returned by train_lm
+    '''
+    if not isinstance(model, ngram_model) :
+        model = ngram_model(model)
+    vocab_bytes = [ token.encode('utf8') for token in model.tokens ]
+    vocab_offsets = array('Q', [0])
+    for token in vocab_bytes :
+        vocab_offsets.append(vocab_offsets[-1] + len(token))
+    sections = [vocab_offsets.tobytes(), b''.join(vocab_bytes)]
+    header = {'backoff' : model.backoff, 'levels' : []}
+    for n in range(1, model.order+1) :
+        level = {}
+        if n > 1 :
+            level['children'] = len(sections)
+            sections.append(bytes(model.children[n-1]))
+        level['words'] = len(sections)
+        level['probs'] = len(sections)+1
+        sections += [bytes(model.words[n]), bytes(model.probs[n])]
+        header['levels'].append(level)
+    _write_sectioned(path, ngram_model.MAGIC, ngram_model.VERSION, header, sections)
+
+def import_lm(path) :
+    '''
+        opens a language model file written by export_lm as ngram_model, the trie levels are memory-mapped
+
+        language models exported as model_file tables (tables 'lm1', ..., 'lmn') are compacted on import
+    '''
+    with open(path, 'rb') as fop :
+        magic = fop.read(4)
+    if magic == model_file.MAGIC :
+        model = import_model(path)
+        return ngram_model({ int(name[2:]) : model[name] for name in model.tables })
+    return ngram_model(path)
+
+def get_file_fingerprint(path) :
+    '''
+        returns the sha256 of the content of a file
+    '''
+    sha = hashlib.sha256()
+    with open(path, 'rb') as fop :
+        for block in iter(lambda: fop.read(1<<20), b'') :
+            sha.update(block)
+    return sha.hexdigest()
+
+def save_checkpoint(path, corpus_path, state, stamp=None) :
+    '''
+        pickles a training state (dict) of the corpus at corpus_path, the file is replaced atomically
+        arguments
+            stamp=None : json serializable description of the corpus content and the training parameters,
+                         the state is only loaded again with an equal stamp (see load_checkpoint)
+    '''
+    state = dict(state)
+    state['corpus'] = os.path.abspath(corpus_path)
+    state['stamp'] = stamp
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as fop :
+        pickle.dump(state, fop, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, path)
+
+def load_checkpoint(path, corpus_path, stamp=None) :
+    '''
+        returns the training state saved at path if it belongs to the corpus at corpus_path and was saved
+        with the same stamp (see save_checkpoint), else None
+    '''
+    try :
+        with open(path, 'rb') as fop :
+            state = pickle.load(fop)
+    except (IOError, EOFError, pickle.UnpicklingError) :
+        return None
+    if (state.get('corpus') != os.path.abspath(corpus_path)) or (state.get('stamp') != stamp) :
+        return None
+    return state
+
+def remove_checkpoint(path) :
+    '''
+        removes the checkpoint at path if it exists, returns True if it was removed
+    '''
+    try :
+        os.remove(path)
+    except OSError :
+        return False
+    return True
+
+def export_probabilities(dist, path) :
+    '''
+        exports a distribution to text file
+    '''
+    with open(path, "w", encoding="utf8") as fop :
+        for key in dist.keys() :
             fop_line = ""
-            for token in sentence :
-                fop_line += token + " "
-            fop_line = fop_line[:-1] + "\n"
+            for key_index in key :
+                fop_line += str(key_index) + " ||| "
+            fop_line += str(dist[key]) + "\n"
             fop.write(fop_line)
+
+def import_probabilities(path, datatype=str()) :
+    '''
+        imports a distribution from ||| separated text file
+        arguments
+            path : path to distribution file
+            datatype=str() : the type the entries should be cast to
+    '''
+    res = {}
+    with open(path, "r", encoding="utf8") as fop :
+        for line in fop :
+            fop_items = [ item.strip() for item in line.split("|||") ]
+            for fop_index, fop_item in enumerate(fop_items) :
+                try :
+                    fop_items[fop_index] = type(datatype)(fop_item) # cast fop_item to datatype
+                except (TypeError, ValueError) :
+                    fop_items[fop_index] = fop_item # if not possible, just use str
+            res[tuple(fop_items[:-1])] = float(fop_items[len(fop_items)-1])
+    return res
+
+def mix_corpora(path_new, path_old, path_out, sample=0.1, seed=0) :
+    '''
+        writes all lines of the new corpus and a random sample of the lines of the old corpus to path_out,
+        e.g. to continue training on newly added parallel data without forgetting the old data
+        arguments
+            path_new : path to the new corpus
+            path_old : path to the old corpus
+            path_out : output path
+            sample=0.1 : probability of each old line to be kept
+            seed=0 : random seed of the sample
+        returns {'new', 'old'} numbers of written lines
+    '''
+    rand = random.Random(seed)
+    res = {'new':0, 'old':0}
+    with open(path_out, "w", encoding="utf8") as fop :
+        with open(path_new, "r", encoding="utf8") as fop_new :
+            for line in fop_new :
+                fop.write(line if line.endswith("\n") else line + "\n")
+                res['new'] += 1
+        with open(path_old, "r", encoding="utf8") as fop_old :
+            for line in fop_old :
+                if rand.random() < sample :
+                    fop.write(line if line.endswith("\n") else line + "\n")
+                    res['old'] += 1
+    return res
+
+def export_sentences(sentences, path, flush_interval=1., buffer_size=1<<16) :
+    '''
+        exports tokenized sentences to path
+
+        sentences may be a generator (e.g. iter_decode_beam), which is consumed incrementally with
+        buffered writes that are flushed to disk at least every flush_interval seconds
+
+        arguments
+            sentences : iterable of token lists
+            path : output path
+            flush_interval=1. : maximum number of seconds between flushes (None to flush only at the end)
+            buffer_size=1<<16 : write buffer size in bytes
+        returns number of exported sentences
+    '''
+    res = 0
+    last_flush = perf_counter()
+    with open(path, "w", encoding="utf8", buffering=buffer_size) as fop:
+        for sentence in sentences :
+            fop.write(" ".join(sentence) + "\n")
+            res += 1
+            if (flush_interval is not None) and (perf_counter() - last_flush >= flush_interval) :
+                fop.flush()
+                last_flush = perf_counter()
+    return res